@@ -0,0 +1,474 @@
+"""
+気象庁のタイル配信の代わりになるローカルのサーバーを使ったベンチマーク
+
+合成した天気予報画像 (wdist) と降雨画像 (nowc) を返す偽のサーバーに対して、
+API サーバーのエンドポイントを典型的なアクセスパターンで叩き、
+レイテンシの p50/p99、RPS、気象庁への取得回数、RSS を出力する。
+
+    python benchmark.py --requests 2000 --concurrency 50 --latency 0.05
+    python benchmark.py --json result.json
+    python benchmark.py --compare result.json --tolerance 0.2
+
+偽のサーバーだけを起動して、別に起動した API サーバーの取得先にすることもできる。
+
+    python benchmark.py --serve --port 49134
+    LWAPI_JMA_BASE_URL=http://localhost:49134/bosai/jmatile/data uvicorn main:app
+"""
+import argparse
+import asyncio
+from functools import lru_cache
+from io import BytesIO
+import json
+import random
+import resource
+import sys
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+import zlib
+
+from fastapi import FastAPI
+from fastapi import Request
+from fastapi import Response
+import httpx
+import numpy as np
+from PIL import Image
+
+import main
+from prefetcher import JAPAN_BBOX
+from tile_fetcher import TileFetcher
+
+# プロダクトごとのパレット番号の数
+PALETTE_SIZES = {"wdist": 6, "nowc": 10}
+
+# 繰り返し問い合わせられる地点 (主要都市)
+HOT_LOCATIONS = [
+    (43.064, 141.347),
+    (40.824, 140.740),
+    (38.269, 140.872),
+    (37.750, 140.468),
+    (36.566, 139.884),
+    (35.690, 139.692),
+    (35.448, 139.642),
+    (36.595, 136.626),
+    (35.181, 136.906),
+    (35.011, 135.768),
+    (34.686, 135.520),
+    (34.691, 135.183),
+    (34.396, 132.459),
+    (33.839, 132.766),
+    (33.607, 130.418),
+    (33.903, 130.934),
+    (32.790, 130.742),
+    (31.560, 130.558),
+    (26.212, 127.681),
+    (24.341, 124.156),
+]
+
+RequestSpec = Tuple[str, str, Any]
+RequestGenerator = Callable[[random.Random], Iterator[RequestSpec]]
+
+
+@lru_cache(maxsize=4096)
+def render_tile(path: str) -> bytes:
+    """
+    URL のパスから、決まった内容の 4 bit パレット PNG を生成する
+    """
+    name = path.split("/")[4]
+    rng = np.random.default_rng(zlib.crc32(path.encode()))
+    blocks = rng.integers(0, PALETTE_SIZES.get(name, 2), (16, 16))
+    indices = np.kron(blocks, np.ones((16, 16), dtype=np.int64))
+    image = Image.fromarray(indices.astype(np.uint8), mode="P")
+    image.putpalette([
+        channel for index in range(16)
+        for channel in (index * 16, 255 - index * 16, 128)
+    ])
+    buffer = BytesIO()
+    image.save(buffer, "PNG", bits=4)
+    return buffer.getvalue()
+
+
+class FakeJMA:
+    """
+    気象庁のタイル配信の代わりに合成したタイル画像を返す ASGI アプリ
+
+    各応答は latency 秒 (± jitter) 遅らせ、error_rate の確率で 500 を返す。
+    ETag を付けて返し、If-None-Match が一致すれば 304 を返す。
+    """
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.fetches = 0
+        self.errors = 0
+        self.not_modified = 0
+        self.app = FastAPI()
+        self.app.add_api_route(
+            "/bosai/jmatile/data/{name}/{observation}/none/{forecast}"
+            "/surf/{element}/{zoom}/{x}/{y}.png",
+            self.get_tile,
+        )
+
+    async def get_tile(
+        self,
+        request: Request,
+        name: str,
+        observation: str,
+        forecast: str,
+        element: str,
+        zoom: int,
+        x: int,
+        y: int,
+    ) -> Response:
+        self.fetches += 1
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return Response(status_code=500)
+        path = (
+            f"/bosai/jmatile/data/{name}/{observation}/none/{forecast}"
+            f"/surf/{element}/{zoom}/{x}/{y}.png"
+        )
+        content = render_tile(path)
+        etag = '"{:08x}"'.format(zlib.crc32(content))
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(
+            content,
+            media_type="image/png",
+            headers={"ETag": etag},
+        )
+
+    def reset(self):
+        self.fetches = 0
+        self.errors = 0
+        self.not_modified = 0
+
+
+def get_rss() -> int:
+    """
+    現在の RSS (バイト) を返す。/proc がなければ最大 RSS を返す
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def random_location(rng: random.Random) -> Dict[str, float]:
+    south, west, north, east = JAPAN_BBOX
+    return {"lat": rng.uniform(south, north), "lon": rng.uniform(west, east)}
+
+
+def hot_location(rng: random.Random) -> Dict[str, float]:
+    lat, lon = rng.choice(HOT_LOCATIONS)
+    return {"lat": lat, "lon": lon}
+
+
+def hot_requests(path: str) -> RequestGenerator:
+    def generate(rng):
+        while True:
+            yield "POST", path, hot_location(rng)
+    return generate
+
+
+def cold_requests(path: str) -> RequestGenerator:
+    def generate(rng):
+        while True:
+            yield "POST", path, random_location(rng)
+    return generate
+
+
+def batch_requests(size: int) -> RequestGenerator:
+    def generate(rng):
+        while True:
+            yield "POST", "/location_weather/batch", {
+                "locations": [
+                    hot_location(rng) if rng.random() < 0.8
+                    else random_location(rng)
+                    for _ in range(size)
+                ],
+            }
+    return generate
+
+
+def get_scenarios(
+    batch_sizes: List[int],
+) -> Dict[str, Tuple[RequestGenerator, int]]:
+    """
+    シナリオ名から、リクエストの生成関数と、キャッシュを捨てる間隔
+    (予報時刻の切り替わりの再現。0 なら捨てない) の組への辞書を返す
+    """
+    scenarios = {
+        "hot-weather": (hot_requests("/location_weather_forecast"), 0),
+        "hot-rainfall": (hot_requests("/location_rainfall"), 0),
+        "cold-rainfall": (cold_requests("/location_rainfall"), 0),
+        "rollover-rainfall": (hot_requests("/location_rainfall"), 100),
+    }
+    for size in batch_sizes:
+        scenarios[f"batch-{size}"] = (batch_requests(size), 0)
+    return scenarios
+
+
+def clear_caches():
+    """
+    予報時刻の切り替わりを再現するため、タイルのキャッシュに加えて、
+    条件付きリクエスト用の検証子と内容のハッシュごとのタイルも捨てる。
+    切り替わり後はタイルの URL が変わるので、実際にはどちらも効かない
+    """
+    for product in main.products:
+        product.cache.clear()
+        product.decoded_tiles.clear()
+        product.fetcher.validators.clear()
+        product.watches.values.clear()
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    fake: FakeJMA,
+    generate: RequestGenerator,
+    rollover_every: int,
+    requests: int,
+    concurrency: int,
+    seed: int,
+) -> Dict[str, float]:
+    """
+    1 つのシナリオを実行して結果を返す
+    """
+    # 前のシナリオのタイルがバックグラウンドでキャッシュに入らないように、
+    # デコード中のものを待ってからキャッシュを捨てる
+    for product in main.products:
+        await asyncio.gather(*product.background_tiles)
+    clear_caches()
+    fake.reset()
+    rng = random.Random(seed)
+    requests_iter = generate(rng)
+    latencies: List[float] = []
+    failures = 0
+    sent = 0
+    lock = asyncio.Lock()
+
+    async def worker():
+        nonlocal failures, sent
+        while True:
+            async with lock:
+                if sent >= requests:
+                    return
+                sent += 1
+                if rollover_every and sent % rollover_every == 0:
+                    clear_caches()
+                method, path, body = next(requests_iter)
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                failures += 1
+            # キャッシュから返せるリクエストは一度も中断せずに終わることがあるので、
+            # 実際の接続と同じように、リクエストごとにイベントループに制御を戻す
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(latencies),
+        "failures": failures,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "upstream_fetches": fake.fetches,
+        "upstream_errors": fake.errors,
+        "upstream_not_modified": fake.not_modified,
+        "rss_bytes": get_rss(),
+    }
+
+
+async def run_benchmark(
+    scenarios: List[str],
+    requests: int = 1000,
+    concurrency: int = 20,
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    batch_sizes: Optional[List[int]] = None,
+    seed: int = 0,
+) -> Dict[str, Dict[str, float]]:
+    """
+    偽のサーバーを取得先にしてシナリオを順に実行し、シナリオ名から結果への辞書を返す
+    """
+    fake = FakeJMA(latency, jitter, error_rate, seed)
+    fetcher = TileFetcher(
+        timeout=max(1.0, (latency + jitter) * 10),
+        transport=httpx.ASGITransport(app=fake.app),
+    )
+    available = get_scenarios(batch_sizes or [10, 100])
+    original_fetchers = [product.fetcher for product in main.products]
+    original_store = [product.store for product in main.products]
+    for product in main.products:
+        product.fetcher = fetcher
+        product.store = None
+    results = {}
+    try:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app),
+            base_url="http://lwapi",
+            timeout=None,
+        ) as client:
+            for name in scenarios:
+                generate, rollover_every = available[name]
+                results[name] = await run_scenario(
+                    client,
+                    fake,
+                    generate,
+                    rollover_every,
+                    requests,
+                    concurrency,
+                    seed,
+                )
+    finally:
+        await fetcher.aclose()
+        for product, original, store in zip(
+            main.products,
+            original_fetchers,
+            original_store,
+        ):
+            product.fetcher = original
+            product.store = store
+        clear_caches()
+    return results
+
+
+def compare(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+) -> List[str]:
+    """
+    基準の結果と比べて、tolerance を超えて悪化した項目を返す
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p99 {result['p99_ms']:.2f}ms"
+                f" > {base['p99_ms']:.2f}ms"
+            )
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: rps {result['rps']:.1f} < {base['rps']:.1f}"
+            )
+        if result["upstream_fetches"] > base["upstream_fetches"] * (
+            1 + tolerance
+        ):
+            regressions.append(
+                f"{name}: upstream fetches {result['upstream_fetches']}"
+                f" > {base['upstream_fetches']}"
+            )
+    return regressions
+
+
+def format_results(results: Dict[str, Dict[str, float]]) -> str:
+    lines = [
+        f"{'scenario':<20} {'requests':>8} {'fail':>5} {'p50 ms':>8}"
+        f" {'p99 ms':>8} {'rps':>9} {'fetches':>8} {'rss MiB':>8}",
+    ]
+    for name, result in results.items():
+        lines.append(
+            f"{name:<20} {result['requests']:>8} {result['failures']:>5}"
+            f" {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}"
+            f" {result['rps']:>9.1f} {result['upstream_fetches']:>8}"
+            f" {result['rss_bytes'] / 2 ** 20:>8.1f}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--scenarios", default=None,
+                        help="comma separated scenario names (default: all)")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--batch-sizes", default="10,100")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--serve", action="store_true",
+                        help="only serve the fake tiles over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=49134)
+    return parser.parse_args(argv)
+
+
+def run(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.serve:
+        import uvicorn
+        fake = FakeJMA(args.latency, args.jitter, args.error_rate, args.seed)
+        uvicorn.run(fake.app, host=args.host, port=args.port)
+        return 0
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",") if size]
+    scenarios = (
+        args.scenarios.split(",") if args.scenarios
+        else list(get_scenarios(batch_sizes))
+    )
+    results = asyncio.run(run_benchmark(
+        scenarios,
+        requests=args.requests,
+        concurrency=args.concurrency,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        batch_sizes=batch_sizes,
+        seed=args.seed,
+    ))
+    print(format_results(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
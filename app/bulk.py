@@ -0,0 +1,428 @@
+"""
+緯度経度の一覧のファイルに、地点ごとの天気予報と降雨量を付けて出力する
+
+CSV (緯度と経度の列を持つ) か JSON Lines (緯度と経度のキーを持つ) を読み、
+入力の各行に値の列を加えて同じ形式で書き出す。入力は --chunk-size 行ずつ
+読んで処理し、チャンクの中の地点はタイルごとにまとめて、必要なタイルを
+並行して取得する。処理済みの行はチャンクごとに書き出すので、入力の行数に
+よらずメモリの使用量は一定で、進捗と処理速度は標準エラー出力に出す。
+
+    python bulk.py locations.csv -o locations_weather.csv
+    python bulk.py locations.jsonl --products rainfall --precision 500
+    cat locations.csv | python bulk.py - --format csv --lat-column latitude
+
+タイルの取得とキャッシュは API サーバーと同じ設定 (LWAPI_* の環境変数) を使う。
+近い地点が続くように入力を並べておくと、同じタイルをチャンクをまたいで
+キャッシュから使えるので速い。
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import math
+import sys
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import IO
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+import main
+from main import JST
+from main import TileProduct
+from projection import TileCoordinate
+from projection import project
+
+# 入出力の形式
+FORMATS = ("csv", "jsonl")
+
+# Web メルカトルで扱える緯度の上限
+MAX_LATITUDE = 85.0511
+
+Row = Dict[str, Any]
+
+
+def detect_format(path: str) -> str:
+    """
+    ファイル名の拡張子から入出力の形式を返す。分からなければ csv とする
+    """
+    if path.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    return "csv"
+
+
+def read_csv(stream: IO[str]) -> Iterator[Row]:
+    yield from csv.DictReader(stream)
+
+
+def read_jsonl(stream: IO[str]) -> Iterator[Row]:
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+READERS = {"csv": read_csv, "jsonl": read_jsonl}
+
+
+def chunked(rows: Iterable[Row], size: int) -> Iterator[List[Row]]:
+    """
+    行を size 行ずつのリストにまとめて返す
+    """
+    chunk: List[Row] = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_locations(
+    rows: List[Row],
+    lat_column: str,
+    lon_column: str,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    行から緯度と経度の配列を取り出し、有効な行を示す真偽値の配列と合わせて返す。
+    列がない行、数値でない行、タイルで扱えない範囲の行は無効とする
+    """
+    lats = np.full(len(rows), math.nan)
+    lons = np.full(len(rows), math.nan)
+    for i, row in enumerate(rows):
+        try:
+            lats[i] = float(row[lat_column])
+            lons[i] = float(row[lon_column])
+        except (KeyError, TypeError, ValueError):
+            continue
+    # NaN との比較は偽になるので、数値でない行もここで無効になる
+    valid = (
+        (np.abs(lats) <= MAX_LATITUDE)
+        & (lons >= -180.0)
+        & (lons < 180.0)
+    )
+    return lats, lons, valid
+
+
+async def lookup_pixel_values(
+    product: TileProduct,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    zoom: int,
+    now: datetime.datetime,
+) -> Tuple[np.ndarray, np.ndarray, str]:
+    """
+    複数地点のパレット番号と古い値 (stale) かどうかの配列、予報時刻を返す。
+    地点はタイルごとにまとめ、必要なタイルは並行して取得する。
+    get_location_values と違い、地点ごとの結果の辞書を作らない
+    """
+    observation_timestamp, forecast_timestamp = \
+        product.get_current_timestamps(now)
+    positions = project(lats, lons, zoom)
+    tiles, inverse = np.unique(
+        np.stack([positions.tile_x, positions.tile_y], axis=1),
+        axis=0,
+        return_inverse=True,
+    )
+    inverse = inverse.reshape(-1)
+    results = await asyncio.gather(*[
+        product.get_tile(
+            observation_timestamp,
+            forecast_timestamp,
+            TileCoordinate(zoom, tile_x, tile_y),
+        )
+        for tile_x, tile_y in tiles.tolist()
+    ])
+    pixel_values = np.zeros(len(lats), dtype=np.int64)
+    stale = np.zeros(len(lats), dtype=bool)
+    # タイルごとの地点の添字を、並べ替えて区切ることで求める
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.searchsorted(inverse[order], np.arange(len(tiles) + 1))
+    for i, (tile, tile_stale) in enumerate(results):
+        index = order[bounds[i]:bounds[i + 1]]
+        if tile is not None:
+            pixel_values[index] = tile.get_many(
+                positions.pixel_x[index],
+                positions.pixel_y[index],
+            )
+        stale[index] = tile_stale
+    return pixel_values, stale, forecast_timestamp
+
+
+def get_columns(product: TileProduct) -> List[str]:
+    """
+    プロダクトごとに出力に加える列名を返す
+    """
+    return [
+        product.value_key,
+        f"{product.value_key}_forecast_timestamp",
+        f"{product.value_key}_stale",
+    ]
+
+
+async def annotate(
+    rows: List[Row],
+    products: List[TileProduct],
+    lat_column: str = "lat",
+    lon_column: str = "lon",
+    zoom: Optional[int] = None,
+    precision: Optional[float] = None,
+) -> int:
+    """
+    各行にプロダクトごとの値、予報時刻、stale の列を加え、無効な行の数を返す。
+    無効な行の列は None にする
+    """
+    lats, lons, valid = parse_locations(rows, lat_column, lon_column)
+    lats, lons = lats[valid], lons[valid]
+    index = np.flatnonzero(valid).tolist()
+    now = datetime.datetime.now(tz=JST)
+    zooms = [
+        product.select_zoom(zoom, precision, lats.tolist())
+        for product in products
+    ]
+    results = await asyncio.gather(*[
+        lookup_pixel_values(product, lats, lons, product_zoom, now)
+        for product, product_zoom in zip(products, zooms)
+    ]) if index else [None] * len(products)
+    for row in rows:
+        for product in products:
+            row.update(dict.fromkeys(get_columns(product)))
+    for product, result in zip(products, results):
+        if result is None:
+            continue
+        pixel_values, stale, forecast_timestamp = result
+        # 範囲外のパレット番号はパレット番号 0 の値として扱う
+        values = [
+            product.values.get(i, product.values[0]) for i in range(256)
+        ]
+        value_key, timestamp_key, stale_key = get_columns(product)
+        for i, pixel_value, row_stale in zip(
+            index,
+            pixel_values.tolist(),
+            stale.tolist(),
+        ):
+            rows[i][value_key] = values[pixel_value]
+            rows[i][timestamp_key] = forecast_timestamp
+            rows[i][stale_key] = row_stale
+    return len(rows) - len(index)
+
+
+class CsvWriter:
+    """
+    行を CSV で書き出す。列は最初の行で決める
+    """
+    def __init__(self, stream: IO[str]):
+        self.stream = stream
+        self.writer: Optional[csv.DictWriter] = None
+
+    def write(self, rows: List[Row]):
+        if not rows:
+            return
+        if self.writer is None:
+            self.writer = csv.DictWriter(
+                self.stream,
+                fieldnames=list(rows[0]),
+                extrasaction="ignore",
+            )
+            self.writer.writeheader()
+        self.writer.writerows(rows)
+        self.stream.flush()
+
+
+class JsonlWriter:
+    """
+    行を 1 行 1 つの JSON オブジェクトで書き出す
+    """
+    def __init__(self, stream: IO[str]):
+        self.stream = stream
+
+    def write(self, rows: List[Row]):
+        self.stream.writelines(
+            json.dumps(row, ensure_ascii=False) + "\n" for row in rows
+        )
+        self.stream.flush()
+
+
+WRITERS = {"csv": CsvWriter, "jsonl": JsonlWriter}
+
+
+class Progress:
+    """
+    処理した行数と処理速度を interval 秒ごとに stream に出力する
+    """
+    def __init__(
+        self,
+        stream: Optional[IO[str]],
+        interval: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.stream = stream
+        self.interval = interval
+        self.clock = clock
+        self.started = self.reported = clock()
+        self.rows = 0
+        self.invalid = 0
+
+    def update(self, rows: int, invalid: int):
+        self.rows += rows
+        self.invalid += invalid
+        if self.clock() - self.reported >= self.interval:
+            self.report()
+
+    def get_upstream_fetches(self) -> int:
+        return int(sum(main.upstream_fetches.values.values()))
+
+    def report(self, done: bool = False):
+        now = self.reported = self.clock()
+        if self.stream is None:
+            return
+        elapsed = now - self.started
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        print(
+            f"{'done' if done else 'progress'}: {self.rows} rows"
+            f" ({self.invalid} invalid) in {elapsed:.1f}s,"
+            f" {rate:.0f} rows/s,"
+            f" {self.get_upstream_fetches()} upstream fetches",
+            file=self.stream,
+            flush=True,
+        )
+
+
+async def annotate_stream(
+    rows: Iterable[Row],
+    write: Callable[[List[Row]], None],
+    products: List[TileProduct],
+    chunk_size: int = 10000,
+    lat_column: str = "lat",
+    lon_column: str = "lon",
+    zoom: Optional[int] = None,
+    precision: Optional[float] = None,
+    progress: Optional[Progress] = None,
+):
+    """
+    行をチャンクごとに処理して書き出す
+    """
+    for chunk in chunked(rows, chunk_size):
+        invalid = await annotate(
+            chunk,
+            products,
+            lat_column,
+            lon_column,
+            zoom,
+            precision,
+        )
+        write(chunk)
+        if progress is not None:
+            progress.update(len(chunk), invalid)
+
+
+async def run_bulk(args: argparse.Namespace) -> int:
+    products = [
+        {
+            "weather": main.location_weather,
+            "rainfall": main.location_rainfall,
+        }[name]
+        for name in args.products
+    ]
+    try:
+        for product in products:
+            product.select_zoom(args.zoom, args.precision)
+    except ValueError as e:
+        print(f"bulk.py: {e}", file=sys.stderr)
+        return 2
+    input_format = args.format or detect_format(args.input)
+    output_format = args.output_format or (
+        detect_format(args.output) if args.output != "-" else input_format
+    )
+    input_stream = (
+        sys.stdin if args.input == "-"
+        else open(args.input, newline="", encoding="utf-8")
+    )
+    output_stream = (
+        sys.stdout if args.output == "-"
+        else open(args.output, "w", newline="", encoding="utf-8")
+    )
+    progress = Progress(
+        None if args.quiet else sys.stderr,
+        args.progress_interval,
+    )
+    try:
+        await annotate_stream(
+            READERS[input_format](input_stream),
+            WRITERS[output_format](output_stream).write,
+            products,
+            args.chunk_size,
+            args.lat_column,
+            args.lon_column,
+            args.zoom,
+            args.precision,
+            progress,
+        )
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+        await main.close_tile_fetcher()
+    progress.report(done=True)
+    return 0
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "input",
+        help="input file (CSV or JSON Lines, - for stdin)",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        default="-",
+        help="output file (default: stdout)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        help="input format (default: from the file extension)",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=FORMATS,
+        help="output format (default: same as the input)",
+    )
+    parser.add_argument(
+        "--products",
+        nargs="+",
+        choices=["weather", "rainfall"],
+        default=["weather", "rainfall"],
+    )
+    parser.add_argument("--lat-column", default="lat")
+    parser.add_argument("--lon-column", default="lon")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--zoom", type=int)
+    parser.add_argument(
+        "--precision",
+        type=float,
+        help="maximum pixel width in meters, used to select the zoom level",
+    )
+    parser.add_argument("--progress-interval", type=float, default=5.0)
+    parser.add_argument("-q", "--quiet", action="store_true")
+    args = parser.parse_args(argv)
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size must be positive")
+    return args
+
+
+def run(argv: Optional[List[str]] = None) -> int:
+    return asyncio.run(run_bulk(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,237 @@
+import datetime
+from datetime import timedelta
+from datetime import timezone
+import mmap
+import os
+from pathlib import Path
+import struct
+import threading
+import time
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Tuple
+from typing import Union
+
+from fastapi.logger import logger
+
+from pixel_tile import PixelTile
+
+# レコードのヘッダ: マジックナンバー, 観測時刻, 予報時刻, 幅, 高さ, 詰めて保持しているか
+RECORD = struct.Struct("<4s14s14sHHB3x")
+MAGIC = b"LWFA"
+
+
+class ArchivedFrame(NamedTuple):
+    """
+    アーカイブから読んだ 1 フレーム分のピクセルの値
+    """
+    observation_timestamp: str
+    forecast_timestamp: str
+    pixel_value: int
+
+
+class FrameArchive:
+    """
+    現在の予報時刻のタイルを、次の予報時刻に置き換えられた後も参照できるように
+    ディスクに追記していくアーカイブ
+
+    タイルは {root}/{product}/{zoom}/{x}/{y}/{予報時刻 (UTC) の日付}.bin に、
+    ヘッダと PixelTile のバイト列 (パレット番号を詰めたもの) を 1 レコードとして
+    追記する。読み込みではファイルをメモリマップし、各レコードのヘッダと
+    1 ピクセル分のバイトだけを読むので、タイル全体はデコードしない。
+    書き込み途中で終わった末尾のレコードは読み飛ばす。
+    """
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.lock = threading.Lock()
+        # タイルごとに直前に追記した (観測時刻, 予報時刻)
+        self.latest: Dict[Tuple[str, int, int, int], Tuple[str, str]] = {}
+
+    def get_path(
+        self,
+        product: str,
+        zoom: int,
+        tile_x: int,
+        tile_y: int,
+        day: str,
+    ) -> Path:
+        return (
+            self.root
+            / product
+            / str(zoom)
+            / str(tile_x)
+            / str(tile_y)
+            / f"{day}.bin"
+        )
+
+    def append(
+        self,
+        product: str,
+        zoom: int,
+        tile_x: int,
+        tile_y: int,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        tile: PixelTile,
+    ) -> bool:
+        """
+        タイルを追記する。同じタイルの同じ時刻を直前に追記していれば何もせず、
+        追記したかどうかを返す
+        """
+        key = (product, zoom, tile_x, tile_y)
+        timestamps = (observation_timestamp, forecast_timestamp)
+        header = RECORD.pack(
+            MAGIC,
+            observation_timestamp.encode(),
+            forecast_timestamp.encode(),
+            tile.width,
+            tile.height,
+            tile.packed,
+        )
+        path = self.get_path(
+            product,
+            zoom,
+            tile_x,
+            tile_y,
+            forecast_timestamp[:8],
+        )
+        with self.lock:
+            if self.latest.get(key) == timestamps:
+                return False
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "ab") as f:
+                f.write(header + bytes(tile.data))
+            self.latest[key] = timestamps
+        return True
+
+    def read_pixels(
+        self,
+        product: str,
+        zoom: int,
+        tile_x: int,
+        tile_y: int,
+        pixel_x: int,
+        pixel_y: int,
+        start: str,
+        end: str,
+    ) -> List[ArchivedFrame]:
+        """
+        予報時刻が start 以上 end 以下 (UTC の YYYYMMDDHHMMSS) のフレームの、
+        ピクセル座標のパレット番号を予報時刻の順に返す。同じ時刻のフレームが
+        複数あれば後に追記したものを使う
+        """
+        frames: Dict[Tuple[str, str], int] = {}
+        day = datetime.datetime.strptime(start[:8], "%Y%m%d")
+        last_day = datetime.datetime.strptime(end[:8], "%Y%m%d")
+        while day <= last_day:
+            path = self.get_path(
+                product,
+                zoom,
+                tile_x,
+                tile_y,
+                day.strftime("%Y%m%d"),
+            )
+            day += timedelta(days=1)
+            try:
+                with open(path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        continue
+                    with mmap.mmap(
+                        f.fileno(),
+                        0,
+                        access=mmap.ACCESS_READ,
+                    ) as buffer:
+                        self._read_pixels(
+                            path,
+                            buffer,
+                            pixel_x,
+                            pixel_y,
+                            start,
+                            end,
+                            frames,
+                        )
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError):
+                logger.exception(f"failed to read frames from {path}")
+        return [
+            ArchivedFrame(observation_timestamp, forecast_timestamp, value)
+            for (forecast_timestamp, observation_timestamp), value
+            in sorted(frames.items())
+        ]
+
+    @staticmethod
+    def _read_pixels(
+        path: Path,
+        buffer: mmap.mmap,
+        pixel_x: int,
+        pixel_y: int,
+        start: str,
+        end: str,
+        frames: Dict[Tuple[str, str], int],
+    ):
+        offset = 0
+        while offset + RECORD.size <= len(buffer):
+            (
+                magic,
+                observation_timestamp,
+                forecast_timestamp,
+                width,
+                height,
+                packed,
+            ) = RECORD.unpack_from(buffer, offset)
+            if magic != MAGIC:
+                logger.warning(f"unexpected frame record in {path}")
+                return
+            data_offset = offset + RECORD.size
+            size = width * height // 2 if packed else width * height
+            if data_offset + size > len(buffer):
+                return
+            offset = data_offset + size
+            forecast_timestamp = forecast_timestamp.decode()
+            if not (
+                start <= forecast_timestamp <= end
+                and 0 <= pixel_x < width
+                and 0 <= pixel_y < height
+            ):
+                continue
+            # PixelTile.get と同じ並びで、該当するバイトだけを読む
+            index = pixel_y * width + pixel_x
+            if packed:
+                value = buffer[data_offset + (index >> 1)]
+                value = value & 0x0F if pixel_x & 1 else value >> 4
+            else:
+                value = buffer[data_offset + index]
+            frames[(forecast_timestamp, observation_timestamp.decode())] = \
+                value
+
+    def prune(self, max_age: float) -> int:
+        """
+        予報時刻の日付が max_age 秒より前に終わったファイルと空のディレクトリを
+        削除し、削除したファイル数を返す
+        """
+        deadline = datetime.datetime.fromtimestamp(
+            time.time() - max_age,
+            tz=timezone.utc,
+        ).replace(tzinfo=None)
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.root, topdown=False):
+            for filename in filenames:
+                try:
+                    day = datetime.datetime.strptime(filename, "%Y%m%d.bin")
+                except ValueError:
+                    continue
+                if day + timedelta(days=1) > deadline:
+                    continue
+                try:
+                    os.unlink(os.path.join(dirpath, filename))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+            if dirpath != str(self.root):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+        return removed
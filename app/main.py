@@ -1,22 +1,144 @@
+import asyncio
 from enum import Enum
+from functools import lru_cache
+import hashlib
 import datetime
 from datetime import timedelta
 from datetime import timezone
 from io import BytesIO
+import json
 import math
+import os
+from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import List
 from typing import Optional
+from typing import Sequence
+from typing import Set
 from typing import Tuple
 from typing import Union
 
 from fastapi import FastAPI
+from fastapi import Header
+from fastapi import HTTPException
+from fastapi import Query
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.logger import logger
+from fastapi.responses import PlainTextResponse
+from fastapi.responses import StreamingResponse
+import numpy as np
 from PIL import Image
-from PIL.Image import Image as PILImage
 from pydantic import BaseModel
-import requests
+
+from frame_archive import FrameArchive
+from metrics import CallbackMetric
+from metrics import Counter
+from metrics import Gauge
+from metrics import Histogram
+from metrics import Registry
+from metrics import RequestMetricsMiddleware
+from pixel_tile import PixelTile
+from png_scanline import read_pixel
+from prefetcher import JAPAN_BBOX
+from prefetcher import TilePrefetcher
+from projection import TileCoordinate
+from projection import pixel_center
+from projection import project
+from projection import tile_windows_in_bbox
+from projection import zoom_for_precision
+from readiness import Readiness
+from single_flight import SingleFlight
+from subscription import LocationSubscription
+from tile_cache import TileCache
+from tile_decoder import TileDecoder
+from tile_fetcher import TileFetcher
+from tile_fetcher import TileNotFound
+from tile_store import DiskTileStore
+from tile_store import TileKey
+from tile_store import TileStore
+from tile_store import locked
+from watch_list import WatchList
 
 JST = timezone(timedelta(hours=+9), 'JST')
+# 切り替わりの前に先読みした次の予報時刻のタイルをキャッシュするときの step
+NEXT_FRAME_STEP = -1
+
+
+@lru_cache(maxsize=8)
+def _format_now(now: datetime.datetime) -> Tuple[str, str]:
+    return (
+        now.strftime("%Y/%m/%d %H:%M:%S"),
+        (now - timedelta(hours=9)).strftime("%Y/%m/%d %H:%M:%S"),
+    )
+
+
+def format_now(now: datetime.datetime) -> Tuple[str, str]:
+    """
+    レスポンスの now と utc の文字列を返す。同じ秒の間は同じ文字列を使い回す
+    """
+    return _format_now(now.replace(microsecond=0))
+
+
+metrics_registry = Registry()
+upstream_fetch_seconds = metrics_registry.register(Histogram(
+    "lwapi_upstream_fetch_seconds",
+    "Time spent downloading a tile image from JMA.",
+    ["product"],
+))
+upstream_fetches = metrics_registry.register(Counter(
+    "lwapi_upstream_fetches_total",
+    "Tile image downloads from JMA by result.",
+    ["product", "result"],
+))
+upstream_fetches_in_flight = metrics_registry.register(Gauge(
+    "lwapi_upstream_fetches_in_flight",
+    "Tile image downloads from JMA in progress.",
+    ["product"],
+))
+tile_decode_seconds = metrics_registry.register(Histogram(
+    "lwapi_tile_decode_seconds",
+    "Time spent decoding a downloaded tile image.",
+    ["product"],
+))
+tile_scanline_lookups = metrics_registry.register(Counter(
+    "lwapi_tile_scanline_lookups_total",
+    "Single location lookups answered by decoding only the needed scanline.",
+    ["product"],
+))
+tile_decodes_skipped = metrics_registry.register(Counter(
+    "lwapi_tile_decodes_skipped_total",
+    "Downloaded tile images reused without decoding by content hash.",
+    ["product"],
+))
+archived_frames = metrics_registry.register(Counter(
+    "lwapi_archived_frames_total",
+    "Tiles of the current forecast timestamp appended to the frame archive.",
+    ["product"],
+))
+projection_seconds = metrics_registry.register(Histogram(
+    "lwapi_projection_seconds",
+    "Time spent projecting locations to tile coordinates per request.",
+    ["product"],
+))
+lookup_seconds = metrics_registry.register(Histogram(
+    "lwapi_lookup_seconds",
+    "Time spent looking up pixel values per request.",
+    ["product"],
+))
+
+
+def decode_tile(content: bytes) -> PixelTile:
+    """
+    画像をデコードし、ピクセル値だけを保持する PixelTile に変換する。
+    パレット画像でなければ、値を持たない (すべて 0 の) タイルとして扱う。
+    TileDecoder のスレッドで呼ぶ
+    """
+    with Image.open(BytesIO(content)) as image:
+        if image.mode != "P":
+            return PixelTile.blank(image.width, image.height)
+        return PixelTile.from_image(image)
 
 
 class Location(BaseModel):
@@ -54,320 +176,1825 @@ class TilePosition(BaseModel):
         self.pixel_x = int((self.x - self.tile_x) * 256)
         self.pixel_y = int((self.y - self.tile_y) * 256)
 
+    @classmethod
+    def from_locations(
+        cls,
+        locations: List[Location],
+        zoom: int = 5,
+    ) -> List["TilePosition"]:
+        """
+        複数の緯度経度をまとめて変換する。座標変換は配列でまとめて行い、
+        バリデーションも省略するので、地点数が多い場合に速い
+        """
+        positions = project(
+            [location.lat for location in locations],
+            [location.lon for location in locations],
+            zoom,
+        )
+        return [
+            cls.construct(
+                location=location,
+                zoom=zoom,
+                x=x,
+                y=y,
+                tile_x=tile_x,
+                tile_y=tile_y,
+                pixel_x=pixel_x,
+                pixel_y=pixel_y,
+            )
+            for location, x, y, tile_x, tile_y, pixel_x, pixel_y in zip(
+                locations,
+                positions.x.tolist(),
+                positions.y.tolist(),
+                positions.tile_x.tolist(),
+                positions.tile_y.tolist(),
+                positions.pixel_x.tolist(),
+                positions.pixel_y.tolist(),
+            )
+        ]
 
-"""
-画像キャッシュの型定義
 
-{
-    (タイル座標 x, タイル座標 y): {
-        "timestamp": タイムスタンプ (str),
-        "image": 画像オブジェクト (PIL.Image),
-    },
-}
-"""
-ImageCache = Dict[
-    Tuple[int, int], Dict[
-        str, Union[str, PILImage],
-    ],
-]
+class TileProduct:
+    """
+    気象庁のタイル画像の取得とキャッシュ、それを使った地点の値の取得を提供する
 
+    プロダクトごとの違いは、サブクラスのクラス属性と get_timestamps,
+    get_next_update で宣言する。
 
-class LocationWeatherForecast:
-    """
-    気象庁からの天気予報画像の取得とキャッシュ、それを使った地点天気予報を提供する
+    * name: URL のデータ種別 (wdist, nowc など)
+    * element: URL の要素名 (wm, hrpns など)
+    * zoom: 使う画像の zoom レベル (リクエストで指定がなければこれを使う)
+    * min_zoom, max_zoom: リクエストで指定できる zoom レベルの範囲
+    * cache_ttl: 画像の更新間隔 (秒)
+    * value_key: レスポンスで値を格納するキー
+    * values: パレット番号から値への対応
+    * frame_interval: 時系列で使う予報時刻の間隔
+    * series_steps: 時系列で返す予報時刻の数 (現在の予報時刻を含む)
     """
-    def __init__(self):
-        self.cache: ImageCache = {}
+    base_url = "https://www.jma.go.jp/bosai/jmatile/data"
+    name: str
+    element: str
+    zoom: int
+    min_zoom: int
+    max_zoom: int
+    cache_ttl: float
+    value_key: str
+    values: Dict[int, Union[str, int]]
+    frame_interval: timedelta
+    series_steps: int
+    # 取得に失敗したタイルをキャッシュする秒数と、再取得の間隔 (秒)
+    failure_ttl = 30.0
+    retry_interval = 5.0
+    max_retry_interval = 60.0
+    # 同時に再取得を試みるタイルの数の上限
+    max_retries = 256
+    # 次の予報時刻の画像を切り替わりの何秒前に先読みするか。0 なら切り替わりの
+    # 後に取得する (切り替わりより前に画像が公開されないプロダクト)
+    prefetch_lead = 0.0
+    # 範囲集計で一度に扱うタイル数の上限
+    max_area_tiles = 256
+    # 内容のハッシュごとに保持するデコード済みタイルの数
+    max_decoded_tiles = 256
+    # アーカイブから一度に問い合わせられる期間
+    max_history_range = timedelta(days=7)
+    # 続けてこの回数だけ一時的な障害で取得に失敗したら、気象庁に異常があるとみなす
+    max_fetch_failures = 5
+
+    def __init__(
+        self,
+        fetcher: Optional[TileFetcher] = None,
+        cache: Optional[TileCache] = None,
+        store: Optional[TileStore] = None,
+        decoder: Optional[TileDecoder] = None,
+        archive: Optional[FrameArchive] = None,
+    ):
+        self.cache = cache if cache is not None else TileCache(
+            ttl=self.cache_ttl,
+        )
+        self.fetcher = fetcher or TileFetcher()
+        self.store = store
+        self.decoder = decoder or TileDecoder()
+        self.archive = archive
+        # 気象庁から最後に取得に成功した時刻と、その後に続けて一時的な障害
+        # (タイムアウト、接続エラー、5xx など) で失敗した回数。提供範囲外の
+        # 座標などで画像が存在しない (404 など) のは気象庁の異常ではないので数えない
+        self.last_fetch_success: Optional[datetime.datetime] = None
+        self.fetch_failures = 0
+        self.archive_tasks: Set[asyncio.Task] = set()
+        # ダウンロードした画像の内容を待っている 1 地点の問い合わせ (URL ごと)
+        self.content_waiters: Dict[str, Set[asyncio.Future]] = {}
+        self.background_tiles: Set[asyncio.Task] = set()
+        self.downloads = SingleFlight()
+        self.decoded_tiles = TileCache(max_entries=self.max_decoded_tiles)
+        self.watches = WatchList()
+        self.tile_listeners: Set[Callable] = set()
+        self._timestamps: Optional[
+            Tuple[datetime.datetime, Tuple[str, str]]
+        ] = None
+        # 直近にリクエストされたタイル座標。先読みする TilePrefetcher が
+        # 動いている間だけ記録し、その TilePrefetcher が更新ごとに空にする
+        self.record_requested_tiles = False
+        self.requested_tiles: Set[Tuple[int, int]] = set()
+        self.retries: Dict[Tuple[Tuple[int, int], str], asyncio.Task] = {}
 
     @staticmethod
     def get_timestamps(now: datetime.datetime) -> Tuple[str, str]:
         """
-        与えられた datetime.datetime を使って、wdist の URL を構築するのに必要な、
-        観測時刻と予報時刻を生成して返す。生成ルールは以下の通り。
-
-        1. 現在時刻 (JST) が 00, 01, 02 時なら 00 時に丸める
-        2. 現在時刻 (JST) が 03, 04, 05 時なら 03 時に丸める
-        3. 現在時刻 (JST) が 06, 07, 08 時なら 06 時に丸める
-        4. 他も同様
-        5. 現在時刻が 06 時 (JST) 以前なら前日の 17:00 (JST) = 前日の 08:00 (UTC)
-        6. 現在時刻が 12 時 (JST) 以前なら当日の 05:00 (JST) = 前日の 20:00 (UTC)
-        7. 現在時刻が 18 時 (JST) 以前なら当日の 11:00 (JST) = 当日の 02:00 (UTC)
-        8. 現在時刻が 19 時 (JST) 以降なら当日の 17:00 (JST) = 当日の 08:00 (UTC)
-        9. 現在時刻の UTC を取得し、予報時刻とする
+        与えられた datetime.datetime から観測時刻と予報時刻を生成して返す
         """
-        forecast_hour = [
-            0, 0, 0,
-            3, 3, 3,
-            6, 6, 6,
-            9, 9, 9,
-            12, 12, 12,
-            15, 15, 15,
-            18, 18, 18,
-            21, 21, 21,
-        ][now.hour]
-        if forecast_hour <= 6:
-            observation_date = (now - timedelta(days=1)).date()
-            observation_timestamp = \
-                observation_date.strftime("%Y%m%d080000")
-        elif forecast_hour <= 12:
-            observation_date = (now - timedelta(days=1)).date()
-            observation_timestamp = \
-                observation_date.strftime("%Y%m%d200000")
-        elif forecast_hour <= 18:
-            observation_date = now.date()
-            observation_timestamp = \
-                observation_date.strftime("%Y%m%d020000")
-        else:
-            observation_date = now.date()
-            observation_timestamp = \
-                observation_date.strftime("%Y%m%d080000")
-        forecast_datetime = datetime.datetime(
-            now.year,
-            now.month,
-            now.day,
-            forecast_hour,
-            0,
-        )
-        forecast_datetime_utc = forecast_datetime - timedelta(hours=9)
-        forecast_timestamp = forecast_datetime_utc.strftime("%Y%m%d%H%M%S")
-        return observation_timestamp, forecast_timestamp
+        raise NotImplementedError
 
     @staticmethod
-    def get_weather_forecast_image_url(
+    def get_next_update(now: datetime.datetime) -> datetime.datetime:
+        """
+        与えられた datetime.datetime の次に予報時刻が切り替わる時刻を返す
+        """
+        raise NotImplementedError
+
+    def get_current_timestamps(
+        self,
+        now: datetime.datetime,
+    ) -> Tuple[str, str]:
+        """
+        get_timestamps の結果を返す。時刻は分単位でしか使わないので、
+        同じ分の間は前回の結果を使い回す
+        """
+        minute = now.replace(second=0, microsecond=0)
+        if self._timestamps is None or self._timestamps[0] != minute:
+            self._timestamps = (minute, self.get_timestamps(now))
+        return self._timestamps[1]
+
+    def get_max_age(self, now: datetime.datetime) -> int:
+        """
+        与えられた datetime.datetime から予報時刻が切り替わるまでの秒数
+        (切り上げ) を返す。その間は同じ地点の値は変わらない
+        """
+        return math.ceil((self.get_next_update(now) - now).total_seconds())
+
+    def get_etag(
+        self,
         observation_timestamp: str,
         forecast_timestamp: str,
         tile_position: TilePosition,
     ) -> str:
         """
-        観測時刻と予報時刻、タイル座標から天気予報画像 URL を生成する
+        地点の値のレスポンスの ETag を返す。同じ観測時刻と予報時刻の同じピクセルなら
+        値は変わらないので、それらから作る。now と utc は変わるので弱い ETag にする
         """
-        tail_part = "{}/none/{}/surf/wm/{}/{}/{}.png".format(
+        return 'W/"{}-{}-{}-{}-{}-{}-{}-{}"'.format(
+            self.name,
             observation_timestamp,
             forecast_timestamp,
             tile_position.zoom,
             tile_position.tile_x,
             tile_position.tile_y,
+            tile_position.pixel_x,
+            tile_position.pixel_y,
         )
-        return f"https://www.jma.go.jp/bosai/jmatile/data/wdist/{tail_part}"
 
-    @staticmethod
-    def download_image(url) -> PILImage:
+    @classmethod
+    def get_frame_timestamps(
+        cls,
+        now: datetime.datetime,
+        steps: int,
+    ) -> List[Tuple[str, str]]:
         """
-        画像を PIL.Image としてダウンロードする
+        与えられた datetime.datetime から、現在の予報時刻と、そこから
+        frame_interval ごとの steps 個の観測時刻と予報時刻の組を返す。
+        観測時刻はすべて同じ
         """
-        image = None
-        try:
-            response = requests.get(url, timeout=1)
-            if response.status_code == 200:
-                image = Image.open(BytesIO(response.content))
-                logger.info(f"successful image download from {url}")
-            else:
-                logger.warning(
-                    f"unexpected response {response.status_code} from {url}"
-                )
-        except:
-            logger.exception(f"failed to download image from {url}")
-        return image
+        observation_timestamp, forecast_timestamp = cls.get_timestamps(now)
+        forecast_datetime = datetime.datetime.strptime(
+            forecast_timestamp,
+            "%Y%m%d%H%M%S",
+        )
+        return [
+            (
+                observation_timestamp,
+                (forecast_datetime + cls.frame_interval * step).strftime(
+                    "%Y%m%d%H%M%S",
+                ),
+            )
+            for step in range(steps)
+        ]
 
-    def get_location_weather_forecast(
+    def select_zoom(
         self,
-        location: Location,
-    ) -> Dict[str, Union[str, Location, TilePosition]]:
+        zoom: Optional[int] = None,
+        precision: Optional[float] = None,
+        lats: Sequence[float] = (),
+    ) -> int:
         """
-        気象庁の天気予報画像を用いて、緯度経度からその地点の天気予報を返す
+        リクエストで指定された zoom レベルか、精度 (1 ピクセルの幅の上限、メートル)
+        から使う zoom レベルを返す。精度からは、緯度 lats のすべての地点で精度を
+        満たす最も粗い zoom レベルを選ぶ。どちらも指定がなければ zoom を返す。
+        範囲外の zoom レベルや正でない精度は ValueError にする
         """
-        tile_position = TilePosition(location=location)
-        now = datetime.datetime.now(tz=JST)
-        observation_timestamp, forecast_timestamp = self.get_timestamps(now)
-        image_url = self.get_weather_forecast_image_url(
+        if zoom is not None:
+            if not self.min_zoom <= zoom <= self.max_zoom:
+                raise ValueError(
+                    f"zoom must be between {self.min_zoom}"
+                    f" and {self.max_zoom}"
+                )
+            return zoom
+        if precision is not None:
+            if precision <= 0:
+                raise ValueError("precision must be positive")
+            return zoom_for_precision(
+                precision,
+                lats,
+                self.min_zoom,
+                self.max_zoom,
+            )
+        return self.zoom
+
+    @classmethod
+    def get_image_url(
+        cls,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        tile_position: Union[TilePosition, TileCoordinate],
+    ) -> str:
+        """
+        観測時刻と予報時刻、タイル座標から画像 URL を生成する
+        """
+        return "{}/{}/{}/none/{}/surf/{}/{}/{}/{}.png".format(
+            cls.base_url,
+            cls.name,
             observation_timestamp,
             forecast_timestamp,
-            tile_position,
+            cls.element,
+            tile_position.zoom,
+            tile_position.tile_x,
+            tile_position.tile_y,
         )
-        cache_key = (tile_position.tile_x, tile_position.tile_y)
-        if (
-            cache_key not in self.cache
-            or
-            self.cache[cache_key]["timestamp"] < forecast_timestamp
-        ):
-            logger.info("cache not found. try to download new image...")
-            self.cache[cache_key] = {}
-            self.cache[cache_key]["image"] = self.download_image(image_url)
-            self.cache[cache_key]["timestamp"] = forecast_timestamp
-        else:
-            logger.info("cache found. use cache.")
-        forecast_image = self.cache[cache_key]["image"]
-        if forecast_image and forecast_image.mode == "P":
-            pixel_value = forecast_image.getpixel((
-                tile_position.pixel_x,
-                tile_position.pixel_y,
-            ))
-        else:
-            pixel_value = 0
-        weather = {
-            0: "unkown",
-            1: "sunny",
-            2: "cloudy",
-            3: "rainy",
-            4: "sleet",
-            5: "snow",
-        }[pixel_value]
-        return {
-            "weather": weather,
-            "location": location,
-            "tile_position": tile_position,
-            "now": now.strftime("%Y/%m/%d %H:%M:%S"),
-            "utc": (now - timedelta(hours=9)).strftime("%Y/%m/%d %H:%M:%S"),
-            "observation_timestamp": observation_timestamp,
-            "forecast_timestamp": forecast_timestamp,
-            "image_url": image_url,
-        }
 
+    async def download_content(self, url: str) -> Optional[bytes]:
+        """
+        画像の内容をダウンロードする
+        """
+        labels = (self.name,)
+        upstream_fetches_in_flight.inc(labels)
+        try:
+            with upstream_fetch_seconds.time(labels):
+                content = await self.fetcher.fetch(url)
+        except TileNotFound:
+            upstream_fetches.inc((self.name, "not_found"))
+            raise
+        finally:
+            upstream_fetches_in_flight.dec(labels)
+        if content is None:
+            upstream_fetches.inc((self.name, "failure"))
+            self.fetch_failures += 1
+            return None
+        upstream_fetches.inc((self.name, "success"))
+        self.last_fetch_success = datetime.datetime.now(tz=JST)
+        self.fetch_failures = 0
+        for waiter in self.content_waiters.pop(url, ()):
+            if not waiter.done():
+                waiter.set_result(content)
+        return content
 
-class LocationRainfall:
-    """
-    気象庁からの降雨画像の取得とキャッシュ、それを使った地点降雨量を提供する
-    """
-    def __init__(self):
-        self.cache: ImageCache = {}
+    async def download_tile(self, url: str) -> Optional[PixelTile]:
+        """
+        画像をダウンロードし、ピクセル値だけを保持する PixelTile に変換する。
+        パレット画像でなければ、値を持たない (すべて 0 の) タイルとして扱う
+        """
+        content = await self.download_content(url)
+        if content is None:
+            return None
+        # 同じ内容の画像 (変更がなかったものや、同じ内容で再発行されたもの) は
+        # デコードも PixelTile への変換もし直さずに使い回す
+        labels = (self.name,)
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        entry = self.decoded_tiles.get(digest)
+        if entry is not None:
+            tile_decodes_skipped.inc(labels)
+            return entry.value
+        try:
+            with tile_decode_seconds.time(labels):
+                tile = await self.decoder.run(decode_tile, content)
+        except Exception:
+            logger.exception(f"failed to decode image from {url}")
+            return None
+        self.decoded_tiles.set(digest, tile, "")
+        return tile
 
-    @staticmethod
-    def get_timestamps(now: datetime.datetime) -> Tuple[str, str]:
+    async def get_tile(
+        self,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        tile_position: Union[TilePosition, TileCoordinate],
+        retry_failed: bool = False,
+        step: int = 0,
+    ) -> Tuple[Optional[PixelTile], bool]:
         """
-        与えられた datetime.datetime nowc の URL を構築するのに必要な、
-        観測時刻と予報時刻を生成して返す。生成ルールは以下の通り。
+        タイル座標の画像をキャッシュから返す。キャッシュになければダウンロードする。
+        retry_failed が真なら、ダウンロードに失敗したキャッシュは使わずに再度ダウンロードする。
+        step は現在の予報時刻から何番目の予報時刻かで、予報時刻ごとに別々にキャッシュする。
+        zoom レベルごとにも別々にキャッシュし、1 つ細かい zoom レベルの 4 枚のタイルが
+        キャッシュにあれば、ダウンロードせずにそれらを縮小して使う。
+        切り替わりの前に先読みした次の予報時刻のタイルがあれば、それを使う。
 
-        現在時刻 (JST) の分を 5 の倍数に丸め、秒以降を 0 にして UTC に変換したものを
-        観測時刻と予報時刻とする
-        （例：2021/08/01 12:07:21 (JST) -> 2021/08/01 03:05:00 (UTC)）
+        ダウンロードに失敗した場合は、1 つ粗い zoom レベルのタイルがキャッシュにあれば
+        それを拡大したものを、なければ前回取得できた画像を古いもの (stale) として返し、
+        バックグラウンドで再取得を試みる。失敗は failure_ttl 秒だけキャッシュする。
+        気象庁の提供範囲外などで画像が存在しなければ (404)、再取得はせず、
+        予報時刻が変わるまで値のないタイル (None) としてキャッシュする。
+        戻り値は画像と、それが古いものかどうかの組
         """
-        round_minute = 5 * int(now.minute / 5)
-        round_now = datetime.datetime(
-            now.year,
-            now.month,
-            now.day,
-            now.hour,
-            round_minute,
-            0,
+        zoom, tile_x, tile_y = (
+            tile_position.zoom,
+            tile_position.tile_x,
+            tile_position.tile_y,
         )
-        utc = round_now - timedelta(hours=9)
-        timestamp = utc.strftime("%Y%m%d%H%M%S")
-        return timestamp, timestamp
+        cache_key = (zoom, tile_x, tile_y, step)
+        previous_entry = self.cache.peek(cache_key)
+        cache_entry = self.cache.get(cache_key, forecast_timestamp)
+        if cache_entry is not None and not (
+            retry_failed and cache_entry.stale
+        ):
+            logger.debug("cache found. use cache.")
+            return cache_entry.value, cache_entry.stale
+        if step == 0:
+            tile = self.peek_tile(
+                (zoom, tile_x, tile_y, NEXT_FRAME_STEP),
+                forecast_timestamp,
+            )
+            if tile is not None:
+                logger.debug("prefetched tile found. use it.")
+                self.cache.pop((zoom, tile_x, tile_y, NEXT_FRAME_STEP))
+                self.put_tile(
+                    tile_position,
+                    step,
+                    tile,
+                    observation_timestamp,
+                    forecast_timestamp,
+                )
+                return tile, False
+        children = [
+            self.peek_tile(
+                (zoom + 1, tile_x * 2 + dx, tile_y * 2 + dy, step),
+                forecast_timestamp,
+            )
+            for dy in (0, 1)
+            for dx in (0, 1)
+        ]
+        if all(child is not None for child in children):
+            logger.debug("cache found at finer zoom. downsample it.")
+            tile = PixelTile.downsample(children)
+            self.put_tile(
+                tile_position,
+                step,
+                tile,
+                observation_timestamp,
+                forecast_timestamp,
+            )
+            return tile, False
+        logger.debug("cache not found. try to download new image...")
+        try:
+            tile = await self.downloads.do(
+                (cache_key, forecast_timestamp),
+                self.load_and_put_tile,
+                observation_timestamp,
+                forecast_timestamp,
+                tile_position,
+                step,
+            )
+        except TileNotFound:
+            self.put_missing_tile(
+                tile_position,
+                step,
+                observation_timestamp,
+                forecast_timestamp,
+            )
+            return None, False
+        if tile is not None:
+            return tile, False
+        parent = self.peek_tile(
+            (zoom - 1, tile_x // 2, tile_y // 2, step),
+            forecast_timestamp,
+        )
+        if parent is not None:
+            tile = parent.upsample(tile_x % 2, tile_y % 2)
+        elif previous_entry is not None:
+            tile = previous_entry.value
+        self.cache.set(
+            cache_key,
+            tile,
+            forecast_timestamp,
+            stale=True,
+            retry_after=self.failure_ttl,
+        )
+        if step == 0 and zoom == self.zoom:
+            self.notify_tile(
+                tile_position,
+                tile,
+                observation_timestamp,
+                forecast_timestamp,
+                stale=True,
+            )
+        if (
+            (cache_key, forecast_timestamp) not in self.retries
+            and len(self.retries) < self.max_retries
+        ):
+            self.retries[(cache_key, forecast_timestamp)] = \
+                asyncio.ensure_future(self.retry_tile(
+                    observation_timestamp,
+                    forecast_timestamp,
+                    tile_position,
+                    step,
+                ))
+        return tile, True
 
-    @staticmethod
-    def get_rainfall_image_url(
+    def put_tile(
+        self,
+        tile_position: Union[TilePosition, TileCoordinate],
+        step: int,
+        tile: PixelTile,
         observation_timestamp: str,
         forecast_timestamp: str,
-        tile_position: TilePosition,
-    ) -> str:
+    ):
         """
-        観測時刻と予報時刻、タイル座標から天気予報画像 URL を生成する
+        取得できたタイルをキャッシュに格納する。監視地点と購読はプロダクトの
+        zoom レベルの現在の予報時刻のタイルだけを使うので、そのときだけ知らせ、
+        アーカイブがあればそのタイルを追記する
         """
-        tail_part = "{}/none/{}/surf/hrpns/{}/{}/{}.png".format(
-            observation_timestamp,
+        self.cache.set(
+            (
+                tile_position.zoom,
+                tile_position.tile_x,
+                tile_position.tile_y,
+                step,
+            ),
+            tile,
             forecast_timestamp,
+        )
+        if step == 0 and tile_position.zoom == self.zoom:
+            self.notify_tile(
+                tile_position,
+                tile,
+                observation_timestamp,
+                forecast_timestamp,
+            )
+            if self.archive is not None:
+                task = asyncio.ensure_future(self.archive_tile(
+                    tile_position,
+                    tile,
+                    observation_timestamp,
+                    forecast_timestamp,
+                ))
+                self.archive_tasks.add(task)
+                task.add_done_callback(self.archive_tasks.discard)
+
+    async def prefetch_next_tile(
+        self,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        tile_position: Union[TilePosition, TileCoordinate],
+    ) -> bool:
+        """
+        次の予報時刻のタイルを切り替わりの前に取得し、現在の予報時刻のタイルとは
+        別のキーにキャッシュする。切り替わった後の get_tile がそれを使うので、
+        切り替わりの前のリクエストに次の予報時刻の値を返すことはない。
+        取得できたかどうかを返す
+        """
+        zoom, tile_x, tile_y = (
             tile_position.zoom,
             tile_position.tile_x,
             tile_position.tile_y,
         )
-        return f"https://www.jma.go.jp/bosai/jmatile/data/nowc/{tail_part}"
+        cache_key = (zoom, tile_x, tile_y, NEXT_FRAME_STEP)
+        if self.peek_tile(cache_key, forecast_timestamp) is not None:
+            return True
+        try:
+            tile = await self.downloads.do(
+                ((zoom, tile_x, tile_y, 0), forecast_timestamp),
+                self.load_tile,
+                observation_timestamp,
+                forecast_timestamp,
+                tile_position,
+            )
+        except TileNotFound:
+            # まだ公開されていなければ、切り替わった後に取得し直す
+            return False
+        if tile is None:
+            return False
+        self.cache.set(cache_key, tile, forecast_timestamp)
+        return True
 
-    @staticmethod
-    def download_image(url) -> PILImage:
+    def put_missing_tile(
+        self,
+        tile_position: Union[TilePosition, TileCoordinate],
+        step: int,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+    ):
+        """
+        存在しないタイルを、予報時刻が変わるまで値のないタイルとしてキャッシュする
+        """
+        self.cache.set(
+            (
+                tile_position.zoom,
+                tile_position.tile_x,
+                tile_position.tile_y,
+                step,
+            ),
+            None,
+            forecast_timestamp,
+        )
+        if step == 0 and tile_position.zoom == self.zoom:
+            self.notify_tile(
+                tile_position,
+                None,
+                observation_timestamp,
+                forecast_timestamp,
+            )
+
+    async def archive_tile(
+        self,
+        tile_position: Union[TilePosition, TileCoordinate],
+        tile: PixelTile,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+    ):
         """
-        画像を PIL.Image としてダウンロードする
+        タイルをアーカイブに追記する。ファイルへの書き込みはスレッドで行う
         """
-        image = None
         try:
-            response = requests.get(url, timeout=1)
-            if response.status_code == 200:
-                image = Image.open(BytesIO(response.content))
-                logger.info(f"successful image download from {url}")
-            else:
-                logger.warning(
-                    f"unexpected response {response.status_code} from {url}"
-                )
-        except:
-            logger.exception(f"failed to download image from {url}")
-        return image
+            appended = await asyncio.to_thread(
+                self.archive.append,
+                self.name,
+                tile_position.zoom,
+                tile_position.tile_x,
+                tile_position.tile_y,
+                observation_timestamp,
+                forecast_timestamp,
+                tile,
+            )
+        except Exception:
+            logger.exception("failed to archive tile")
+            return
+        if appended:
+            archived_frames.inc((self.name,))
 
-    def get_location_rainfall(
+    async def load_and_put_tile(
         self,
-        location: Location,
-    ) -> Dict[str, Union[str, Location, TilePosition]]:
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        tile_position: Union[TilePosition, TileCoordinate],
+        step: int,
+    ) -> Optional[PixelTile]:
         """
-        気象庁の降雨画像を用いて、緯度経度からその地点の降雨量を返す
+        load_tile で読み込んだタイルをキャッシュに格納して返す。SingleFlight の
+        処理の中で格納するので、待っていた呼び出し元が再開するまでの間に来た
+        呼び出しが、同じタイルを再度ダウンロードすることはない
         """
-        tile_position = TilePosition(location=location, zoom=9)
-        now = datetime.datetime.now(tz=JST)
-        observation_timestamp, forecast_timestamp = self.get_timestamps(now)
-        image_url = self.get_rainfall_image_url(
+        tile = await self.load_tile(
             observation_timestamp,
             forecast_timestamp,
             tile_position,
         )
-        cache_key = (tile_position.tile_x, tile_position.tile_y)
+        if tile is not None:
+            self.put_tile(
+                tile_position,
+                step,
+                tile,
+                observation_timestamp,
+                forecast_timestamp,
+            )
+        return tile
+
+    def peek_tile(
+        self,
+        cache_key: Tuple[int, int, int, int],
+        forecast_timestamp: str,
+    ) -> Optional[PixelTile]:
+        """
+        forecast_timestamp の取得に成功したタイルがキャッシュにあれば、
+        期限や統計に関係なく返す。なければ None を返す
+        """
+        entry = self.cache.peek(cache_key)
         if (
-            cache_key not in self.cache
-            or
-            self.cache[cache_key]["timestamp"] < forecast_timestamp
+            entry is None
+            or entry.stale
+            or entry.value is None
+            or entry.timestamp != forecast_timestamp
         ):
-            logger.info("cache not found. try to download new image...")
-            self.cache[cache_key] = {}
-            self.cache[cache_key]["image"] = self.download_image(image_url)
-            self.cache[cache_key]["timestamp"] = forecast_timestamp
-        else:
-            logger.info("cache found. use cache.")
-        rainfall_image = self.cache[cache_key]["image"]
-        if rainfall_image and rainfall_image.mode == "P":
-            pixel_value = rainfall_image.getpixel((
-                tile_position.pixel_x,
-                tile_position.pixel_y,
-            ))
-        else:
-            pixel_value = 0
-        rainfall = {
-            0: 0,
-            1: 0,
-            2: 1,
-            3: 5,
-            4: 10,
-            5: 20,
-            6: 30,
-            7: 50,
-            8: 80,
-            9: 100,
-        }[pixel_value]
-        return {
-            "rainfall": rainfall,
-            "location": location,
-            "tile_position": tile_position,
-            "now": now.strftime("%Y/%m/%d %H:%M:%S"),
-            "utc": (now - timedelta(hours=9)).strftime("%Y/%m/%d %H:%M:%S"),
-            "observation_timestamp": observation_timestamp,
-            "forecast_timestamp": forecast_timestamp,
-            "image_url": image_url,
-        }
+            return None
+        return entry.value
 
+    def notify_tile(
+        self,
+        tile_position: Union[TilePosition, TileCoordinate],
+        tile: Optional[PixelTile],
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        stale: bool = False,
+    ):
+        """
+        現在の予報時刻のタイルが更新されたことを、監視地点と tile_listeners に知らせる。
+        tile_listeners の各関数は (product, tile_x, tile_y, tile,
+        observation_timestamp, forecast_timestamp, stale) で呼ばれる
+        """
+        self.watches.update(
+            tile_position.tile_x,
+            tile_position.tile_y,
+            tile,
+            observation_timestamp,
+            forecast_timestamp,
+            stale,
+        )
+        for listener in list(self.tile_listeners):
+            try:
+                listener(
+                    self,
+                    tile_position.tile_x,
+                    tile_position.tile_y,
+                    tile,
+                    observation_timestamp,
+                    forecast_timestamp,
+                    stale,
+                )
+            except Exception:
+                logger.exception("failed to notify tile update")
 
-app = FastAPI(
-    title="Location Weather API",
-    description=(
-        "Get the latest weather info for a certain location in"
-        " Japan using the weather forecast and rainfall image of"
-        " the Japan Meteorological Agency."
-    ),
-    version="0.0.1",
-)
-location_weather = LocationWeatherForecast()
-location_rainfall = LocationRainfall()
+    async def retry_tile(
+        self,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        tile_position: Union[TilePosition, TileCoordinate],
+        step: int = 0,
+    ):
+        """
+        取得に失敗した画像を、間隔を倍にしながら予報時刻が変わるまで再取得する。
+        画像が存在しないとわかれば、それ以上は再取得しない
+        """
+        cache_key = (
+            tile_position.zoom,
+            tile_position.tile_x,
+            tile_position.tile_y,
+            step,
+        )
+        interval = self.retry_interval
+        try:
+            while self.get_frame_timestamps(
+                datetime.datetime.now(tz=JST),
+                step + 1,
+            )[step] == (observation_timestamp, forecast_timestamp):
+                await asyncio.sleep(interval)
+                try:
+                    tile = await self.downloads.do(
+                        (cache_key, forecast_timestamp),
+                        self.load_and_put_tile,
+                        observation_timestamp,
+                        forecast_timestamp,
+                        tile_position,
+                        step,
+                    )
+                except TileNotFound:
+                    self.put_missing_tile(
+                        tile_position,
+                        step,
+                        observation_timestamp,
+                        forecast_timestamp,
+                    )
+                    return
+                if tile is not None:
+                    return
+                interval = min(interval * 2, self.max_retry_interval)
+        finally:
+            self.retries.pop((cache_key, forecast_timestamp), None)
 
+    async def load_tile(
+        self,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        tile_position: Union[TilePosition, TileCoordinate],
+    ) -> Optional[PixelTile]:
+        """
+        タイルストアから画像を読み込む。なければダウンロードしてタイルストアに保存する
+        """
+        key = TileKey(
+            self.name,
+            observation_timestamp,
+            forecast_timestamp,
+            tile_position.zoom,
+            tile_position.tile_x,
+            tile_position.tile_y,
+        )
+        image_url = self.get_image_url(
+            observation_timestamp,
+            forecast_timestamp,
+            tile_position,
+        )
+        if self.store is None:
+            return await self.download_tile(image_url)
+        tile = await asyncio.to_thread(self.store.get, key)
+        if tile is not None:
+            return tile
+        # 他のワーカーが同じタイルを取得中なら、それを待ってタイルストアから読み込む
+        async with locked(self.store, key):
+            tile = await asyncio.to_thread(self.store.get, key)
+            if tile is not None:
+                return tile
+            tile = await self.download_tile(image_url)
+            if tile is not None:
+                await asyncio.to_thread(self.store.put, key, tile)
+        return tile
 
-class WeatherEnum(str, Enum):
-    """
-    地点天気予報レスポンスに含む天気種別の定義
-    """
-    unkown = "unkown"
+    async def get_pixel_value(
+        self,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        tile_position: TilePosition,
+    ) -> Tuple[int, bool]:
+        """
+        1 地点のパレット番号と、それが古いものかどうかの組を返す。
+
+        タイルをダウンロードする必要があれば、タイル全体のデコードを待たずに、
+        ダウンロードした画像をその地点の行まで展開して先に返す。タイルの
+        デコードとキャッシュへの格納はバックグラウンドで続ける
+        """
+        pixel_x, pixel_y = tile_position.pixel_x, tile_position.pixel_y
+        cache_key = (
+            tile_position.zoom,
+            tile_position.tile_x,
+            tile_position.tile_y,
+            0,
+        )
+        if self.peek_tile(cache_key, forecast_timestamp) is not None:
+            tile, stale = await self.get_tile(
+                observation_timestamp,
+                forecast_timestamp,
+                tile_position,
+            )
+        else:
+            task = asyncio.ensure_future(self.get_tile(
+                observation_timestamp,
+                forecast_timestamp,
+                tile_position,
+            ))
+            self.background_tiles.add(task)
+            task.add_done_callback(self.background_tiles.discard)
+            url = self.get_image_url(
+                observation_timestamp,
+                forecast_timestamp,
+                tile_position,
+            )
+            waiter = asyncio.get_running_loop().create_future()
+            self.content_waiters.setdefault(url, set()).add(waiter)
+            try:
+                await asyncio.wait(
+                    {task, waiter},
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            finally:
+                waiters = self.content_waiters.get(url)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self.content_waiters[url]
+            if not task.done() and waiter.done():
+                pixel_value = read_pixel(waiter.result(), pixel_x, pixel_y)
+                if pixel_value is not None:
+                    tile_scanline_lookups.inc((self.name,))
+                    return pixel_value, False
+            tile, stale = await task
+        if tile is None:
+            return 0, stale
+        return tile.get(pixel_x, pixel_y), stale
+
+    def get_value(self, tile: Optional[PixelTile], pixel_x: int, pixel_y: int):
+        """
+        タイルのピクセル座標の値を返す。タイルがなければパレット番号 0 の値を返す
+        """
+        pixel_value = tile.get(pixel_x, pixel_y) if tile is not None else 0
+        return self.values.get(pixel_value, self.values[0])
+
+    async def get_location_values(
+        self,
+        locations: List[Location],
+        zoom: Optional[int] = None,
+    ) -> List[Dict[str, Union[str, int, bool, Location, TilePosition]]]:
+        """
+        複数の緯度経度からそれぞれの地点の値を返す。
+        同じタイルに含まれる地点はまとめて扱い、必要なタイルは並行して取得する。
+        zoom を指定しなければプロダクトの zoom レベルの画像を使う
+        """
+        zoom = self.zoom if zoom is None else zoom
+        with projection_seconds.time((self.name,)):
+            tile_positions = TilePosition.from_locations(locations, zoom)
+        now = datetime.datetime.now(tz=JST)
+        observation_timestamp, forecast_timestamp = \
+            self.get_current_timestamps(now)
+        unique_tile_positions = {}
+        for tile_position in tile_positions:
+            unique_tile_positions.setdefault(
+                (tile_position.tile_x, tile_position.tile_y),
+                tile_position,
+            )
+        if len(locations) == 1:
+            # 1 地点だけなら、タイル全体のデコードを待たずに値を返せる
+            tiles = {}
+            pixel_values = [await self.get_pixel_value(
+                observation_timestamp,
+                forecast_timestamp,
+                tile_positions[0],
+            )]
+        else:
+            tiles = dict(zip(
+                unique_tile_positions,
+                await asyncio.gather(*[
+                    self.get_tile(
+                        observation_timestamp,
+                        forecast_timestamp,
+                        tile_position,
+                    )
+                    for tile_position in unique_tile_positions.values()
+                ]),
+            ))
+            pixel_values = []
+        if self.record_requested_tiles and zoom == self.zoom:
+            self.requested_tiles.update(unique_tile_positions)
+        now_str, utc_str = format_now(now)
+        with lookup_seconds.time((self.name,)):
+            # 画像 URL はタイルごとに一度だけ生成する
+            image_urls = {
+                key: self.get_image_url(
+                    observation_timestamp,
+                    forecast_timestamp,
+                    tile_position,
+                )
+                for key, tile_position in unique_tile_positions.items()
+            }
+            if tiles:
+                for tile_position in tile_positions:
+                    tile, stale = tiles[
+                        (tile_position.tile_x, tile_position.tile_y)
+                    ]
+                    pixel_values.append((
+                        tile.get(tile_position.pixel_x, tile_position.pixel_y)
+                        if tile is not None else 0,
+                        stale,
+                    ))
+            results = []
+            for location, tile_position, (pixel_value, stale) in zip(
+                locations,
+                tile_positions,
+                pixel_values,
+            ):
+                key = (tile_position.tile_x, tile_position.tile_y)
+                results.append({
+                    self.value_key: self.values.get(
+                        pixel_value,
+                        self.values[0],
+                    ),
+                    "location": location,
+                    "tile_position": tile_position,
+                    "now": now_str,
+                    "utc": utc_str,
+                    "observation_timestamp": observation_timestamp,
+                    "forecast_timestamp": forecast_timestamp,
+                    "image_url": image_urls[key],
+                    "stale": stale,
+                })
+        return results
+
+    async def get_location_series(
+        self,
+        location: Location,
+        zoom: Optional[int] = None,
+    ) -> Dict[str, Union[str, Location, TilePosition, List[Dict]]]:
+        """
+        緯度経度から、その地点の現在から series_steps 個の予報時刻の値を返す。
+        各予報時刻の画像は並行して取得し、予報時刻ごとにキャッシュする
+        """
+        zoom = self.zoom if zoom is None else zoom
+        tile_position = TilePosition.from_locations([location], zoom)[0]
+        now = datetime.datetime.now(tz=JST)
+        now_str, utc_str = format_now(now)
+        frames = self.get_frame_timestamps(now, self.series_steps)
+        tiles = await asyncio.gather(*[
+            self.get_tile(
+                observation_timestamp,
+                forecast_timestamp,
+                tile_position,
+                step=step,
+            )
+            for step, (observation_timestamp, forecast_timestamp)
+            in enumerate(frames)
+        ])
+        if self.record_requested_tiles and zoom == self.zoom:
+            self.requested_tiles.add(
+                (tile_position.tile_x, tile_position.tile_y),
+            )
+        series = []
+        for (observation_timestamp, forecast_timestamp), (tile, stale) in zip(
+            frames,
+            tiles,
+        ):
+            series.append({
+                self.value_key: self.get_value(
+                    tile,
+                    tile_position.pixel_x,
+                    tile_position.pixel_y,
+                ),
+                "forecast_timestamp": forecast_timestamp,
+                "image_url": self.get_image_url(
+                    observation_timestamp,
+                    forecast_timestamp,
+                    tile_position,
+                ),
+                "stale": stale,
+            })
+        return {
+            "location": location,
+            "tile_position": tile_position,
+            "now": now_str,
+            "utc": utc_str,
+            "observation_timestamp": frames[0][0],
+            "series": series,
+        }
+
+    async def get_location_history(
+        self,
+        location: Location,
+        start: datetime.datetime,
+        end: datetime.datetime,
+    ) -> Dict[str, Union[str, Location, TilePosition, List[Dict]]]:
+        """
+        緯度経度から、予報時刻が start から end までのアーカイブ済みの値を返す。
+        アーカイブにはプロダクトの zoom レベルのタイルだけがあるので、その
+        zoom レベルを使う。各フレームは該当するピクセルだけを読み、タイル全体は
+        読み込まない。タイムゾーンのない時刻は JST として扱う
+        """
+        if self.archive is None:
+            raise ValueError("frame archive is not enabled")
+        start, end = [
+            t.replace(tzinfo=JST) if t.tzinfo is None else t
+            for t in (start, end)
+        ]
+        if start > end:
+            raise ValueError("start must not exceed end")
+        if end - start > self.max_history_range:
+            raise ValueError(
+                f"range must not exceed {self.max_history_range}"
+            )
+        start_timestamp, end_timestamp = [
+            t.astimezone(timezone.utc).strftime("%Y%m%d%H%M%S")
+            for t in (start, end)
+        ]
+        tile_position = TilePosition.from_locations([location], self.zoom)[0]
+        frames = await asyncio.to_thread(
+            self.archive.read_pixels,
+            self.name,
+            self.zoom,
+            tile_position.tile_x,
+            tile_position.tile_y,
+            tile_position.pixel_x,
+            tile_position.pixel_y,
+            start_timestamp,
+            end_timestamp,
+        )
+        now_str, utc_str = format_now(datetime.datetime.now(tz=JST))
+        return {
+            "location": location,
+            "tile_position": tile_position,
+            "now": now_str,
+            "utc": utc_str,
+            "start": start_timestamp,
+            "end": end_timestamp,
+            "series": [
+                {
+                    self.value_key: self.values.get(
+                        frame.pixel_value,
+                        self.values[0],
+                    ),
+                    "forecast_timestamp": frame.forecast_timestamp,
+                    "image_url": self.get_image_url(
+                        frame.observation_timestamp,
+                        frame.forecast_timestamp,
+                        tile_position,
+                    ),
+                    "stale": False,
+                }
+                for frame in frames
+            ],
+        }
+
+    def add_watch_location(self, name: str, location: Location):
+        """
+        監視地点を登録する。タイル座標とピクセル座標はここで一度だけ計算する
+        """
+        self.watches.add(
+            name,
+            TilePosition.from_locations([location], self.zoom)[0],
+        )
+
+    async def get_watch_value(
+        self,
+        name: str,
+    ) -> Optional[Dict[str, Union[str, int, bool, Location, TilePosition]]]:
+        """
+        監視地点の値を返す。現在の予報時刻の値を保持していればそれをそのまま返し、
+        なければタイルを取得して、そのタイルの監視地点の値をまとめて更新する。
+        登録されていない地点なら None を返す
+        """
+        tile_position = self.watches.positions.get(name)
+        if tile_position is None:
+            return None
+        now = datetime.datetime.now(tz=JST)
+        now_str, utc_str = format_now(now)
+        observation_timestamp, forecast_timestamp = \
+            self.get_current_timestamps(now)
+        value = self.watches.values.get(name)
+        if value is None or value.forecast_timestamp != forecast_timestamp:
+            tile, stale = await self.get_tile(
+                observation_timestamp,
+                forecast_timestamp,
+                tile_position,
+            )
+            self.watches.update(
+                tile_position.tile_x,
+                tile_position.tile_y,
+                tile,
+                observation_timestamp,
+                forecast_timestamp,
+                stale,
+            )
+            value = self.watches.values[name]
+        return {
+            self.value_key: self.values.get(
+                value.pixel_value,
+                self.values[0],
+            ),
+            "location": tile_position.location,
+            "tile_position": tile_position,
+            "now": now_str,
+            "utc": utc_str,
+            "observation_timestamp": value.observation_timestamp,
+            "forecast_timestamp": value.forecast_timestamp,
+            "image_url": self.get_image_url(
+                value.observation_timestamp,
+                value.forecast_timestamp,
+                tile_position,
+            ),
+            "stale": value.stale,
+        }
+
+    async def get_area_values(
+        self,
+        south: float,
+        west: float,
+        north: float,
+        east: float,
+        zoom: Optional[int] = None,
+    ) -> Dict[str, Union[str, int, float, bool, None, Dict]]:
+        """
+        緯度経度の矩形範囲に含まれるピクセルの値を集計して返す。
+        値ごとのピクセル数 (histogram) と、値が数値であればその最大値と平均値を返す。
+        範囲を覆うタイルは並行して取得し、タイル画像内の範囲ごとにまとめて数える
+        """
+        if south > north or west > east:
+            raise ValueError("south/west must not exceed north/east")
+        zoom = self.zoom if zoom is None else zoom
+        windows = tile_windows_in_bbox(
+            south,
+            west,
+            north,
+            east,
+            zoom,
+            max_tiles=self.max_area_tiles,
+        )
+        now = datetime.datetime.now(tz=JST)
+        now_str, utc_str = format_now(now)
+        observation_timestamp, forecast_timestamp = \
+            self.get_current_timestamps(now)
+        tiles = await asyncio.gather(*[
+            self.get_tile(observation_timestamp, forecast_timestamp, window)
+            for window in windows
+        ])
+        counts = np.zeros(256, dtype=np.int64)
+        stale = False
+        for window, (tile, tile_stale) in zip(windows, tiles):
+            stale = stale or tile_stale
+            if tile is None:
+                counts[0] += (window.x1 - window.x0) * (window.y1 - window.y0)
+                continue
+            counts += np.bincount(
+                tile.to_array()[
+                    window.y0:window.y1,
+                    window.x0:window.x1,
+                ].ravel(),
+                minlength=256,
+            )
+        # 範囲外のパレット番号はパレット番号 0 の値として扱う
+        values = [
+            self.values.get(index, self.values[0]) for index in range(256)
+        ]
+        histogram: Dict[Union[str, int], int] = {}
+        for index in np.flatnonzero(counts).tolist():
+            histogram[values[index]] = \
+                histogram.get(values[index], 0) + int(counts[index])
+        pixels = int(counts.sum())
+        maximum = mean = None
+        if all(isinstance(value, int) for value in histogram):
+            value_array = np.array(values, dtype=np.float64)
+            maximum = max(histogram)
+            mean = float(counts @ value_array) / pixels
+        return {
+            "south": south,
+            "west": west,
+            "north": north,
+            "east": east,
+            "zoom": zoom,
+            "tiles": len(windows),
+            "pixels": pixels,
+            "histogram": histogram,
+            "max": maximum,
+            "mean": mean,
+            "now": now_str,
+            "utc": utc_str,
+            "observation_timestamp": observation_timestamp,
+            "forecast_timestamp": forecast_timestamp,
+            "stale": stale,
+        }
+
+
+class LocationWeatherForecast(TileProduct):
+    """
+    気象庁からの天気予報画像の取得とキャッシュ、それを使った地点天気予報を提供する
+    """
+    name = "wdist"
+    element = "wm"
+    zoom = 5
+    min_zoom = 4
+    max_zoom = 5
+    # 天気予報画像は 3 時間ごとに更新される
+    cache_ttl = 3 * 60 * 60
+    # 予報時刻の画像は前もって公開されているので、切り替わりの前に先読みする
+    prefetch_lead = 10 * 60
+    # 時系列は 3 時間ごとに 24 時間先までを返す
+    frame_interval = timedelta(hours=3)
+    series_steps = 9
+    value_key = "weather"
+    values = {
+        0: "unkown",
+        1: "sunny",
+        2: "cloudy",
+        3: "rainy",
+        4: "sleet",
+        5: "snow",
+    }
+
+    @staticmethod
+    def get_timestamps(now: datetime.datetime) -> Tuple[str, str]:
+        """
+        与えられた datetime.datetime を使って、wdist の URL を構築するのに必要な、
+        観測時刻と予報時刻を生成して返す。生成ルールは以下の通り。
+
+        1. 現在時刻 (JST) が 00, 01, 02 時なら 00 時に丸める
+        2. 現在時刻 (JST) が 03, 04, 05 時なら 03 時に丸める
+        3. 現在時刻 (JST) が 06, 07, 08 時なら 06 時に丸める
+        4. 他も同様
+        5. 現在時刻が 06 時 (JST) 以前なら前日の 17:00 (JST) = 前日の 08:00 (UTC)
+        6. 現在時刻が 12 時 (JST) 以前なら当日の 05:00 (JST) = 前日の 20:00 (UTC)
+        7. 現在時刻が 18 時 (JST) 以前なら当日の 11:00 (JST) = 当日の 02:00 (UTC)
+        8. 現在時刻が 19 時 (JST) 以降なら当日の 17:00 (JST) = 当日の 08:00 (UTC)
+        9. 現在時刻の UTC を取得し、予報時刻とする
+        """
+        forecast_hour = [
+            0, 0, 0,
+            3, 3, 3,
+            6, 6, 6,
+            9, 9, 9,
+            12, 12, 12,
+            15, 15, 15,
+            18, 18, 18,
+            21, 21, 21,
+        ][now.hour]
+        if forecast_hour <= 6:
+            observation_date = (now - timedelta(days=1)).date()
+            observation_timestamp = \
+                observation_date.strftime("%Y%m%d080000")
+        elif forecast_hour <= 12:
+            observation_date = (now - timedelta(days=1)).date()
+            observation_timestamp = \
+                observation_date.strftime("%Y%m%d200000")
+        elif forecast_hour <= 18:
+            observation_date = now.date()
+            observation_timestamp = \
+                observation_date.strftime("%Y%m%d020000")
+        else:
+            observation_date = now.date()
+            observation_timestamp = \
+                observation_date.strftime("%Y%m%d080000")
+        forecast_datetime = datetime.datetime(
+            now.year,
+            now.month,
+            now.day,
+            forecast_hour,
+            0,
+        )
+        forecast_datetime_utc = forecast_datetime - timedelta(hours=9)
+        forecast_timestamp = forecast_datetime_utc.strftime("%Y%m%d%H%M%S")
+        return observation_timestamp, forecast_timestamp
+
+    @staticmethod
+    def get_next_update(now: datetime.datetime) -> datetime.datetime:
+        """
+        与えられた datetime.datetime の次に予報時刻が切り替わる時刻 (3 時間ごと) を返す
+        """
+        current = now.replace(
+            hour=now.hour - now.hour % 3,
+            minute=0,
+            second=0,
+            microsecond=0,
+        )
+        return current + timedelta(hours=3)
+
+    @classmethod
+    def get_weather_forecast_image_url(
+        cls,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        tile_position: TilePosition,
+    ) -> str:
+        """
+        観測時刻と予報時刻、タイル座標から天気予報画像 URL を生成する
+        """
+        return cls.get_image_url(
+            observation_timestamp,
+            forecast_timestamp,
+            tile_position,
+        )
+
+    async def get_location_weather_forecast(
+        self,
+        location: Location,
+        zoom: Optional[int] = None,
+    ) -> Dict[str, Union[str, Location, TilePosition]]:
+        """
+        気象庁の天気予報画像を用いて、緯度経度からその地点の天気予報を返す
+        """
+        return (await self.get_location_values([location], zoom))[0]
+
+    async def get_location_weather_forecasts(
+        self,
+        locations: List[Location],
+        zoom: Optional[int] = None,
+    ) -> List[Dict[str, Union[str, Location, TilePosition]]]:
+        """
+        気象庁の天気予報画像を用いて、複数の緯度経度からそれぞれの地点の天気予報を返す
+        """
+        return await self.get_location_values(locations, zoom)
+
+
+class LocationRainfall(TileProduct):
+    """
+    気象庁からの降雨画像の取得とキャッシュ、それを使った地点降雨量を提供する
+    """
+    name = "nowc"
+    element = "hrpns"
+    zoom = 9
+    min_zoom = 4
+    max_zoom = 10
+    # 降雨画像は 5 分ごとに更新される
+    cache_ttl = 5 * 60
+    # 時系列は 5 分ごとに 1 時間先までの予測を返す
+    frame_interval = timedelta(minutes=5)
+    series_steps = 13
+    value_key = "rainfall"
+    values = {
+        0: 0,
+        1: 0,
+        2: 1,
+        3: 5,
+        4: 10,
+        5: 20,
+        6: 30,
+        7: 50,
+        8: 80,
+        9: 100,
+    }
+
+    @staticmethod
+    def get_timestamps(now: datetime.datetime) -> Tuple[str, str]:
+        """
+        与えられた datetime.datetime nowc の URL を構築するのに必要な、
+        観測時刻と予報時刻を生成して返す。生成ルールは以下の通り。
+
+        現在時刻 (JST) の分を 5 の倍数に丸め、秒以降を 0 にして UTC に変換したものを
+        観測時刻と予報時刻とする
+        （例：2021/08/01 12:07:21 (JST) -> 2021/08/01 03:05:00 (UTC)）
+        """
+        round_minute = 5 * int(now.minute / 5)
+        round_now = datetime.datetime(
+            now.year,
+            now.month,
+            now.day,
+            now.hour,
+            round_minute,
+            0,
+        )
+        utc = round_now - timedelta(hours=9)
+        timestamp = utc.strftime("%Y%m%d%H%M%S")
+        return timestamp, timestamp
+
+    @staticmethod
+    def get_next_update(now: datetime.datetime) -> datetime.datetime:
+        """
+        与えられた datetime.datetime の次に観測時刻が切り替わる時刻 (5 分ごと) を返す
+        """
+        current = now.replace(
+            minute=now.minute - now.minute % 5,
+            second=0,
+            microsecond=0,
+        )
+        return current + timedelta(minutes=5)
+
+    @classmethod
+    def get_rainfall_image_url(
+        cls,
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        tile_position: TilePosition,
+    ) -> str:
+        """
+        観測時刻と予報時刻、タイル座標から降雨画像 URL を生成する
+        """
+        return cls.get_image_url(
+            observation_timestamp,
+            forecast_timestamp,
+            tile_position,
+        )
+
+    async def get_location_rainfall(
+        self,
+        location: Location,
+        zoom: Optional[int] = None,
+    ) -> Dict[str, Union[str, Location, TilePosition]]:
+        """
+        気象庁の降雨画像を用いて、緯度経度からその地点の降雨量を返す
+        """
+        return (await self.get_location_values([location], zoom))[0]
+
+    async def get_location_rainfalls(
+        self,
+        locations: List[Location],
+        zoom: Optional[int] = None,
+    ) -> List[Dict[str, Union[str, Location, TilePosition]]]:
+        """
+        気象庁の降雨画像を用いて、複数の緯度経度からそれぞれの地点の降雨量を返す
+        """
+        return await self.get_location_values(locations, zoom)
+
+
+app = FastAPI(
+    title="Location Weather API",
+    description=(
+        "Get the latest weather info for a certain location in"
+        " Japan using the weather forecast and rainfall image of"
+        " the Japan Meteorological Agency."
+    ),
+    version="0.0.1",
+)
+tile_fetcher = TileFetcher(
+    timeout=float(os.environ.get("LWAPI_FETCH_TIMEOUT", "1.0")),
+    max_connections=int(os.environ.get("LWAPI_FETCH_MAX_CONNECTIONS", "20")),
+    max_concurrency=int(os.environ.get("LWAPI_FETCH_MAX_CONCURRENCY", "10")),
+    max_validators=int(os.environ.get("LWAPI_FETCH_MAX_VALIDATORS", "4096")),
+    max_validator_bytes=int(os.environ.get(
+        "LWAPI_FETCH_MAX_VALIDATOR_BYTES",
+        str(64 * 1024 * 1024),
+    )),
+)
+tile_decoder = TileDecoder(
+    max_workers=int(os.environ.get("LWAPI_DECODE_WORKERS", "4")),
+    max_pending=int(os.environ.get("LWAPI_DECODE_MAX_PENDING", "64")),
+)
+TileProduct.base_url = os.environ.get(
+    "LWAPI_JMA_BASE_URL",
+    TileProduct.base_url,
+)
+cache_max_entries = int(os.environ.get("LWAPI_CACHE_MAX_ENTRIES", "4096"))
+cache_max_bytes = int(os.environ.get("LWAPI_CACHE_MAX_BYTES", "268435456"))
+tile_store = None
+if os.environ.get("LWAPI_TILE_STORE_DIR"):
+    tile_store = DiskTileStore(os.environ["LWAPI_TILE_STORE_DIR"])
+tile_store_max_age = float(
+    os.environ.get("LWAPI_TILE_STORE_MAX_AGE", str(24 * 60 * 60)),
+)
+frame_archive = None
+if os.environ.get("LWAPI_ARCHIVE_DIR"):
+    frame_archive = FrameArchive(os.environ["LWAPI_ARCHIVE_DIR"])
+frame_archive_max_age = float(
+    os.environ.get("LWAPI_ARCHIVE_MAX_AGE", str(30 * 24 * 60 * 60)),
+)
+location_weather = LocationWeatherForecast(
+    tile_fetcher,
+    TileCache(
+        max_entries=cache_max_entries,
+        max_bytes=cache_max_bytes,
+        ttl=LocationWeatherForecast.cache_ttl,
+    ),
+    tile_store,
+    tile_decoder,
+)
+location_rainfall = LocationRainfall(
+    tile_fetcher,
+    TileCache(
+        max_entries=cache_max_entries,
+        max_bytes=cache_max_bytes,
+        ttl=LocationRainfall.cache_ttl,
+    ),
+    tile_store,
+    tile_decoder,
+    frame_archive,
+)
+
+products = [location_weather, location_rainfall]
+
+request_seconds = metrics_registry.register(Histogram(
+    "lwapi_request_seconds",
+    "Time spent handling a request per endpoint.",
+    ["method", "path", "status"],
+))
+app.add_middleware(RequestMetricsMiddleware, histogram=request_seconds)
+
+
+def product_metric(get_value: Callable) -> Callable:
+    """
+    プロダクトごとの値を集める CallbackMetric の callback を返す
+    """
+    return lambda: {
+        (product.name,): get_value(product) for product in products
+    }
+
+
+for key, metric_type, documentation in [
+    ("hits", "counter", "Tile cache hits."),
+    ("misses", "counter", "Tile cache misses."),
+    ("evictions", "counter", "Tile cache entries evicted by the size limits."),
+    ("expirations", "counter", "Tile cache entries removed by the TTL."),
+    ("entries", "gauge", "Tile cache entries."),
+    ("bytes", "gauge", "Estimated size of the tile cache in bytes."),
+]:
+    metrics_registry.register(CallbackMetric(
+        "lwapi_tile_cache_" + key + (
+            "_total" if metric_type == "counter" else ""
+        ),
+        documentation,
+        ["product"],
+        product_metric(lambda product, key=key: product.cache.stats()[key]),
+        metric_type,
+    ))
+for key, documentation in [
+    ("entries", "Decoded tiles kept by content hash."),
+    ("bytes", "Estimated size of decoded tiles kept by content hash."),
+]:
+    metrics_registry.register(CallbackMetric(
+        "lwapi_decoded_tiles_" + key,
+        documentation,
+        ["product"],
+        product_metric(
+            lambda product, key=key: product.decoded_tiles.stats()[key],
+        ),
+    ))
+metrics_registry.register(CallbackMetric(
+    "lwapi_tile_downloads_in_flight",
+    "Distinct tiles being downloaded or loaded from the tile store.",
+    ["product"],
+    product_metric(lambda product: len(product.downloads)),
+))
+metrics_registry.register(CallbackMetric(
+    "lwapi_upstream_not_modified_total",
+    "Conditional tile image requests answered with 304 Not Modified.",
+    [],
+    lambda: {(): tile_fetcher.not_modified},
+    "counter",
+))
+for key, documentation in [
+    ("entries", "Tile image bodies kept for conditional requests."),
+    ("bytes", "Size of tile image bodies kept for conditional requests."),
+]:
+    metrics_registry.register(CallbackMetric(
+        "lwapi_upstream_validators_" + key,
+        documentation,
+        [],
+        lambda key=key: {(): tile_fetcher.validators.stats()[key]},
+    ))
+metrics_registry.register(CallbackMetric(
+    "lwapi_tile_decodes_in_flight",
+    "Tile image decodes running or queued in the decoder thread pool.",
+    [],
+    lambda: {(): tile_decoder.pending},
+))
+metrics_registry.register(CallbackMetric(
+    "lwapi_tile_decodes_waiting",
+    "Tile image decodes waiting for room in the decoder queue.",
+    [],
+    lambda: {(): tile_decoder.waiting},
+))
+metrics_registry.register(CallbackMetric(
+    "lwapi_watch_locations",
+    "Registered watch locations.",
+    ["product"],
+    product_metric(lambda product: len(product.watches)),
+))
+metrics_registry.register(CallbackMetric(
+    "lwapi_subscriptions",
+    "Open location update subscriptions.",
+    ["product"],
+    product_metric(lambda product: len(product.tile_listeners)),
+))
+
+
+def now_jst() -> datetime.datetime:
+    return datetime.datetime.now(tz=JST)
+
+
+def create_prefetcher(product, mode: str) -> Optional[TilePrefetcher]:
+    """
+    先読みのモード (off, hot, japan) に応じた TilePrefetcher を生成する
+    """
+    if mode == "hot":
+        return TilePrefetcher(product, now_jst)
+    if mode == "japan":
+        return TilePrefetcher.for_japan(product, now_jst)
+    return None
+
+
+prefetchers = [
+    prefetcher for prefetcher in [
+        create_prefetcher(
+            location_weather,
+            os.environ.get("LWAPI_PREFETCH_WEATHER_FORECAST", "off"),
+        ),
+        create_prefetcher(
+            location_rainfall,
+            os.environ.get("LWAPI_PREFETCH_RAINFALL", "off"),
+        ),
+    ]
+    if prefetcher is not None
+]
+
+
+def create_warmer(product, region: str) -> Optional[TilePrefetcher]:
+    """
+    起動時に温める範囲 (off, japan, または "南端,西端,北端,東端") に応じて、
+    その範囲のタイルを対象にした TilePrefetcher を生成する
+    """
+    if region == "off":
+        return None
+    if region == "japan":
+        return TilePrefetcher.for_bbox(product, JAPAN_BBOX, now_jst)
+    south, west, north, east = [float(value) for value in region.split(",")]
+    return TilePrefetcher.for_bbox(
+        product,
+        (south, west, north, east),
+        now_jst,
+    )
+
+
+readiness = Readiness(
+    [
+        warmer for warmer in [
+            create_warmer(
+                location_weather,
+                os.environ.get("LWAPI_WARMUP_WEATHER_FORECAST", "japan"),
+            ),
+            create_warmer(
+                location_rainfall,
+                os.environ.get("LWAPI_WARMUP_RAINFALL", "off"),
+            ),
+        ]
+        if warmer is not None
+    ],
+    min_warmth=float(os.environ.get("LWAPI_WARMUP_MIN_WARMTH", "0.9")),
+    timeout=float(os.environ.get("LWAPI_WARMUP_TIMEOUT", "300")),
+)
+
+
+async def prune_tile_store():
+    """
+    タイルストアから古いタイルを定期的に削除する
+    """
+    while True:
+        try:
+            removed = await asyncio.to_thread(
+                tile_store.prune,
+                tile_store_max_age,
+            )
+            logger.info(f"pruned {removed} files from tile store")
+        except Exception:
+            logger.exception("failed to prune tile store")
+        await asyncio.sleep(60 * 60)
+
+
+async def prune_frame_archive():
+    """
+    アーカイブから古いフレームを定期的に削除する
+    """
+    while True:
+        try:
+            removed = await asyncio.to_thread(
+                frame_archive.prune,
+                frame_archive_max_age,
+            )
+            logger.info(f"pruned {removed} files from frame archive")
+        except Exception:
+            logger.exception("failed to prune frame archive")
+        await asyncio.sleep(60 * 60)
+
+
+background_tasks: List[asyncio.Task] = []
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """
+    起動時にキャッシュの warm-up、タイル画像の先読み、タイルストアと
+    アーカイブの掃除を開始する
+    """
+    background_tasks.append(asyncio.ensure_future(readiness.warm_up()))
+    for prefetcher in prefetchers:
+        prefetcher.start()
+    if tile_store is not None:
+        background_tasks.append(asyncio.ensure_future(prune_tile_store()))
+    if frame_archive is not None:
+        background_tasks.append(asyncio.ensure_future(prune_frame_archive()))
+
+
+@app.on_event("shutdown")
+async def close_tile_fetcher():
+    """
+    終了時にバックグラウンドの処理を止め、タイル取得用の接続プールと
+    デコード用のスレッドプールを閉じる
+    """
+    for prefetcher in prefetchers:
+        await prefetcher.stop()
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await tile_fetcher.aclose()
+    tile_decoder.shutdown()
+
+
+def location_to_dict(location: Location) -> Dict[str, float]:
+    return {"lat": location.lat, "lon": location.lon}
+
+
+def tile_position_to_dict(
+    tile_position: TilePosition,
+) -> Dict[str, Union[int, float, Dict[str, float]]]:
+    return {
+        "location": location_to_dict(tile_position.location),
+        "zoom": tile_position.zoom,
+        "x": tile_position.x,
+        "y": tile_position.y,
+        "tile_x": tile_position.tile_x,
+        "tile_y": tile_position.tile_y,
+        "pixel_x": tile_position.pixel_x,
+        "pixel_y": tile_position.pixel_y,
+    }
+
+
+def encode_result(result: Dict, compact: bool = False) -> Dict:
+    """
+    get_location_values などの結果の Location と TilePosition を辞書にする。
+    compact なら tile_position を省く
+    """
+    result = dict(result)
+    result["location"] = location_to_dict(result["location"])
+    if compact:
+        del result["tile_position"]
+    else:
+        result["tile_position"] = tile_position_to_dict(
+            result["tile_position"],
+        )
+    return result
+
+
+def select_zoom(
+    product: TileProduct,
+    zoom: Optional[int],
+    precision: Optional[float],
+    locations: List[Location],
+) -> int:
+    """
+    リクエストの zoom と precision からプロダクトの使う zoom レベルを返す。
+    範囲外なら 400 にする
+    """
+    try:
+        return product.select_zoom(
+            zoom,
+            precision,
+            [location.lat for location in locations],
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def json_response(
+    content: Any,
+    headers: Optional[Dict[str, str]] = None,
+    status_code: int = 200,
+) -> Response:
+    """
+    レスポンスモデルによる検証と変換を通さずに JSON を返す。
+    結果はすでにレスポンスモデルの形になっているので、検証は冗長になる
+    """
+    return Response(
+        json.dumps(
+            content,
+            ensure_ascii=False,
+            allow_nan=False,
+            separators=(",", ":"),
+        ).encode("utf-8"),
+        media_type="application/json",
+        headers=headers,
+        status_code=status_code,
+    )
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-Match ヘッダーが ETag に一致するかを弱い比較で判定する
+    """
+    if if_none_match is None:
+        return False
+
+    def opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    tags = [opaque(tag) for tag in if_none_match.split(",")]
+    return "*" in tags or opaque(etag) in tags
+
+
+async def get_cacheable_location_value(
+    product: TileProduct,
+    location: Location,
+    if_none_match: Optional[str],
+    compact: bool,
+    zoom: Optional[int],
+    precision: Optional[float],
+    snap: bool,
+) -> Response:
+    """
+    GET の地点の API のレスポンスを返す。予報時刻が切り替わるまでの Cache-Control と
+    ETag を付け、If-None-Match が一致すればタイルを見ずに 304 を返す。
+    snap なら地点をピクセルの中心に寄せ、同じピクセルなら同じレスポンスにする。
+    stale なレスポンスはキャッシュさせない
+    """
+    zoom = select_zoom(product, zoom, precision, [location])
+    tile_position = TilePosition.from_locations([location], zoom)[0]
+    if snap:
+        lat, lon = pixel_center(
+            zoom,
+            tile_position.tile_x,
+            tile_position.tile_y,
+            tile_position.pixel_x,
+            tile_position.pixel_y,
+        )
+        location = Location(lat=lat, lon=lon)
+    now = datetime.datetime.now(tz=JST)
+    etag = product.get_etag(
+        *product.get_current_timestamps(now),
+        tile_position,
+    )
+    if etag_matches(if_none_match, etag):
+        return Response(
+            status_code=304,
+            headers={
+                "Cache-Control": f"public, max-age={product.get_max_age(now)}",
+                "ETag": etag,
+            },
+        )
+    result = (await product.get_location_values([location], zoom))[0]
+    if result["stale"]:
+        headers = {"Cache-Control": "no-cache"}
+    else:
+        headers = {
+            "Cache-Control": "public, max-age={}".format(
+                product.get_max_age(datetime.datetime.now(tz=JST)),
+            ),
+            "ETag": product.get_etag(
+                result["observation_timestamp"],
+                result["forecast_timestamp"],
+                result["tile_position"],
+            ),
+        }
+    return json_response(encode_result(result, compact), headers)
+
+
+class WeatherEnum(str, Enum):
+    """
+    地点天気予報レスポンスに含む天気種別の定義
+    """
+    unkown = "unkown"
     sunny = "sunny"
     cloudy = "cloudy"
     rainy = "rainy"
@@ -381,23 +2008,128 @@ class LocationWeatherForecastResponse(BaseModel):
     """
     weather: WeatherEnum
     location: Location
-    tile_position: TilePosition
+    tile_position: Optional[TilePosition]
     now: str
     utc: str
     observation_timestamp: str
     forecast_timestamp: str
     image_url: str
+    stale: bool = False
 
 
 @app.post(
     "/location_weather_forecast",
     response_model=LocationWeatherForecastResponse,
 )
-async def get_location_weather_forecast(location: Location):
+async def get_location_weather_forecast(
+    location: Location,
+    compact: bool = False,
+    zoom: Optional[int] = None,
+    precision: Optional[float] = None,
+):
+    """
+    気象庁の天気予報画像を用いて、緯度経度からその地点の天気予報を返す API。
+    compact なら tile_position を省く。zoom か precision (メートル) で
+    使う画像の zoom レベルを指定できる
+    """
+    zoom = select_zoom(location_weather, zoom, precision, [location])
+    return json_response(encode_result(
+        await location_weather.get_location_weather_forecast(location, zoom),
+        compact,
+    ))
+
+
+@app.get(
+    "/location_weather_forecast",
+    response_model=LocationWeatherForecastResponse,
+)
+async def get_location_weather_forecast_cacheable(
+    lat: float,
+    lon: float,
+    compact: bool = False,
+    zoom: Optional[int] = None,
+    precision: Optional[float] = None,
+    snap: bool = False,
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    POST /location_weather_forecast の GET 版。予報時刻が切り替わるまで
+    キャッシュできるように Cache-Control と ETag を付けて返す
+    """
+    return await get_cacheable_location_value(
+        location_weather,
+        Location(lat=lat, lon=lon),
+        if_none_match,
+        compact,
+        zoom,
+        precision,
+        snap,
+    )
+
+
+@app.post(
+    "/location_weather_forecast/batch",
+    response_model=List[LocationWeatherForecastResponse],
+)
+async def get_location_weather_forecasts(
+    locations: List[Location],
+    compact: bool = False,
+    zoom: Optional[int] = None,
+    precision: Optional[float] = None,
+):
+    """
+    気象庁の天気予報画像を用いて、複数の緯度経度からそれぞれの地点の天気予報を返す API
+    """
+    zoom = select_zoom(location_weather, zoom, precision, locations)
+    return json_response([
+        encode_result(result, compact)
+        for result in await location_weather.get_location_weather_forecasts(
+            locations,
+            zoom,
+        )
+    ])
+
+
+class WeatherForecastFrame(BaseModel):
+    """
+    地点天気予報の時系列の 1 予報時刻分の定義
+    """
+    weather: WeatherEnum
+    forecast_timestamp: str
+    image_url: str
+    stale: bool = False
+
+
+class LocationWeatherForecastSeriesResponse(BaseModel):
+    """
+    地点天気予報の時系列レスポンス定義
+    """
+    location: Location
+    tile_position: Optional[TilePosition]
+    now: str
+    utc: str
+    observation_timestamp: str
+    series: List[WeatherForecastFrame]
+
+
+@app.post(
+    "/location_weather_forecast/series",
+    response_model=LocationWeatherForecastSeriesResponse,
+)
+async def get_location_weather_forecast_series(
+    location: Location,
+    compact: bool = False,
+    zoom: Optional[int] = None,
+    precision: Optional[float] = None,
+):
     """
-    気象庁の天気予報画像を用いて、緯度経度からその地点の天気予報を返す API
+    気象庁の天気予報画像を用いて、緯度経度からその地点の 24 時間先までの天気予報を返す API
     """
-    return location_weather.get_location_weather_forecast(location)
+    zoom = select_zoom(location_weather, zoom, precision, [location])
+    return json_response(encode_result(
+        await location_weather.get_location_series(location, zoom),
+        compact,
+    ))
 
 
 class RainfallEnum(int, Enum):
@@ -421,23 +2153,455 @@ class LocationRainfallResponse(BaseModel):
     """
     rainfall: RainfallEnum
     location: Location
-    tile_position: TilePosition
+    tile_position: Optional[TilePosition]
     now: str
     utc: str
     observation_timestamp: str
     forecast_timestamp: str
     image_url: str
+    stale: bool = False
 
 
 @app.post(
     "/location_rainfall",
     response_model=LocationRainfallResponse,
 )
-async def get_location_rainfall(location: Location):
+async def get_location_rainfall(
+    location: Location,
+    compact: bool = False,
+    zoom: Optional[int] = None,
+    precision: Optional[float] = None,
+):
+    """
+    気象庁の天気予報画像を用いて、緯度経度からその地点の降雨量を返す API。
+    compact なら tile_position を省く。zoom か precision (メートル) で
+    使う画像の zoom レベルを指定できる
+    """
+    zoom = select_zoom(location_rainfall, zoom, precision, [location])
+    return json_response(encode_result(
+        await location_rainfall.get_location_rainfall(location, zoom),
+        compact,
+    ))
+
+
+@app.get(
+    "/location_rainfall",
+    response_model=LocationRainfallResponse,
+)
+async def get_location_rainfall_cacheable(
+    lat: float,
+    lon: float,
+    compact: bool = False,
+    zoom: Optional[int] = None,
+    precision: Optional[float] = None,
+    snap: bool = False,
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    POST /location_rainfall の GET 版。観測時刻が切り替わるまで
+    キャッシュできるように Cache-Control と ETag を付けて返す
+    """
+    return await get_cacheable_location_value(
+        location_rainfall,
+        Location(lat=lat, lon=lon),
+        if_none_match,
+        compact,
+        zoom,
+        precision,
+        snap,
+    )
+
+
+@app.post(
+    "/location_rainfall/batch",
+    response_model=List[LocationRainfallResponse],
+)
+async def get_location_rainfalls(
+    locations: List[Location],
+    compact: bool = False,
+    zoom: Optional[int] = None,
+    precision: Optional[float] = None,
+):
+    """
+    気象庁の降雨画像を用いて、複数の緯度経度からそれぞれの地点の降雨量を返す API
+    """
+    zoom = select_zoom(location_rainfall, zoom, precision, locations)
+    return json_response([
+        encode_result(result, compact)
+        for result in await location_rainfall.get_location_rainfalls(
+            locations,
+            zoom,
+        )
+    ])
+
+
+class RainfallFrame(BaseModel):
+    """
+    地点降雨量の時系列の 1 予報時刻分の定義
+    """
+    rainfall: RainfallEnum
+    forecast_timestamp: str
+    image_url: str
+    stale: bool = False
+
+
+class LocationRainfallSeriesResponse(BaseModel):
+    """
+    地点降雨量の時系列レスポンス定義
+    """
+    location: Location
+    tile_position: Optional[TilePosition]
+    now: str
+    utc: str
+    observation_timestamp: str
+    series: List[RainfallFrame]
+
+
+@app.post(
+    "/location_rainfall/series",
+    response_model=LocationRainfallSeriesResponse,
+)
+async def get_location_rainfall_series(
+    location: Location,
+    compact: bool = False,
+    zoom: Optional[int] = None,
+    precision: Optional[float] = None,
+):
+    """
+    気象庁の降雨画像を用いて、緯度経度からその地点の 1 時間先までの降雨量を返す API
+    """
+    zoom = select_zoom(location_rainfall, zoom, precision, [location])
+    return json_response(encode_result(
+        await location_rainfall.get_location_series(location, zoom),
+        compact,
+    ))
+
+
+class LocationRainfallHistoryResponse(BaseModel):
+    """
+    地点降雨量の過去の時系列レスポンス定義
+    """
+    location: Location
+    tile_position: Optional[TilePosition]
+    now: str
+    utc: str
+    start: str
+    end: str
+    series: List[RainfallFrame]
+
+
+@app.post(
+    "/location_rainfall/history",
+    response_model=LocationRainfallHistoryResponse,
+)
+async def get_location_rainfall_history(
+    location: Location,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    compact: bool = False,
+):
+    """
+    アーカイブした降雨画像を用いて、緯度経度からその地点の start から end までの
+    降雨量を返す API。end の既定は現在時刻、start の既定は end の 6 時間前
+    """
+    if location_rainfall.archive is None:
+        raise HTTPException(
+            status_code=404,
+            detail="frame archive is not enabled",
+        )
+    end = end or datetime.datetime.now(tz=JST)
+    start = start or end - timedelta(hours=6)
+    try:
+        result = await location_rainfall.get_location_history(
+            location,
+            start,
+            end,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return json_response(encode_result(result, compact))
+
+
+class Area(BaseModel):
+    """
+    緯度経度の矩形範囲を格納するデータクラス
+    """
+    south: float
+    west: float
+    north: float
+    east: float
+
+
+class AreaAggregateResponse(BaseModel):
+    """
+    範囲集計レスポンス定義。histogram は値ごとのピクセル数で、
+    max と mean は値が数値のプロダクトのみ
+    """
+    south: float
+    west: float
+    north: float
+    east: float
+    zoom: int
+    tiles: int
+    pixels: int
+    histogram: Dict[str, int]
+    max: Optional[int]
+    mean: Optional[float]
+    now: str
+    utc: str
+    observation_timestamp: str
+    forecast_timestamp: str
+    stale: bool = False
+
+
+async def get_area_values(
+    product: TileProduct,
+    area: Area,
+    zoom: Optional[int] = None,
+):
+    try:
+        return await product.get_area_values(
+            area.south,
+            area.west,
+            area.north,
+            area.east,
+            product.select_zoom(zoom),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post(
+    "/location_weather_forecast/area",
+    response_model=AreaAggregateResponse,
+)
+async def get_area_weather_forecast(area: Area, zoom: Optional[int] = None):
+    """
+    気象庁の天気予報画像を用いて、緯度経度の矩形範囲の天気ごとのピクセル数を返す API
+    """
+    return await get_area_values(location_weather, area, zoom)
+
+
+@app.post(
+    "/location_rainfall/area",
+    response_model=AreaAggregateResponse,
+)
+async def get_area_rainfall(area: Area, zoom: Optional[int] = None):
+    """
+    気象庁の降雨画像を用いて、緯度経度の矩形範囲の降雨量の分布と最大値、平均値を返す API
+    """
+    return await get_area_values(location_rainfall, area, zoom)
+
+
+class ProductEnum(str, Enum):
+    """
+    一括取得 API で指定できるプロダクトの定義
+    """
+    weather_forecast = "weather_forecast"
+    rainfall = "rainfall"
+
+
+class LocationWeatherBatchRequest(BaseModel):
+    """
+    複数地点・複数プロダクトの一括取得リクエスト定義
+    """
+    locations: List[Location]
+    products: List[ProductEnum] = [
+        ProductEnum.weather_forecast,
+        ProductEnum.rainfall,
+    ]
+
+
+class LocationWeatherBatchResponse(BaseModel):
+    """
+    複数地点・複数プロダクトの一括取得レスポンス定義
+    """
+    weather_forecast: Optional[List[LocationWeatherForecastResponse]]
+    rainfall: Optional[List[LocationRainfallResponse]]
+
+
+@app.post(
+    "/location_weather/batch",
+    response_model=LocationWeatherBatchResponse,
+)
+async def get_location_weather(
+    request: LocationWeatherBatchRequest,
+    compact: bool = False,
+    precision: Optional[float] = None,
+):
+    """
+    複数の緯度経度について、指定されたプロダクトの情報をまとめて返す API。
+    precision (メートル) を指定すると、プロダクトごとにそれを満たす zoom レベルを使う
+    """
+    products = {
+        ProductEnum.weather_forecast: location_weather,
+        ProductEnum.rainfall: location_rainfall,
+    }
+    requested = [
+        product for product in products if product in request.products
+    ]
+    results = await asyncio.gather(*[
+        products[product].get_location_values(
+            request.locations,
+            select_zoom(products[product], None, precision, request.locations),
+        )
+        for product in requested
+    ])
+    response = {product.value: None for product in ProductEnum}
+    for product, result in zip(requested, results):
+        response[product.value] = [
+            encode_result(item, compact) for item in result
+        ]
+    return json_response(response)
+
+
+watch_max_locations = int(
+    os.environ.get("LWAPI_WATCH_MAX_LOCATIONS", "10000"),
+)
+
+
+class WatchLocation(BaseModel):
+    """
+    監視地点の定義
+    """
+    name: str
+    location: Location
+
+
+@app.get("/watch_locations", response_model=List[WatchLocation])
+async def get_watch_locations():
+    """
+    登録されている監視地点の一覧を返す API
+    """
+    return [
+        {"name": name, "location": tile_position.location}
+        for name, tile_position in location_weather.watches.positions.items()
+    ]
+
+
+@app.put("/watch_locations/{name}", response_model=WatchLocation)
+async def put_watch_location(name: str, location: Location):
+    """
+    監視地点を登録する API。登録した地点の値はタイルの更新時にまとめて計算される
+    """
+    if (
+        name not in location_weather.watches
+        and len(location_weather.watches) >= watch_max_locations
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"too many watch locations (max {watch_max_locations})",
+        )
+    location_weather.add_watch_location(name, location)
+    location_rainfall.add_watch_location(name, location)
+    return {"name": name, "location": location}
+
+
+@app.delete("/watch_locations/{name}", response_model=WatchLocation)
+async def delete_watch_location(name: str):
+    """
+    監視地点の登録を取り消す API
+    """
+    tile_position = location_weather.watches.remove(name)
+    location_rainfall.watches.remove(name)
+    if tile_position is None:
+        raise HTTPException(status_code=404, detail="watch location not found")
+    return {"name": name, "location": tile_position.location}
+
+
+@app.get(
+    "/watch_locations/{name}/weather_forecast",
+    response_model=LocationWeatherForecastResponse,
+)
+async def get_watch_weather_forecast(name: str, compact: bool = False):
+    """
+    監視地点の天気予報を返す API
+    """
+    result = await location_weather.get_watch_value(name)
+    if result is None:
+        raise HTTPException(status_code=404, detail="watch location not found")
+    return json_response(encode_result(result, compact))
+
+
+@app.get(
+    "/watch_locations/{name}/rainfall",
+    response_model=LocationRainfallResponse,
+)
+async def get_watch_rainfall(name: str, compact: bool = False):
     """
-    気象庁の天気予報画像を用いて、緯度経度からその地点の降雨量を返す API
+    監視地点の降雨量を返す API
     """
-    return location_rainfall.get_location_rainfall(location)
+    result = await location_rainfall.get_watch_value(name)
+    if result is None:
+        raise HTTPException(status_code=404, detail="watch location not found")
+    return json_response(encode_result(result, compact))
+
+
+stream_max_locations = int(
+    os.environ.get("LWAPI_STREAM_MAX_LOCATIONS", "1000"),
+)
+
+
+def format_event(event: Optional[Dict]) -> str:
+    """
+    購読のイベントを Server-Sent Events の形式にする。None はコメント行にする
+    """
+    if event is None:
+        return ": keepalive\n\n"
+    event = dict(event)
+    name = event.pop("event")
+    return f"event: {name}\ndata: {json.dumps(jsonable_encoder(event))}\n\n"
+
+
+@app.get("/location_updates")
+async def get_location_updates(
+    lat: List[float] = Query(...),
+    lon: List[float] = Query(...),
+    products: List[ProductEnum] = Query([
+        ProductEnum.weather_forecast,
+        ProductEnum.rainfall,
+    ]),
+):
+    """
+    複数の緯度経度を購読し、値が変わったときだけその地点の値を
+    Server-Sent Events で送る API。地点は lat と lon を同じ順に並べて指定する。
+    イベント名は weather か rainfall で、最初は全地点の現在の値を送る
+    """
+    if len(lat) != len(lon):
+        raise HTTPException(
+            status_code=400,
+            detail="lat and lon must have the same length",
+        )
+    if len(lat) > stream_max_locations:
+        raise HTTPException(
+            status_code=400,
+            detail=f"too many locations (max {stream_max_locations})",
+        )
+    locations = [Location(lat=la, lon=lo) for la, lo in zip(lat, lon)]
+    product_map = {
+        ProductEnum.weather_forecast: location_weather,
+        ProductEnum.rainfall: location_rainfall,
+    }
+    subscription = LocationSubscription(
+        {
+            product_map[product]: TilePosition.from_locations(
+                locations,
+                product_map[product].zoom,
+            )
+            for product in set(products)
+        },
+        lambda: datetime.datetime.now(tz=JST),
+    )
+
+    async def stream():
+        async for event in subscription.events():
+            yield format_event(event)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 class HealthStatus(BaseModel):
@@ -447,9 +2611,80 @@ class HealthStatus(BaseModel):
     status: bool
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    キャッシュや気象庁からの取得、リクエストの処理時間などのメトリクスを
+    Prometheus のテキスト形式で返す API
+    """
+    return PlainTextResponse(
+        metrics_registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
 @app.get("/healthcheck", response_model=HealthStatus)
 async def healthcheck():
     """
     API サーバーの健康状態を取得する API
     """
     return {"status": True}
+
+
+class ProductReadiness(BaseModel):
+    """
+    プロダクトごとのキャッシュと気象庁からの取得の状態の定義
+    """
+    product: str
+    warmup_tiles: int
+    cached_tiles: int
+    warmth: float
+    last_fetch_success: Optional[str]
+    fetch_failures: int
+    upstream_healthy: bool
+
+
+class ReadinessStatus(BaseModel):
+    """
+    リクエストを受けられるかどうかの定義
+    """
+    ready: bool
+    warming_up: bool
+    products: List[ProductReadiness]
+
+
+@app.get("/readiness", response_model=ReadinessStatus)
+async def get_readiness():
+    """
+    キャッシュの warm-up が終わってリクエストを受けられるかを返す API。
+    受けられなければ 503 を返すので、ロードバランサーの readiness probe に使う
+    """
+    warmers = {warmer.product: warmer for warmer in readiness.warmers}
+    statuses = []
+    for product in products:
+        warmer = warmers.get(product)
+        tiles, cached = (
+            readiness.get_warmth(warmer) if warmer is not None else (0, 0)
+        )
+        statuses.append({
+            "product": product.name,
+            "warmup_tiles": tiles,
+            "cached_tiles": cached,
+            "warmth": cached / tiles if tiles else 1.0,
+            "last_fetch_success": (
+                format_now(product.last_fetch_success)[0]
+                if product.last_fetch_success is not None else None
+            ),
+            "fetch_failures": product.fetch_failures,
+            "upstream_healthy": (
+                product.fetch_failures < product.max_fetch_failures
+            ),
+        })
+    return json_response(
+        {
+            "ready": readiness.ready,
+            "warming_up": readiness.warming_up,
+            "products": statuses,
+        },
+        status_code=200 if readiness.ready else 503,
+    )
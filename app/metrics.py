@@ -0,0 +1,254 @@
+from contextlib import contextmanager
+import math
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Sequence
+from typing import Tuple
+
+LabelValues = Tuple[str, ...]
+
+# 秒単位の処理時間向けのバケット
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """
+    Prometheus のテキスト形式で出力できるメトリクスの基底クラス
+    """
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, float]]:
+        """
+        (サンプル名, ラベルの値, 値) を順に返す
+        """
+        return iter(())
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for name, labelvalues, value in self.samples():
+            labelnames = self.labelnames
+            if len(labelvalues) > len(labelnames):
+                labelnames = labelnames + ("le",)
+            lines.append(
+                f"{name}{_format_labels(labelnames, labelvalues)}"
+                f" {_format_value(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    """
+    増えるだけの値
+    """
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, labels: LabelValues = (), amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, float]]:
+        for labels, value in sorted(self.values.items()):
+            yield self.name, labels, value
+
+
+class Gauge(Counter):
+    """
+    増減する値
+    """
+    type = "gauge"
+
+    def dec(self, labels: LabelValues = (), amount: float = 1.0):
+        self.inc(labels, -amount)
+
+    def set(self, value: float, labels: LabelValues = ()):
+        self.values[labels] = value
+
+
+class CallbackMetric(Metric):
+    """
+    出力のたびに callback を呼んで値を集める。callback はラベルの値から値への
+    辞書を返す。キャッシュの統計など、他のオブジェクトが持つ値を出すのに使う
+    """
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        callback: Callable[[], Dict[LabelValues, float]],
+        type: str = "gauge",
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type = type
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, float]]:
+        for labels, value in sorted(self.callback().items()):
+            yield self.name, labels, value
+
+
+class Histogram(Metric):
+    """
+    値の分布をバケットごとの累積数と合計で記録する
+    """
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, labels: LabelValues = ()):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * len(self.buckets)
+            self.sums[labels] = 0.0
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self.sums[labels] += value
+
+    @contextmanager
+    def time(self, labels: LabelValues = ()) -> Iterator[None]:
+        """
+        with ブロックの処理時間 (秒) を記録する
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, float]]:
+        for labels, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield f"{self.name}_bucket", labels + (
+                    _format_value(bound),
+                ), total
+            yield f"{self.name}_sum", labels, self.sums[labels]
+            yield f"{self.name}_count", labels, total
+
+
+class Registry:
+    """
+    メトリクスをまとめて Prometheus のテキスト形式で出力する
+    """
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"duplicated metric {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetricsMiddleware:
+    """
+    エンドポイントごとのリクエストの処理時間を記録する ASGI ミドルウェア
+
+    histogram には (method, path, status) のラベルを持つ Histogram を与える。
+    path はルーティングされたパスのテンプレートで、どのルートにも一致しなければ
+    unmatched とする。レスポンスを送り終える前に切断されたもの
+    (Server-Sent Events など) は記録しない。
+    """
+    def __init__(self, app, histogram: Histogram):
+        self.app = app
+        self.histogram = histogram
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        def observe():
+            route = scope.get("route")
+            self.histogram.observe(
+                time.perf_counter() - start,
+                (
+                    scope["method"],
+                    getattr(route, "path", "unmatched"),
+                    str(status),
+                ),
+            )
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body",
+                False,
+            ):
+                observe()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            status = 500
+            observe()
+            raise
@@ -0,0 +1,115 @@
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+from PIL.Image import Image as PILImage
+
+
+class PixelTile:
+    """
+    パレット (P モード) 画像のピクセル値 (パレット番号) だけを保持するタイル
+
+    天気予報画像も降雨画像もパレット番号は 16 未満なので、2 ピクセルを
+    1 バイトに詰めて (上位 4 bit が偶数列、下位 4 bit が奇数列) 保持する。
+    16 以上のパレット番号を含む画像は 1 ピクセル 1 バイトで保持する。
+    """
+    __slots__ = ("width", "height", "packed", "data")
+
+    def __init__(self, width: int, height: int, packed: bool, data: bytes):
+        self.width = width
+        self.height = height
+        self.packed = packed
+        self.data = data
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+    @classmethod
+    def from_array(cls, indices: np.ndarray) -> "PixelTile":
+        """
+        パレット番号の 2 次元配列からタイルを生成する
+        """
+        indices = np.ascontiguousarray(indices, dtype=np.uint8)
+        height, width = indices.shape
+        if width % 2 == 0 and (indices.size == 0 or indices.max() < 16):
+            packed = (indices[:, 0::2] << 4) | indices[:, 1::2]
+            return cls(width, height, True, packed.tobytes())
+        return cls(width, height, False, indices.tobytes())
+
+    @classmethod
+    def blank(cls, width: int = 256, height: int = 256) -> "PixelTile":
+        """
+        すべてのピクセルのパレット番号が 0 のタイルを生成する
+        """
+        return cls.from_array(np.zeros((height, width), dtype=np.uint8))
+
+    @classmethod
+    def from_image(cls, image: Optional[PILImage]) -> Optional["PixelTile"]:
+        """
+        PIL.Image からタイルを生成する。P モード以外の画像は扱わず None を返す
+        """
+        if image is None or image.mode != "P":
+            return None
+        return cls.from_array(np.asarray(image))
+
+    @classmethod
+    def downsample(cls, children: Sequence["PixelTile"]) -> "PixelTile":
+        """
+        1 つ細かい zoom レベルの 4 枚のタイル (左上, 右上, 左下, 右下の順) から、
+        それらを覆う粗いタイルを生成する。各 2x2 ピクセルの左上のピクセルを使う
+        """
+        top_left, top_right, bottom_left, bottom_right = [
+            child.to_array()[0::2, 0::2] for child in children
+        ]
+        return cls.from_array(np.block([
+            [top_left, top_right],
+            [bottom_left, bottom_right],
+        ]))
+
+    def upsample(self, quadrant_x: int, quadrant_y: int) -> "PixelTile":
+        """
+        タイルの 4 分の 1 の範囲 (quadrant_x, quadrant_y は 0 か 1) を
+        2 倍に拡大し、1 つ細かい zoom レベルのタイルを生成する
+        """
+        half_width = self.width // 2
+        half_height = self.height // 2
+        indices = self.to_array()[
+            quadrant_y * half_height:(quadrant_y + 1) * half_height,
+            quadrant_x * half_width:(quadrant_x + 1) * half_width,
+        ]
+        return self.from_array(indices.repeat(2, axis=0).repeat(2, axis=1))
+
+    def get(self, x: int, y: int) -> int:
+        """
+        ピクセル座標 (x, y) のパレット番号を返す
+        """
+        if self.packed:
+            value = self.data[(y * self.width + x) >> 1]
+            return value & 0x0F if x & 1 else value >> 4
+        return self.data[y * self.width + x]
+
+    def get_many(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        複数のピクセル座標のパレット番号をまとめて返す
+        """
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        data = np.frombuffer(self.data, dtype=np.uint8)
+        if not self.packed:
+            return data[ys * self.width + xs]
+        values = data[(ys * self.width + xs) >> 1]
+        return np.where(xs & 1, values & 0x0F, values >> 4)
+
+    def to_array(self) -> np.ndarray:
+        """
+        パレット番号の 2 次元配列 (height, width) を返す
+        """
+        data = np.frombuffer(self.data, dtype=np.uint8)
+        if not self.packed:
+            return data.reshape(self.height, self.width)
+        data = data.reshape(self.height, self.width // 2)
+        indices = np.empty((self.height, self.width), dtype=np.uint8)
+        indices[:, 0::2] = data >> 4
+        indices[:, 1::2] = data & 0x0F
+        return indices
@@ -0,0 +1,78 @@
+import struct
+from typing import List
+from typing import Optional
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG のフィルタ種別
+FILTER_NONE = 0
+FILTER_SUB = 1
+FILTER_UP = 2
+
+
+def read_pixel(content: bytes, x: int, y: int) -> Optional[int]:
+    """
+    パレット (カラータイプ 3) の PNG から、ピクセル座標 (x, y) のパレット番号を
+    画像全体をデコードせずに返す
+
+    IDAT は y 行目までしか展開せず、フィルタは y 行目と、Up フィルタで
+    参照する上の行の x 列に関わる分だけを戻す。Average や Paeth のように
+    左上のピクセルにも依存するフィルタの行に当たった場合や、扱えない形式
+    (パレット以外、インターレース) の場合は None を返すので、画像全体を
+    デコードすること
+    """
+    if not content.startswith(PNG_SIGNATURE):
+        return None
+    header = None
+    idat: List[bytes] = []
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(content):
+        length, chunk_type = struct.unpack(">I4s", content[pos:pos + 8])
+        data = content[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if chunk_type == b"IHDR":
+            header = struct.unpack(">IIBBBBB", data)
+        elif chunk_type == b"IDAT":
+            idat.append(data)
+        elif chunk_type == b"IEND":
+            break
+    if header is None:
+        return None
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if (
+        color_type != 3
+        or interlace != 0
+        or bit_depth not in (1, 2, 4, 8)
+        or not (0 <= x < width and 0 <= y < height)
+    ):
+        return None
+    stride = (width * bit_depth + 7) // 8 + 1
+    try:
+        raw = zlib.decompressobj().decompress(
+            b"".join(idat),
+            stride * (y + 1),
+        )
+    except zlib.error:
+        return None
+    if len(raw) < stride * (y + 1):
+        return None
+    # パレット画像は 1 ピクセル 1 バイト以下なので、フィルタは 1 バイト前を参照する
+    byte_index = x * bit_depth // 8
+    value = 0
+    for row in range(y, -1, -1):
+        offset = row * stride
+        filter_type = raw[offset]
+        if filter_type == FILTER_NONE:
+            value += raw[offset + 1 + byte_index]
+            break
+        if filter_type == FILTER_SUB:
+            value += sum(raw[offset + 1:offset + 2 + byte_index])
+            break
+        if filter_type != FILTER_UP:
+            return None
+        # Up は上の行の同じバイトを足すので、上の行へたどる (0 行目の上は 0)
+        value += raw[offset + 1 + byte_index]
+    byte = value & 0xFF
+    shift = 8 - bit_depth - (x * bit_depth) % 8
+    return (byte >> shift) & ((1 << bit_depth) - 1)
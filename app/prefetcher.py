@@ -0,0 +1,206 @@
+import asyncio
+from collections import deque
+import datetime
+from typing import Any
+from typing import Callable
+from typing import Deque
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from fastapi.logger import logger
+
+from projection import TileCoordinate
+from projection import tiles_in_bbox
+
+# 日本全域を覆う緯度経度の矩形範囲 (南端, 西端, 北端, 東端)
+JAPAN_BBOX = (20.0, 122.0, 46.0, 154.0)
+
+
+class TilePrefetcher:
+    """
+    予報時刻 (観測時刻) の切り替わりに合わせて、次の時刻のタイル画像を先に取得する
+
+    対象は、固定のタイル (日本全域など) と、直近 hot_intervals 回の更新間隔で
+    リクエストされたタイル、監視地点を含むタイル。プロダクトの prefetch_lead
+    が正なら、切り替わりのその秒数前に次の時刻のタイルを取得しておき、
+    切り替わった直後のリクエストがダウンロードを待たないようにする。
+    切り替わりの後にも対象のタイルを取得し、取得に失敗したタイルは、
+    次の切り替わりまで retry_interval 秒ごとに再取得を試みる。
+
+    product には LocationWeatherForecast か LocationRainfall を与える。
+    """
+    def __init__(
+        self,
+        product: Any,
+        clock: Callable[[], datetime.datetime],
+        tiles: Iterable[Tuple[int, int]] = (),
+        hot_intervals: int = 3,
+        delay: float = 5.0,
+        retry_interval: float = 15.0,
+    ):
+        self.product = product
+        self.clock = clock
+        self.tiles: Set[Tuple[int, int]] = set(tiles)
+        self.hot_tiles: Deque[Set[Tuple[int, int]]] = deque(
+            maxlen=hot_intervals,
+        )
+        self.delay = delay
+        self.retry_interval = retry_interval
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def for_bbox(
+        cls,
+        product: Any,
+        bbox: Tuple[float, float, float, float],
+        *args,
+        **kwargs,
+    ) -> "TilePrefetcher":
+        """
+        緯度経度の矩形範囲 (南端, 西端, 北端, 東端) を覆うタイルを対象にした
+        TilePrefetcher を生成する
+        """
+        tiles = [
+            (tile.tile_x, tile.tile_y)
+            for tile in tiles_in_bbox(*bbox, product.zoom)
+        ]
+        return cls(product, *args, tiles=tiles, **kwargs)
+
+    @classmethod
+    def for_japan(cls, product: Any, *args, **kwargs) -> "TilePrefetcher":
+        """
+        日本全域を覆うタイルを対象にした TilePrefetcher を生成する
+        """
+        return cls.for_bbox(product, JAPAN_BBOX, *args, **kwargs)
+
+    def rotate_hot_tiles(self):
+        """
+        直前の更新間隔でリクエストされたタイルを記録する
+        """
+        self.hot_tiles.append(set(self.product.requested_tiles))
+        self.product.requested_tiles.clear()
+
+    def get_tiles(self) -> Set[Tuple[int, int]]:
+        """
+        先読みの対象となるタイル座標の集合を返す
+        """
+        return self.tiles.union(
+            *self.hot_tiles,
+            self.product.watches.tiles(),
+        )
+
+    async def prefetch(
+        self,
+        now: datetime.datetime,
+        tiles: Iterable[Tuple[int, int]],
+    ) -> List[Tuple[int, int]]:
+        """
+        now 時点のタイル画像を取得してキャッシュに格納し、取得に失敗したタイル座標を返す
+        """
+        tiles = sorted(tiles)
+        observation_timestamp, forecast_timestamp = \
+            self.product.get_timestamps(now)
+        results = await asyncio.gather(*[
+            self.product.get_tile(
+                observation_timestamp,
+                forecast_timestamp,
+                TileCoordinate(self.product.zoom, tile_x, tile_y),
+                retry_failed=True,
+            )
+            for tile_x, tile_y in tiles
+        ])
+        failed = [tile for tile, (_, stale) in zip(tiles, results) if stale]
+        logger.info(
+            f"prefetched {len(tiles) - len(failed)}/{len(tiles)} tiles"
+            f" for {forecast_timestamp}"
+        )
+        return failed
+
+    async def prefetch_next(
+        self,
+        update: datetime.datetime,
+        tiles: Iterable[Tuple[int, int]],
+    ) -> int:
+        """
+        切り替わりの前に、update 時点のタイル画像を取得して次の予報時刻の
+        タイルとしてキャッシュに格納し、取得できたタイル数を返す
+        """
+        tiles = sorted(tiles)
+        observation_timestamp, forecast_timestamp = \
+            self.product.get_timestamps(update)
+        results = await asyncio.gather(*[
+            self.product.prefetch_next_tile(
+                observation_timestamp,
+                forecast_timestamp,
+                TileCoordinate(self.product.zoom, tile_x, tile_y),
+            )
+            for tile_x, tile_y in tiles
+        ])
+        fetched = sum(results)
+        logger.info(
+            f"prefetched {fetched}/{len(tiles)} tiles"
+            f" for {forecast_timestamp} before the update"
+        )
+        return fetched
+
+    async def run(self):
+        """
+        予報時刻の切り替わりごとに先読みを繰り返す
+        """
+        while True:
+            now = self.clock()
+            update = self.product.get_next_update(now)
+            lead = self.product.prefetch_lead
+            if lead > 0 and (update - now).total_seconds() > lead:
+                await asyncio.sleep((update - now).total_seconds() - lead)
+                try:
+                    await self.prefetch_next(
+                        update,
+                        self.get_tiles() | self.product.requested_tiles,
+                    )
+                except Exception:
+                    logger.exception("failed to prefetch tiles")
+                now = self.clock()
+            await asyncio.sleep(
+                max(0.0, (update - now).total_seconds() + self.delay),
+            )
+            self.rotate_hot_tiles()
+            now = self.clock()
+            next_update = self.product.get_next_update(now)
+            try:
+                failed = await self.prefetch(now, self.get_tiles())
+                while failed and (
+                    self.clock() + datetime.timedelta(
+                        seconds=self.retry_interval,
+                    ) < next_update
+                ):
+                    await asyncio.sleep(self.retry_interval)
+                    failed = await self.prefetch(now, failed)
+            except Exception:
+                logger.exception("failed to prefetch tiles")
+
+    def start(self):
+        """
+        バックグラウンドで先読みを開始する
+        """
+        if self._task is None:
+            if self.hot_tiles.maxlen:
+                self.product.record_requested_tiles = True
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """
+        バックグラウンドの先読みを停止する
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self.product.record_requested_tiles = False
+            self.product.requested_tiles.clear()
@@ -0,0 +1,194 @@
+import math
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+
+ArrayLike = Union[Sequence[float], np.ndarray]
+
+# 赤道の長さ (メートル)
+EARTH_CIRCUMFERENCE = 40075016.686
+
+
+class TileCoordinate(NamedTuple):
+    """
+    zoom レベルとタイル座標の組
+    """
+    zoom: int
+    tile_x: int
+    tile_y: int
+
+
+class TilePositionArray(NamedTuple):
+    """
+    複数地点のタイル座標とタイル画像内ピクセル座標を格納する配列の組
+    """
+    x: np.ndarray
+    y: np.ndarray
+    tile_x: np.ndarray
+    tile_y: np.ndarray
+    pixel_x: np.ndarray
+    pixel_y: np.ndarray
+
+
+def _asinh_tan(lat_rad: np.ndarray) -> np.ndarray:
+    # numpy の tan, arcsinh は libm と最下位ビットが異なることがあるため、
+    # TilePosition と同じ結果になるようにここだけ math を使う
+    return np.fromiter(
+        map(math.asinh, map(math.tan, lat_rad.tolist())),
+        dtype=np.float64,
+        count=lat_rad.size,
+    )
+
+
+def project(
+    lats: ArrayLike,
+    lons: ArrayLike,
+    zoom: int,
+) -> TilePositionArray:
+    """
+    緯度経度の配列をまとめてタイル座標とタイル画像内ピクセル座標に変換する。
+    計算は TilePosition と同じ手順で行い、結果も一致する
+    """
+    lats = np.asarray(lats, dtype=np.float64).ravel()
+    lons = np.asarray(lons, dtype=np.float64).ravel()
+    lat_rad = np.radians(lats)
+    n = 2.0 ** zoom
+    x = (lons + 180.0) / 360.0 * n
+    y = (1.0 - _asinh_tan(lat_rad) / math.pi) / 2.0 * n
+    tile_x = x.astype(np.int64)
+    tile_y = y.astype(np.int64)
+    pixel_x = ((x - tile_x) * 256).astype(np.int64)
+    pixel_y = ((y - tile_y) * 256).astype(np.int64)
+    return TilePositionArray(x, y, tile_x, tile_y, pixel_x, pixel_y)
+
+
+def pixel_center(
+    zoom: int,
+    tile_x: int,
+    tile_y: int,
+    pixel_x: int,
+    pixel_y: int,
+) -> Tuple[float, float]:
+    """
+    タイル画像内ピクセルの中心の緯度経度を返す
+    """
+    n = 2.0 ** zoom
+    x = tile_x + (pixel_x + 0.5) / 256
+    y = tile_y + (pixel_y + 0.5) / 256
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * y / n))))
+    lon = x / n * 360.0 - 180.0
+    return lat, lon
+
+
+def pixel_size(lat: float, zoom: int) -> float:
+    """
+    緯度 lat における zoom レベルのタイル画像の 1 ピクセルの幅 (メートル) を返す
+    """
+    return (
+        EARTH_CIRCUMFERENCE * math.cos(math.radians(lat)) / (256 * 2 ** zoom)
+    )
+
+
+def zoom_for_precision(
+    precision: float,
+    lats: Sequence[float],
+    min_zoom: int,
+    max_zoom: int,
+) -> int:
+    """
+    すべての緯度で 1 ピクセルの幅が precision メートル以下になる最も粗い
+    zoom レベルを min_zoom から max_zoom の範囲で返す。max_zoom でも
+    足りなければ max_zoom を返す
+    """
+    # 1 ピクセルの幅は赤道に近いほど大きい
+    lat = min((abs(lat) for lat in lats), default=0.0)
+    for zoom in range(min_zoom, max_zoom):
+        if pixel_size(lat, zoom) <= precision:
+            return zoom
+    return max_zoom
+
+
+def _check_tile_count(
+    positions: TilePositionArray,
+    max_tiles: Optional[int],
+):
+    # 一覧を作る前に、北西端と南東端のタイル座標だけからタイル数を数える
+    if max_tiles is None:
+        return
+    min_tile_x, max_tile_x = positions.tile_x.tolist()
+    min_tile_y, max_tile_y = positions.tile_y.tolist()
+    count = (max_tile_x - min_tile_x + 1) * (max_tile_y - min_tile_y + 1)
+    if count > max_tiles:
+        raise ValueError(f"area covers {count} tiles (max {max_tiles})")
+
+
+def tiles_in_bbox(
+    south: float,
+    west: float,
+    north: float,
+    east: float,
+    zoom: int,
+    max_tiles: Optional[int] = None,
+) -> List[TileCoordinate]:
+    """
+    緯度経度の矩形範囲を覆うタイル座標の一覧を返す。
+    タイル数が max_tiles を超える場合は一覧を作らずに ValueError を送出する
+    """
+    positions = project([north, south], [west, east], zoom)
+    _check_tile_count(positions, max_tiles)
+    min_tile_x, max_tile_x = positions.tile_x.tolist()
+    min_tile_y, max_tile_y = positions.tile_y.tolist()
+    return [
+        TileCoordinate(zoom, tile_x, tile_y)
+        for tile_x in range(min_tile_x, max_tile_x + 1)
+        for tile_y in range(min_tile_y, max_tile_y + 1)
+    ]
+
+
+class TileWindow(NamedTuple):
+    """
+    タイル座標と、そのタイル画像内のピクセル座標の範囲 [x0, x1), [y0, y1)
+    """
+    zoom: int
+    tile_x: int
+    tile_y: int
+    x0: int
+    y0: int
+    x1: int
+    y1: int
+
+
+def tile_windows_in_bbox(
+    south: float,
+    west: float,
+    north: float,
+    east: float,
+    zoom: int,
+    max_tiles: Optional[int] = None,
+) -> List[TileWindow]:
+    """
+    緯度経度の矩形範囲を覆うタイル座標と、各タイル画像内で矩形範囲に含まれる
+    ピクセル座標の範囲の一覧を返す。
+    タイル数が max_tiles を超える場合は一覧を作らずに ValueError を送出する
+    """
+    positions = project([north, south], [west, east], zoom)
+    _check_tile_count(positions, max_tiles)
+    min_x, max_x = (positions.tile_x * 256 + positions.pixel_x).tolist()
+    min_y, max_y = (positions.tile_y * 256 + positions.pixel_y).tolist()
+    return [
+        TileWindow(
+            zoom,
+            tile.tile_x,
+            tile.tile_y,
+            max(min_x - tile.tile_x * 256, 0),
+            max(min_y - tile.tile_y * 256, 0),
+            min(max_x - tile.tile_x * 256 + 1, 256),
+            min(max_y - tile.tile_y * 256 + 1, 256),
+        )
+        for tile in tiles_in_bbox(south, west, north, east, zoom)
+    ]
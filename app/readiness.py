@@ -0,0 +1,97 @@
+import asyncio
+import time
+from typing import Callable
+from typing import List
+from typing import Tuple
+
+from fastapi.logger import logger
+
+from prefetcher import TilePrefetcher
+
+
+class Readiness:
+    """
+    起動時にキャッシュを温め (warm-up)、リクエストを受けてよいかを判断する
+
+    warmers はプロダクトごとの TilePrefetcher で、その対象のタイルのうち
+    キャッシュに値があるものの割合 (warmth) が、すべてのプロダクトで
+    min_warmth 以上になるまで、キャッシュにないタイルを retry_interval 秒
+    ごとに取得し直す。タイルはタイルストアにあればそこから読み込む。
+    min_warmth に達するか、timeout 秒が経てば ready とする。一度 ready に
+    なれば、気象庁の障害などでキャッシュが古くなっても ready のままにする
+    (どのワーカーも同じ状況なので、外しても負荷が他に移るだけのため)。
+    """
+    def __init__(
+        self,
+        warmers: List[TilePrefetcher],
+        min_warmth: float = 0.9,
+        timeout: float = 300.0,
+        retry_interval: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.warmers = warmers
+        self.min_warmth = min_warmth
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.ready = False
+        self.warming_up = False
+
+    @staticmethod
+    def get_missing_tiles(warmer: TilePrefetcher) -> List[Tuple[int, int]]:
+        """
+        warmer の対象のタイルのうち、キャッシュに値がないタイル座標を返す。
+        存在しない (404) とわかったタイルは値がなくても含めない
+        """
+        product = warmer.product
+        missing = []
+        for tile_x, tile_y in sorted(warmer.get_tiles()):
+            entry = product.cache.peek((product.zoom, tile_x, tile_y, 0))
+            if entry is None or (entry.value is None and entry.stale):
+                missing.append((tile_x, tile_y))
+        return missing
+
+    def get_warmth(self, warmer: TilePrefetcher) -> Tuple[int, int]:
+        """
+        warmer の対象のタイル数と、そのうちキャッシュに値があるタイル数を返す
+        """
+        tiles = len(warmer.get_tiles())
+        return tiles, tiles - len(self.get_missing_tiles(warmer))
+
+    def is_warm(self) -> bool:
+        for warmer in self.warmers:
+            tiles, cached = self.get_warmth(warmer)
+            if tiles and cached < tiles * self.min_warmth:
+                return False
+        return True
+
+    async def warm_up(self):
+        """
+        キャッシュが温まるか timeout 秒が経つまで、対象のタイルを並行して取得する
+        """
+        deadline = self.clock() + self.timeout
+        self.warming_up = True
+        try:
+            while not self.is_warm():
+                if self.clock() >= deadline:
+                    logger.warning("warm-up timed out. ready with cold cache.")
+                    break
+                await asyncio.gather(*[
+                    warmer.prefetch(warmer.clock(), missing)
+                    for warmer, missing in [
+                        (warmer, self.get_missing_tiles(warmer))
+                        for warmer in self.warmers
+                    ]
+                    if missing
+                ])
+                if not self.is_warm():
+                    await asyncio.sleep(max(0.0, min(
+                        self.retry_interval,
+                        deadline - self.clock(),
+                    )))
+        except Exception:
+            logger.exception("failed to warm up tiles")
+        finally:
+            self.warming_up = False
+            self.ready = True
+        logger.info("warm-up finished")
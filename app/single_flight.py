@@ -0,0 +1,37 @@
+import asyncio
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+
+
+class SingleFlight:
+    """
+    同じキーに対する同時実行中の非同期処理を 1 つにまとめる
+
+    最初の呼び出しが処理を開始し、処理中に同じキーで呼び出されたものは
+    新たに処理を開始せず、その結果を待って受け取る。
+    """
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    async def do(
+        self,
+        key: Hashable,
+        func: Callable[..., Awaitable[Any]],
+        *args: Any,
+    ) -> Any:
+        """
+        key に対する処理が実行中ならその結果を待ち、なければ func(*args) を実行する
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        # 呼び出し元がキャンセルされても、他の待機者のために処理は継続させる
+        return await asyncio.shield(task)
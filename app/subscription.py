@@ -0,0 +1,158 @@
+import asyncio
+import datetime
+from typing import Any
+from typing import AsyncIterator
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from fastapi.logger import logger
+
+from watch_list import WatchList
+
+
+class LocationSubscription:
+    """
+    複数地点の値の変化を購読する
+
+    地点ごとの値は、購読しているプロダクトのタイルが更新されたとき
+    (tile_listeners) にまとめて計算し、前回送った値から変わった地点だけを
+    イベントとして返す。先読みが無効でも更新が届くように、予報時刻の
+    切り替わりごとに購読している地点のタイルを自分でも取得する。
+
+    positions にはプロダクトごとに、地点の順に並べたタイル座標
+    (tile_x, tile_y, pixel_x, pixel_y を持つもの) を与える。
+    """
+    def __init__(
+        self,
+        positions: Dict[Any, Sequence[Any]],
+        clock: Callable[[], datetime.datetime],
+        delay: float = 5.0,
+    ):
+        self.positions = positions
+        self.clock = clock
+        self.delay = delay
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self.watches: Dict[Any, WatchList] = {}
+        self.sent: Dict[Tuple[Any, str], Any] = {}
+        for product, product_positions in positions.items():
+            watches = WatchList()
+            for index, position in enumerate(product_positions):
+                watches.add(str(index), position)
+            self.watches[product] = watches
+
+    def on_tile(
+        self,
+        product: Any,
+        tile_x: int,
+        tile_y: int,
+        tile: Optional[Any],
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        stale: bool,
+    ):
+        """
+        タイルの更新を受け取り、値が変わった地点のイベントをキューに入れる
+        """
+        watches = self.watches.get(product)
+        if watches is None:
+            return
+        names = watches.update(
+            tile_x,
+            tile_y,
+            tile,
+            observation_timestamp,
+            forecast_timestamp,
+            stale,
+        )
+        for name in names:
+            watch_value = watches.values[name]
+            value = product.values.get(
+                watch_value.pixel_value,
+                product.values[0],
+            )
+            if (product, name) in self.sent and (
+                self.sent[(product, name)] == value
+            ):
+                continue
+            self.sent[(product, name)] = value
+            position = watches.positions[name]
+            self.queue.put_nowait({
+                "event": product.value_key,
+                "index": int(name),
+                "location": position.location,
+                product.value_key: value,
+                "observation_timestamp": watch_value.observation_timestamp,
+                "forecast_timestamp": watch_value.forecast_timestamp,
+                "stale": watch_value.stale,
+            })
+
+    async def refresh(self, product: Any):
+        """
+        購読している地点を含むタイルを現在の予報時刻で取得し、値の変化を調べる
+        """
+        observation_timestamp, forecast_timestamp = \
+            product.get_timestamps(self.clock())
+        positions = {}
+        for position in self.positions[product]:
+            positions.setdefault((position.tile_x, position.tile_y), position)
+        results = await asyncio.gather(*[
+            product.get_tile(
+                observation_timestamp,
+                forecast_timestamp,
+                position,
+            )
+            for position in positions.values()
+        ])
+        for (tile_x, tile_y), (tile, stale) in zip(positions, results):
+            self.on_tile(
+                product,
+                tile_x,
+                tile_y,
+                tile,
+                observation_timestamp,
+                forecast_timestamp,
+                stale,
+            )
+
+    async def run(self, product: Any):
+        """
+        予報時刻の切り替わりごとに refresh を繰り返す
+        """
+        while True:
+            try:
+                await self.refresh(product)
+            except Exception:
+                logger.exception("failed to refresh subscribed tiles")
+            now = self.clock()
+            await asyncio.sleep(
+                (product.get_next_update(now) - now).total_seconds()
+                + self.delay,
+            )
+
+    async def events(
+        self,
+        keepalive: float = 15.0,
+    ) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """
+        値が変わった地点のイベントを順に返す。keepalive 秒イベントがなければ
+        接続を保つために None を返す。最初は全地点の現在の値を返す
+        """
+        tasks: List[asyncio.Task] = []
+        for product in self.positions:
+            product.tile_listeners.add(self.on_tile)
+            tasks.append(asyncio.ensure_future(self.run(product)))
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(self.queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            for product in self.positions:
+                product.tile_listeners.discard(self.on_tile)
+            for task in tasks:
+                task.cancel()
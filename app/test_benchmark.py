@@ -0,0 +1,76 @@
+import asyncio
+from io import BytesIO
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+
+from PIL import Image
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from benchmark import compare
+from benchmark import render_tile
+from benchmark import run_benchmark
+import main
+
+
+class TestBenchmark(TestCase):
+
+    def test_render_tile(self):
+        path = "/bosai/jmatile/data/nowc/20210802005000/none/20210802005000/surf/hrpns/9/442/204.png"
+        self.assertEqual(render_tile(path), render_tile(path))
+        with Image.open(BytesIO(render_tile(path))) as image:
+            self.assertEqual(image.mode, "P")
+            self.assertEqual(image.size, (256, 256))
+            self.assertLess(max(image.getdata()), 10)
+
+    def test_run_benchmark(self):
+        fetchers = [product.fetcher for product in main.products]
+        results = asyncio.run(run_benchmark(
+            ["hot-rainfall", "rollover-rainfall", "batch-5"],
+            requests=40,
+            concurrency=4,
+            error_rate=0.1,
+            batch_sizes=[5],
+        ))
+        self.assertEqual(set(results), {"hot-rainfall", "rollover-rainfall", "batch-5"})
+        for result in results.values():
+            self.assertEqual(result["requests"], 40)
+            self.assertEqual(result["failures"], 0)
+            self.assertGreater(result["rps"], 0)
+            self.assertGreater(result["rss_bytes"], 0)
+        self.assertLessEqual(
+            results["hot-rainfall"]["upstream_fetches"],
+            results["rollover-rainfall"]["upstream_fetches"],
+        )
+        self.assertEqual([product.fetcher for product in main.products], fetchers)
+
+    def test_clear_caches(self):
+        results = asyncio.run(run_benchmark(
+            ["rollover-rainfall"],
+            requests=200,
+            concurrency=4,
+        ))
+        # 切り替わりのたびに、新しい URL と同じように取得とデコードをし直す
+        self.assertEqual(results["rollover-rainfall"]["upstream_not_modified"], 0)
+        self.assertGreater(results["rollover-rainfall"]["upstream_fetches"], 20)
+        for product in main.products:
+            self.assertEqual(len(product.decoded_tiles), 0)
+            self.assertEqual(len(product.fetcher.validators), 0)
+
+    def test_compare(self):
+        baseline = {"hot": {"p99_ms": 10.0, "rps": 100.0, "upstream_fetches": 10}}
+        self.assertEqual(compare(baseline, baseline, 0.2), [])
+        regressions = compare(
+            {"hot": {"p99_ms": 20.0, "rps": 50.0, "upstream_fetches": 20}},
+            baseline,
+            0.2,
+        )
+        self.assertEqual(len(regressions), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+import asyncio
+import csv
+from io import StringIO
+import json
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from bulk import CsvWriter
+from bulk import JsonlWriter
+from bulk import Progress
+from bulk import annotate_stream
+from bulk import chunked
+from bulk import detect_format
+from bulk import parse_args
+from bulk import parse_locations
+from bulk import read_csv
+from bulk import read_jsonl
+from main import Location
+from main import LocationRainfall
+from main import LocationWeatherForecast
+from test_helpers import FakeClock
+from test_helpers import encode_image
+
+EXAMPLE_IMAGES_DIR = HERE / "example_images"
+
+
+LOCATIONS = [
+    (26.206998, 127.65174),
+    (26.3344, 127.8056),
+    (26.2124, 127.6792),
+    (26.5, 127.9),
+]
+
+
+class TestBulk(TestCase):
+
+    def test_detect_format(self):
+        self.assertEqual(detect_format("points.jsonl"), "jsonl")
+        self.assertEqual(detect_format("points.ndjson"), "jsonl")
+        self.assertEqual(detect_format("points.csv"), "csv")
+        self.assertEqual(detect_format("-"), "csv")
+
+    def test_chunked(self):
+        self.assertEqual(
+            list(chunked(iter(range(5)), 2)),
+            [[0, 1], [2, 3], [4]],
+        )
+        self.assertEqual(list(chunked(iter([]), 2)), [])
+
+    def test_parse_locations(self):
+        lats, lons, valid = parse_locations(
+            [
+                {"lat": "35.0", "lon": "139.0"},
+                {"lat": "x", "lon": "139.0"},
+                {"lat": "35.0"},
+                {"lat": None, "lon": "139.0"},
+                {"lat": "89.0", "lon": "139.0"},
+                {"lat": "35.0", "lon": "180.0"},
+                {"lat": -35.0, "lon": -180.0},
+            ],
+            "lat",
+            "lon",
+        )
+        self.assertEqual(
+            valid.tolist(),
+            [True, False, False, False, False, False, True],
+        )
+        self.assertEqual(lats[0], 35.0)
+        self.assertEqual(lons[6], -180.0)
+
+    def test_parse_args(self):
+        args = parse_args(["points.csv"])
+        self.assertEqual(args.products, ["weather", "rainfall"])
+        self.assertEqual(args.output, "-")
+        with self.assertRaises(SystemExit):
+            parse_args(["points.csv", "--chunk-size", "0"])
+
+    @patch.object(LocationRainfall, "download_content")
+    @patch.object(LocationWeatherForecast, "download_content")
+    def test_annotate_stream(self, mock_weather, mock_rainfall):
+        weather = LocationWeatherForecast()
+        rainfall = LocationRainfall()
+        source = StringIO()
+        writer = csv.writer(source)
+        writer.writerow(["name", "lat", "lon"])
+        for i, (lat, lon) in enumerate(LOCATIONS):
+            writer.writerow([f"p{i}", lat, lon])
+        writer.writerow(["bad", "", "127.0"])
+        source.seek(0)
+        output = StringIO()
+        progress_output = StringIO()
+        clock = FakeClock()
+        progress = Progress(progress_output, 0.0, clock)
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as weather_image, \
+                Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as rainfall_image:
+            mock_weather.return_value = encode_image(weather_image)
+            mock_rainfall.return_value = encode_image(rainfall_image)
+            asyncio.run(annotate_stream(
+                read_csv(source),
+                CsvWriter(output).write,
+                [weather, rainfall],
+                chunk_size=2,
+                progress=progress,
+            ))
+            expected = {
+                product.value_key: asyncio.run(product.get_location_values(
+                    [Location(lat=lat, lon=lon) for lat, lon in LOCATIONS],
+                ))
+                for product in [weather, rainfall]
+            }
+        # 同じタイルはチャンクをまたいでキャッシュから使う
+        # (降雨量の zoom 9 では 4 地点が 2 枚のタイルにまたがる)
+        self.assertEqual(mock_weather.call_count, 1)
+        self.assertEqual(mock_rainfall.call_count, 2)
+        output.seek(0)
+        rows = list(csv.DictReader(output))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(list(rows[0]), [
+            "name",
+            "lat",
+            "lon",
+            "weather",
+            "weather_forecast_timestamp",
+            "weather_stale",
+            "rainfall",
+            "rainfall_forecast_timestamp",
+            "rainfall_stale",
+        ])
+        for i, row in enumerate(rows[:4]):
+            self.assertEqual(row["name"], f"p{i}")
+            for key, results in expected.items():
+                self.assertEqual(row[key], str(results[i][key]))
+                self.assertEqual(
+                    row[f"{key}_forecast_timestamp"],
+                    results[i]["forecast_timestamp"],
+                )
+                self.assertEqual(row[f"{key}_stale"], "False")
+        self.assertEqual(rows[4]["weather"], "")
+        self.assertEqual(rows[4]["rainfall_stale"], "")
+        self.assertEqual(progress.rows, 5)
+        self.assertEqual(progress.invalid, 1)
+        self.assertEqual(len(progress_output.getvalue().splitlines()), 3)
+        self.assertIn("5 rows (1 invalid)", progress_output.getvalue())
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_annotate_stream_jsonl(self, mock_rainfall):
+        rainfall = LocationRainfall()
+        source = StringIO("".join(
+            json.dumps({"id": i, "latitude": lat, "longitude": lon}) + "\n"
+            for i, (lat, lon) in enumerate(LOCATIONS)
+        ) + "\n")
+        output = StringIO()
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as image:
+            mock_rainfall.return_value = encode_image(image)
+            asyncio.run(annotate_stream(
+                read_jsonl(source),
+                JsonlWriter(output).write,
+                [rainfall],
+                chunk_size=3,
+                lat_column="latitude",
+                lon_column="longitude",
+                zoom=8,
+            ))
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([row["id"] for row in rows], [0, 1, 2, 3])
+        for row in rows:
+            self.assertIsInstance(row["rainfall"], int)
+            self.assertFalse(row["rainfall_stale"])
+        self.assertIn("/8/218/108.png", mock_rainfall.call_args[0][0])
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_annotate_stream_failure(self, mock_rainfall):
+        rainfall = LocationRainfall()
+        mock_rainfall.return_value = None
+        output = StringIO()
+        asyncio.run(annotate_stream(
+            iter([{"lat": 26.2, "lon": 127.7}]),
+            JsonlWriter(output).write,
+            [rainfall],
+        ))
+        row = json.loads(output.getvalue())
+        self.assertEqual(row["rainfall"], 0)
+        self.assertTrue(row["rainfall_stale"])
+
+
+if __name__ == "__main__":
+    unittest.main()
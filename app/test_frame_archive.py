@@ -0,0 +1,121 @@
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+import unittest
+from unittest import TestCase
+
+import numpy as np
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from frame_archive import ArchivedFrame
+from frame_archive import FrameArchive
+from pixel_tile import PixelTile
+
+
+def make_tile(value: int) -> PixelTile:
+    indices = np.zeros((256, 256), dtype=np.uint8)
+    indices[10, 20] = value
+    indices[10, 21] = value + 1
+    return PixelTile.from_array(indices)
+
+
+class TestFrameArchive(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.archive = FrameArchive(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def append(self, timestamp: str, tile: PixelTile) -> bool:
+        return self.archive.append(
+            "nowc",
+            9,
+            442,
+            204,
+            timestamp,
+            timestamp,
+            tile,
+        )
+
+    def read(self, pixel_x: int, start: str, end: str):
+        return self.archive.read_pixels(
+            "nowc",
+            9,
+            442,
+            204,
+            pixel_x,
+            10,
+            start,
+            end,
+        )
+
+    def test_read_pixels(self):
+        self.assertTrue(self.append("20210801235500", make_tile(3)))
+        self.assertTrue(self.append("20210802000000", make_tile(5)))
+        self.assertTrue(self.append("20210802000500", make_tile(7)))
+        # 同じ時刻の再追記は無視する
+        self.assertFalse(self.append("20210802000500", make_tile(7)))
+        self.assertEqual(
+            self.read(20, "20210801000000", "20210802235959"),
+            [
+                ArchivedFrame("20210801235500", "20210801235500", 3),
+                ArchivedFrame("20210802000000", "20210802000000", 5),
+                ArchivedFrame("20210802000500", "20210802000500", 7),
+            ],
+        )
+        self.assertEqual(
+            [frame.pixel_value for frame in self.read(
+                21,
+                "20210802000000",
+                "20210802000000",
+            )],
+            [6],
+        )
+        self.assertEqual(self.read(20, "20210803000000", "20210803235959"), [])
+
+    def test_read_pixels_unpacked(self):
+        indices = np.zeros((256, 256), dtype=np.uint8)
+        indices[10, 20] = 200
+        tile = PixelTile.from_array(indices)
+        self.assertFalse(tile.packed)
+        self.append("20210802000000", tile)
+        self.assertEqual(
+            [frame.pixel_value for frame in self.read(
+                20,
+                "20210802000000",
+                "20210802000000",
+            )],
+            [200],
+        )
+
+    def test_read_pixels_truncated(self):
+        self.append("20210802000000", make_tile(5))
+        self.append("20210802000500", make_tile(7))
+        path = self.archive.get_path("nowc", 9, 442, 204, "20210802")
+        # 書き込み途中で終わった末尾のレコードは読み飛ばす
+        os.truncate(path, os.path.getsize(path) - 100)
+        self.assertEqual(
+            [frame.pixel_value for frame in self.read(
+                20,
+                "20210802000000",
+                "20210802235959",
+            )],
+            [5],
+        )
+
+    def test_prune(self):
+        self.append("20210802000000", make_tile(5))
+        self.assertEqual(self.archive.prune(time.time()), 0)
+        self.assertEqual(self.archive.prune(0), 1)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
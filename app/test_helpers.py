@@ -0,0 +1,24 @@
+from io import BytesIO
+
+from PIL.Image import Image as PILImage
+
+
+def encode_image(image: PILImage) -> bytes:
+    """
+    画像を PNG にエンコードしたバイト列を返す
+    """
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeClock:
+    """
+    now を書き換えて時間を進められる単調時計
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
@@ -1,28 +1,49 @@
+import asyncio
 import datetime
+import json
 from pathlib import Path
 import sys
+import tempfile
 import unittest
 from unittest import TestCase
 from unittest.mock import patch
 
 from fastapi.testclient import TestClient
+import httpx
+import numpy as np
 from PIL import Image
-from PIL.Image import Image as PILImage
 
 HERE = Path(__file__).resolve().parent
 
 sys.path.append(str(HERE))
 
+from frame_archive import FrameArchive
 from main import JST
 from main import Location
 from main import LocationRainfall
 from main import LocationRainfallResponse
 from main import LocationWeatherForecastResponse
 from main import LocationWeatherForecast
+from main import NEXT_FRAME_STEP
 from main import RainfallEnum
 from main import TilePosition
+from main import TileProduct
 from main import WeatherEnum
 from main import app
+from main import encode_result
+from main import etag_matches
+from main import format_now
+import main
+from pixel_tile import PixelTile
+from projection import TileCoordinate
+from test_helpers import FakeClock
+from test_helpers import encode_image
+from tile_cache import TileCache
+from tile_decoder import TileDecoder
+from tile_fetcher import TileFetcher
+from tile_fetcher import TileNotFound
+from tile_store import DiskTileStore
+from tile_store import MemoryTileStore
 
 EXAMPLE_IMAGES_DIR = HERE / "example_images"
 
@@ -53,12 +74,71 @@ class TestTilePosition(TestCase):
         self.assertEqual(tile_position.tile_x, 13)
         self.assertEqual(tile_position.tile_y, 6)
 
+    def test_from_locations(self):
+        locations = [
+            Location(lat=26.206998, lon=127.65174),
+            Location(lat=33.903307, lon=130.933741),
+        ]
+        for zoom in [5, 9]:
+            tile_positions = TilePosition.from_locations(locations, zoom=zoom)
+            self.assertEqual(
+                tile_positions,
+                [TilePosition(location=location, zoom=zoom) for location in locations],
+            )
+
+
+class TestTileProduct(TestCase):
+
+    class ThunderProduct(TileProduct):
+        name = "thns"
+        element = "thns"
+        zoom = 7
+        cache_ttl = 10 * 60
+        value_key = "thunder"
+        values = {0: 0, 1: 1, 2: 2}
+
+        @staticmethod
+        def get_timestamps(now):
+            timestamp = now.strftime("%Y%m%d%H%M00")
+            return timestamp, timestamp
+
+    def test_get_image_url(self):
+        tile_position = TilePosition(
+            location=Location(lat=33.903307, lon=130.933741),
+            zoom=7,
+        )
+        self.assertEqual(
+            self.ThunderProduct.get_image_url(
+                "20210802005000",
+                "20210802005000",
+                tile_position,
+            ),
+            "https://www.jma.go.jp/bosai/jmatile/data/thns/20210802005000/none/20210802005000/surf/thns/7/110/51.png",
+        )
+
+    def test_get_location_values(self):
+        product = self.ThunderProduct()
+        tile = PixelTile.from_array([[2] * 256] * 256)
+        with patch.object(product, "download_tile") as mock_download_tile:
+            mock_download_tile.return_value = tile
+            results = asyncio.run(product.get_location_values([
+                Location(lat=33.903307, lon=130.933741),
+                Location(lat=33.9, lon=130.9),
+            ]))
+        self.assertEqual([result["thunder"] for result in results], [2, 2])
+        self.assertEqual(mock_download_tile.call_count, 1)
+        self.assertEqual(product.get_value(None, 0, 0), 0)
+        self.assertEqual(
+            product.get_value(PixelTile.from_array([[9, 9]]), 0, 0),
+            0,
+        )
+
 
 class TestLocationWeatherForecast(TestCase):
 
     def test___init__(self):
         location_weather_forecast = LocationWeatherForecast()
-        self.assertDictEqual(location_weather_forecast.cache, {})
+        self.assertEqual(len(location_weather_forecast.cache), 0)
 
     def test_get_timestamps(self):
         now = datetime.datetime(2021, 8, 1, 5, 59)
@@ -131,6 +211,27 @@ class TestLocationWeatherForecast(TestCase):
         self.assertEqual(timestamps[0], "20210801080000")
         self.assertEqual(timestamps[1], "20210801150000")
 
+    def test_get_next_update(self):
+        now = datetime.datetime(2021, 8, 1, 5, 59, 59)
+        self.assertEqual(
+            LocationWeatherForecast.get_next_update(now),
+            datetime.datetime(2021, 8, 1, 6, 0),
+        )
+
+        now = datetime.datetime(2021, 8, 1, 23, 0)
+        self.assertEqual(
+            LocationWeatherForecast.get_next_update(now),
+            datetime.datetime(2021, 8, 2, 0, 0),
+        )
+
+    def test_get_frame_timestamps(self):
+        now = datetime.datetime(2021, 8, 1, 22, 30)
+        frames = LocationWeatherForecast.get_frame_timestamps(now, 9)
+        self.assertEqual(len(frames), 9)
+        self.assertEqual(frames[0], LocationWeatherForecast.get_timestamps(now))
+        self.assertEqual(frames[1], ("20210801080000", "20210801150000"))
+        self.assertEqual(frames[8], ("20210801080000", "20210802120000"))
+
     def test_get_weather_forecast_image_url(self):
         location = Location(lat=26.206998, lon=127.65174)
         tile_position = TilePosition(location=location)
@@ -157,62 +258,95 @@ class TestLocationWeatherForecast(TestCase):
         )
 
     @unittest.skip("To reduce the load on the jma server and test time")
-    def test_download_image(self):
+    def test_download_tile(self):
         location = Location(lat=26.206998, lon=127.65174)
         tile_position = TilePosition(location=location)
         timestamps = LocationWeatherForecast.get_timestamps(datetime.datetime.now(tz=JST))
         image_url = LocationWeatherForecast.get_weather_forecast_image_url(*timestamps, tile_position)
         with self.assertLogs("fastapi", level="INFO") as cm:
-            image = LocationWeatherForecast.download_image(image_url)
+            tile = asyncio.run(LocationWeatherForecast().download_tile(image_url))
             self.assertTrue("successful image download from" in cm.output[0])
-        self.assertIsInstance(image, PILImage)
+        self.assertIsInstance(tile, PixelTile)
 
         image_url = "https://www.jma.go.jp/bosai/jmatile/data/wdist/21000801080000/none/21000801080000/surf/wm/4/13/6.png"
         with self.assertLogs("fastapi", level="WARNING") as cm:
-            image = LocationWeatherForecast.download_image(image_url)
+            tile = asyncio.run(LocationWeatherForecast().download_tile(image_url))
             self.assertTrue("unexpected response" in cm.output[0])
 
         image_url = "THIS_IS_INVALID_URL"
         with self.assertLogs("fastapi", level="ERROR") as cm:
-            image = LocationWeatherForecast.download_image(image_url)
+            tile = asyncio.run(LocationWeatherForecast().download_tile(image_url))
             self.assertTrue("failed to download image from" in cm.output[0])
 
-    @patch.object(LocationWeatherForecast, "download_image")
-    def test_get_location_weather_forecast(self, mock_download_image):
+    @patch.object(LocationWeatherForecast, "download_content")
+    def test_get_location_weather_forecast(self, mock_download_content):
         location_weather_forecast = LocationWeatherForecast()
         location = Location(lat=26.206998, lon=127.65174)
 
-        with self.assertLogs("fastapi", level="INFO") as cm:
+        with self.assertLogs("fastapi", level="DEBUG") as cm:
             with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as example_image:
-                mock_download_image.return_value = example_image
-                info = location_weather_forecast.get_location_weather_forecast(location)
+                mock_download_content.return_value = encode_image(example_image)
+                info = asyncio.run(location_weather_forecast.get_location_weather_forecast(location))
                 self.assertIsInstance(info, dict)
                 self.assertEqual(info["weather"], "cloudy")
                 self.assertTrue("cache not found." in cm.output[0])
 
-        with self.assertLogs("fastapi", level="INFO") as cm:
+        with self.assertLogs("fastapi", level="DEBUG") as cm:
             with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as example_image:
-                mock_download_image.return_value = example_image
-                info = location_weather_forecast.get_location_weather_forecast(location)
+                mock_download_content.return_value = encode_image(example_image)
+                info = asyncio.run(location_weather_forecast.get_location_weather_forecast(location))
                 self.assertTrue("cache found." in cm.output[0])
 
         location = Location(lat=0, lon=0)
         with Image.open(str(EXAMPLE_IMAGES_DIR / "0.png")) as example_image:
-            mock_download_image.return_value = example_image
-            info = location_weather_forecast.get_location_weather_forecast(location)
+            mock_download_content.return_value = encode_image(example_image)
+            info = asyncio.run(location_weather_forecast.get_location_weather_forecast(location))
             self.assertEqual(info["weather"], "unkown")
 
         location = Location(lat=100, lon=100)
-        mock_download_image.return_value = None
-        info = location_weather_forecast.get_location_weather_forecast(location)
+        mock_download_content.return_value = None
+        info = asyncio.run(location_weather_forecast.get_location_weather_forecast(location))
         self.assertEqual(info["weather"], "unkown")
 
+    @patch.object(LocationWeatherForecast, "download_content")
+    def test_get_location_weather_forecasts(self, mock_download_content):
+        location_weather_forecast = LocationWeatherForecast()
+        locations = [
+            Location(lat=26.206998, lon=127.65174),
+            Location(lat=0, lon=0),
+            Location(lat=26.206998, lon=127.65174),
+        ]
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            infos = asyncio.run(location_weather_forecast.get_location_weather_forecasts(locations))
+        self.assertEqual(mock_download_content.call_count, 2)
+        self.assertEqual([info["location"] for info in infos], locations)
+        self.assertEqual(infos[0]["weather"], "cloudy")
+        self.assertEqual(infos[2]["weather"], "cloudy")
+
+    @patch.object(LocationWeatherForecast, "download_content")
+    def test_get_location_weather_forecast_single_flight(self, mock_download_content):
+        location_weather_forecast = LocationWeatherForecast()
+        location = Location(lat=26.206998, lon=127.65174)
+
+        async def run():
+            return await asyncio.gather(*[
+                location_weather_forecast.get_location_weather_forecast(location)
+                for _ in range(5)
+            ])
+
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            infos = asyncio.run(run())
+        self.assertEqual(mock_download_content.call_count, 1)
+        self.assertEqual([info["weather"] for info in infos], ["cloudy"] * 5)
+
 
 class TestLocationRainfall(TestCase):
 
     def test___init__(self):
         location_rainfall = LocationRainfall()
-        self.assertDictEqual(location_rainfall.cache, {})
+        self.assertEqual(len(location_rainfall.cache), 0)
 
     def test_get_timestamps(self):
         now = datetime.datetime(2021, 8, 1, 0, 0)
@@ -225,6 +359,32 @@ class TestLocationRainfall(TestCase):
         self.assertEqual(timestamps[0], "20210801035500")
         self.assertEqual(timestamps[1], "20210801035500")
 
+    def test_get_next_update(self):
+        now = datetime.datetime(2021, 8, 1, 12, 7, 21)
+        self.assertEqual(
+            LocationRainfall.get_next_update(now),
+            datetime.datetime(2021, 8, 1, 12, 10),
+        )
+
+        now = datetime.datetime(2021, 8, 1, 23, 55)
+        self.assertEqual(
+            LocationRainfall.get_next_update(now),
+            datetime.datetime(2021, 8, 2, 0, 0),
+        )
+
+    def test_get_max_age(self):
+        location_rainfall = LocationRainfall()
+        now = datetime.datetime(2021, 8, 1, 23, 57, 30, 500000, tzinfo=JST)
+        self.assertEqual(location_rainfall.get_max_age(now), 150)
+
+    def test_get_frame_timestamps(self):
+        now = datetime.datetime(2021, 8, 1, 23, 57)
+        frames = LocationRainfall.get_frame_timestamps(now, 13)
+        self.assertEqual(len(frames), 13)
+        self.assertEqual(frames[0], ("20210801145500", "20210801145500"))
+        self.assertEqual(frames[1], ("20210801145500", "20210801150000"))
+        self.assertEqual(frames[12], ("20210801145500", "20210801155500"))
+
     def test_get_rainfall_image_url(self):
         location = Location(lat=33.903307, lon=130.933741)
         tile_position = TilePosition(location=location, zoom=9)
@@ -239,56 +399,516 @@ class TestLocationRainfall(TestCase):
         )
 
     @unittest.skip("To reduce the load on the jma server and test time")
-    def test_download_image(self):
+    def test_download_tile(self):
         location = Location(lat=33.903307, lon=130.933741)
         tile_position = TilePosition(location=location, zoom=9)
         timestamps = LocationRainfall.get_timestamps(datetime.datetime.now(tz=JST))
         image_url = LocationRainfall.get_rainfall_image_url(*timestamps, tile_position)
         with self.assertLogs("fastapi", level="INFO") as cm:
-            image = LocationRainfall.download_image(image_url)
+            tile = asyncio.run(LocationRainfall().download_tile(image_url))
             self.assertTrue("successful image download from" in cm.output[0])
-        self.assertIsInstance(image, PILImage)
+        self.assertIsInstance(tile, PixelTile)
 
         image_url = "https://www.jma.go.jp/bosai/jmatile/data/nowc/21000731150000/none/21000731150000/surf/hrpns/9/442/204.png"
         with self.assertLogs("fastapi", level="WARNING") as cm:
-            image = LocationRainfall.download_image(image_url)
+            tile = asyncio.run(LocationRainfall().download_tile(image_url))
             self.assertTrue("unexpected response" in cm.output[0])
 
         image_url = "THIS_IS_INVALID_URL"
         with self.assertLogs("fastapi", level="ERROR") as cm:
-            image = LocationRainfall.download_image(image_url)
+            tile = asyncio.run(LocationRainfall().download_tile(image_url))
             self.assertTrue("failed to download image from" in cm.output[0])
 
-    @patch.object(LocationRainfall, "download_image")
-    def test_get_location_weather_forecast(self, mock_download_image):
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_location_weather_forecast(self, mock_download_content):
         location_rainfall = LocationRainfall()
         location = Location(lat=33.903307, lon=130.933741)
 
-        with self.assertLogs("fastapi", level="INFO") as cm:
+        with self.assertLogs("fastapi", level="DEBUG") as cm:
             with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
-                mock_download_image.return_value = example_image
-                result = location_rainfall.get_location_rainfall(location)
+                mock_download_content.return_value = encode_image(example_image)
+                result = asyncio.run(location_rainfall.get_location_rainfall(location))
                 self.assertIsInstance(result, dict)
                 self.assertEqual(result["rainfall"], 80)
                 self.assertTrue("cache not found." in cm.output[0])
 
-        with self.assertLogs("fastapi", level="INFO") as cm:
+        with self.assertLogs("fastapi", level="DEBUG") as cm:
             with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as example_image:
-                mock_download_image.return_value = example_image
-                result = location_rainfall.get_location_rainfall(location)
+                mock_download_content.return_value = encode_image(example_image)
+                result = asyncio.run(location_rainfall.get_location_rainfall(location))
                 self.assertTrue("cache found." in cm.output[0])
 
         location = Location(lat=0, lon=0)
         with Image.open(str(EXAMPLE_IMAGES_DIR / "0.png")) as example_image:
-            mock_download_image.return_value = example_image
-            result = location_rainfall.get_location_rainfall(location)
+            mock_download_content.return_value = encode_image(example_image)
+            result = asyncio.run(location_rainfall.get_location_rainfall(location))
             self.assertEqual(result["rainfall"], 0)
 
         location = Location(lat=100, lon=100)
-        mock_download_image.return_value = None
-        result = location_rainfall.get_location_rainfall(location)
+        mock_download_content.return_value = None
+        result = asyncio.run(location_rainfall.get_location_rainfall(location))
         self.assertEqual(result["rainfall"], 0)
 
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_location_series(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        location = Location(lat=33.903307, lon=130.933741)
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            result = asyncio.run(location_rainfall.get_location_series(location))
+        self.assertEqual(len(result["series"]), 13)
+        self.assertEqual(mock_download_content.call_count, 13)
+        self.assertEqual(len(location_rainfall.cache), 13)
+        self.assertEqual(
+            [frame["rainfall"] for frame in result["series"]],
+            [80] * 13,
+        )
+        self.assertEqual(
+            len({frame["image_url"] for frame in result["series"]}),
+            13,
+        )
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_requested_tiles(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        location = Location(lat=33.903307, lon=130.933741)
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            # 先読みが動いていなければ記録しない
+            asyncio.run(location_rainfall.get_location_rainfall(location))
+            self.assertEqual(location_rainfall.requested_tiles, set())
+            location_rainfall.record_requested_tiles = True
+            asyncio.run(location_rainfall.get_location_rainfall(location))
+            asyncio.run(location_rainfall.get_location_series(
+                Location(lat=33.9, lon=131.5),
+            ))
+        self.assertEqual(
+            location_rainfall.requested_tiles,
+            {(442, 204), (443, 204)},
+        )
+
+    def test_get_area_values(self):
+        location_rainfall = LocationRainfall()
+        indices = [[8, 2] * 128] * 256
+        with patch.object(location_rainfall, "download_tile") as mock_download_tile:
+            mock_download_tile.return_value = PixelTile.from_array(indices)
+            result = asyncio.run(location_rainfall.get_area_values(33.8, 130.8, 34.0, 131.0))
+        self.assertEqual(result["tiles"], mock_download_tile.call_count)
+        self.assertEqual(sum(result["histogram"].values()), result["pixels"])
+        self.assertEqual(set(result["histogram"]), {1, 80})
+        self.assertEqual(result["max"], 80)
+        self.assertAlmostEqual(
+            result["mean"],
+            (80 * result["histogram"][80] + result["histogram"][1]) / result["pixels"],
+        )
+
+        location_weather = LocationWeatherForecast()
+        with patch.object(location_weather, "download_tile") as mock_download_tile:
+            mock_download_tile.return_value = None
+            result = asyncio.run(location_weather.get_area_values(33.8, 130.8, 34.0, 131.0))
+        self.assertEqual(result["histogram"], {"unkown": result["pixels"]})
+        self.assertIsNone(result["max"])
+        self.assertIsNone(result["mean"])
+
+        with self.assertRaises(ValueError):
+            asyncio.run(location_rainfall.get_area_values(34.0, 130.8, 33.8, 131.0))
+        with self.assertRaises(ValueError):
+            asyncio.run(location_rainfall.get_area_values(20.0, 122.0, 46.0, 154.0))
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_watch_value(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        self.assertIsNone(asyncio.run(location_rainfall.get_watch_value("store")))
+        location_rainfall.add_watch_location("store", Location(lat=33.903307, lon=130.933741))
+        location_rainfall.add_watch_location("zero", Location(lat=33.9, lon=130.9))
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            result = asyncio.run(location_rainfall.get_watch_value("store"))
+        self.assertEqual(result["rainfall"], 80)
+        self.assertEqual(mock_download_content.call_count, 1)
+        self.assertIn("zero", location_rainfall.watches.values)
+
+        expected = asyncio.run(location_rainfall.get_location_rainfall(Location(lat=33.9, lon=130.9)))
+        result = asyncio.run(location_rainfall.get_watch_value("zero"))
+        self.assertEqual(result["rainfall"], expected["rainfall"])
+        self.assertEqual(result["tile_position"], expected["tile_position"])
+        self.assertEqual(mock_download_content.call_count, 1)
+
+    def test_download_content_fetch_status(self):
+        content = (EXAMPLE_IMAGES_DIR / "204.png").read_bytes()
+        location_rainfall = LocationRainfall()
+        self.assertIsNone(location_rainfall.last_fetch_success)
+        with patch.object(location_rainfall.fetcher, "fetch") as mock_fetch:
+            mock_fetch.return_value = None
+            for _ in range(2):
+                asyncio.run(location_rainfall.download_content("https://example.com/1.png"))
+            self.assertEqual(location_rainfall.fetch_failures, 2)
+            self.assertIsNone(location_rainfall.last_fetch_success)
+            mock_fetch.return_value = content
+            asyncio.run(location_rainfall.download_content("https://example.com/1.png"))
+        self.assertEqual(location_rainfall.fetch_failures, 0)
+        self.assertIsNotNone(location_rainfall.last_fetch_success)
+
+    def test_fetch_failures_not_found(self):
+        status_code = 404
+
+        def handler(request):
+            return httpx.Response(status_code)
+
+        location_rainfall = LocationRainfall(
+            fetcher=TileFetcher(transport=httpx.MockTransport(handler)),
+        )
+        # 提供範囲外の座標への問い合わせは気象庁の異常として数えない
+        for i in range(location_rainfall.max_fetch_failures):
+            result = asyncio.run(location_rainfall.get_location_rainfall(
+                Location(lat=0, lon=i * 10),
+            ))
+            self.assertEqual(result["rainfall"], 0)
+            self.assertFalse(result["stale"])
+        self.assertEqual(location_rainfall.fetch_failures, 0)
+
+        status_code = 503
+        with self.assertLogs("fastapi", level="WARNING"):
+            asyncio.run(location_rainfall.download_content("https://example.com/1.png"))
+        self.assertEqual(location_rainfall.fetch_failures, 1)
+
+    def test_download_tile_reuses_decoded_tile(self):
+        content = (EXAMPLE_IMAGES_DIR / "204.png").read_bytes()
+        location_rainfall = LocationRainfall()
+        with patch.object(location_rainfall.fetcher, "fetch") as mock_fetch, \
+                patch("main.Image.open", wraps=Image.open) as mock_open, \
+                patch.object(
+                    PixelTile,
+                    "from_image",
+                    wraps=PixelTile.from_image,
+                ) as mock_from_image:
+            mock_fetch.return_value = content
+            first = asyncio.run(location_rainfall.download_tile("https://example.com/1.png"))
+            second = asyncio.run(location_rainfall.download_tile("https://example.com/2.png"))
+            # 同じ内容なら、デコードも PixelTile への変換もし直さない
+            self.assertIs(first, second)
+            self.assertEqual(mock_open.call_count, 1)
+            self.assertEqual(mock_from_image.call_count, 1)
+
+            mock_fetch.return_value = (EXAMPLE_IMAGES_DIR / "13.png").read_bytes()
+            third = asyncio.run(location_rainfall.download_tile("https://example.com/3.png"))
+            self.assertIsNot(first, third)
+            self.assertEqual(mock_open.call_count, 2)
+            self.assertEqual(mock_from_image.call_count, 2)
+        self.assertEqual(len(location_rainfall.decoded_tiles), 2)
+
+    def test_get_location_rainfall_scanline(self):
+        content = (EXAMPLE_IMAGES_DIR / "204.png").read_bytes()
+
+        class SlowDecoder(TileDecoder):
+            async def run(self, func, *args):
+                await self.release.wait()
+                return await super().run(func, *args)
+
+        decoder = SlowDecoder()
+        location_rainfall = LocationRainfall(decoder=decoder)
+        location = Location(lat=33.903307, lon=130.933741)
+
+        async def run():
+            decoder.release = asyncio.Event()
+            # タイル全体のデコードを待たずに、その地点の行だけを読んで返す
+            result = await location_rainfall.get_location_rainfall(location)
+            self.assertEqual(result["rainfall"], 80)
+            self.assertFalse(result["stale"])
+            self.assertEqual(location_rainfall.content_waiters, {})
+            self.assertEqual(len(location_rainfall.background_tiles), 1)
+            decoder.release.set()
+            await asyncio.gather(*location_rainfall.background_tiles)
+            self.assertEqual(len(location_rainfall.cache), 1)
+            result = await location_rainfall.get_location_rainfall(location)
+            self.assertEqual(result["rainfall"], 80)
+
+        with patch.object(location_rainfall.fetcher, "fetch") as mock_fetch:
+            mock_fetch.return_value = content
+            asyncio.run(run())
+            self.assertEqual(mock_fetch.call_count, 1)
+        decoder.shutdown()
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_location_rainfall_tile_store(self, mock_download_content):
+        location = Location(lat=33.903307, lon=130.933741)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+                mock_download_content.return_value = encode_image(example_image)
+                location_rainfall = LocationRainfall(store=DiskTileStore(tmpdir))
+                result = asyncio.run(location_rainfall.get_location_rainfall(location))
+                self.assertEqual(result["rainfall"], 80)
+
+            # 再起動後はタイルストアから読み込み、ダウンロードしない
+            mock_download_content.return_value = None
+            location_rainfall = LocationRainfall(store=DiskTileStore(tmpdir))
+            result = asyncio.run(location_rainfall.get_location_rainfall(location))
+            self.assertEqual(result["rainfall"], 80)
+        self.assertEqual(mock_download_content.call_count, 1)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_location_rainfall_shared_tile_store(self, mock_download_content):
+        # 同じタイルストアを共有する 2 つのワーカーを模擬する
+        store = MemoryTileStore()
+        workers = [LocationRainfall(store=store), LocationRainfall(store=store)]
+        location = Location(lat=33.903307, lon=130.933741)
+
+        async def run():
+            return await asyncio.gather(*[
+                worker.get_location_rainfall(location) for worker in workers
+            ])
+
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            results = asyncio.run(run())
+        self.assertEqual([result["rainfall"] for result in results], [80, 80])
+        self.assertEqual(mock_download_content.call_count, 1)
+        self.assertEqual(len(store.tiles), 1)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_location_rainfall_stale(self, mock_download_content):
+        clock = FakeClock()
+        location_rainfall = LocationRainfall(cache=TileCache(clock=clock))
+        location = Location(lat=33.903307, lon=130.933741)
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            # 前の観測時刻の画像だけがキャッシュにある状態で、ダウンロードに失敗する
+            location_rainfall.cache.set((9, 442, 204, 0), PixelTile.from_image(example_image), "20000101000000")
+        mock_download_content.return_value = None
+
+        async def run():
+            result = await location_rainfall.get_location_rainfall(location)
+            self.assertEqual(result["rainfall"], 80)
+            self.assertTrue(result["stale"])
+            self.assertEqual(len(location_rainfall.retries), 1)
+
+            # 失敗は failure_ttl 秒だけキャッシュされる
+            result = await location_rainfall.get_location_rainfall(location)
+            self.assertTrue(result["stale"])
+            self.assertEqual(mock_download_content.call_count, 1)
+
+            clock.now = location_rainfall.failure_ttl
+            result = await location_rainfall.get_location_rainfall(location)
+            self.assertEqual(result["rainfall"], 80)
+            self.assertTrue(result["stale"])
+            self.assertEqual(mock_download_content.call_count, 2)
+
+        asyncio.run(run())
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_retry_tile(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        location_rainfall.retry_interval = 0.001
+        location = Location(lat=33.903307, lon=130.933741)
+
+        async def run():
+            result = await location_rainfall.get_location_rainfall(location)
+            self.assertEqual(result["rainfall"], 0)
+            self.assertTrue(result["stale"])
+            await asyncio.gather(*location_rainfall.retries.values())
+            result = await location_rainfall.get_location_rainfall(location)
+            self.assertEqual(result["rainfall"], 80)
+            self.assertFalse(result["stale"])
+
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.side_effect = [None, None, encode_image(example_image)]
+            asyncio.run(run())
+        self.assertEqual(mock_download_content.call_count, 3)
+        self.assertEqual(location_rainfall.retries, {})
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_location_rainfall_not_found(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        location_rainfall.retry_interval = 0.001
+        location = Location(lat=0, lon=0)
+        mock_download_content.side_effect = TileNotFound("404")
+
+        async def run():
+            for _ in range(3):
+                result = await location_rainfall.get_location_rainfall(location)
+                self.assertEqual(result["rainfall"], 0)
+                self.assertFalse(result["stale"])
+            # 存在しないタイルは再取得せず、予報時刻が変わるまでキャッシュする
+            self.assertEqual(location_rainfall.retries, {})
+
+        asyncio.run(run())
+        self.assertEqual(mock_download_content.call_count, 1)
+
+    @patch.object(LocationWeatherForecast, "download_content")
+    def test_prefetch_next_tile(self, mock_download_content):
+        location_weather = LocationWeatherForecast()
+        coordinate = TileCoordinate(5, 27, 13)
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as example_image, \
+                Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as other_image:
+            mock_download_content.side_effect = [
+                encode_image(example_image),
+                encode_image(other_image),
+            ]
+
+            async def run():
+                self.assertTrue(await location_weather.prefetch_next_tile(
+                    "20210801020000",
+                    "20210801060000",
+                    coordinate,
+                ))
+                # 切り替わりの前のリクエストには次の予報時刻のタイルを返さない
+                current, stale = await location_weather.get_tile(
+                    "20210801020000",
+                    "20210801030000",
+                    coordinate,
+                )
+                self.assertFalse(stale)
+                self.assertEqual(mock_download_content.call_count, 2)
+                self.assertEqual(
+                    location_weather.cache.peek((5, 27, 13, 0)).timestamp,
+                    "20210801030000",
+                )
+                # 切り替わった後はダウンロードせずに先読みしたタイルを使う
+                tile, stale = await location_weather.get_tile(
+                    "20210801020000",
+                    "20210801060000",
+                    coordinate,
+                )
+                self.assertFalse(stale)
+                self.assertIsNot(tile, current)
+                self.assertTrue((tile.to_array() == np.asarray(example_image)).all())
+                self.assertEqual(mock_download_content.call_count, 2)
+                self.assertIsNone(location_weather.cache.peek((5, 27, 13, NEXT_FRAME_STEP)))
+
+            asyncio.run(run())
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_max_retries(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        location_rainfall.max_retries = 2
+        mock_download_content.return_value = None
+
+        async def run():
+            await location_rainfall.get_location_rainfalls([
+                Location(lat=33.9, lon=130.9 + i)
+                for i in range(4)
+            ])
+            self.assertEqual(len(location_rainfall.retries), 2)
+            for task in location_rainfall.retries.values():
+                task.cancel()
+
+        asyncio.run(run())
+        self.assertEqual(mock_download_content.call_count, 4)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_location_rainfall_single_flight(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        location = Location(lat=33.903307, lon=130.933741)
+
+        async def run():
+            return await asyncio.gather(*[
+                location_rainfall.get_location_rainfall(location)
+                for _ in range(5)
+            ])
+
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            results = asyncio.run(run())
+        self.assertEqual(mock_download_content.call_count, 1)
+        self.assertEqual([result["rainfall"] for result in results], [80] * 5)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_tile_from_finer_zoom(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        location = Location(lat=33.903307, lon=130.933741)
+        _, forecast_timestamp = location_rainfall.get_current_timestamps(
+            datetime.datetime.now(tz=JST),
+        )
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            tile = PixelTile.from_image(example_image)
+        # zoom 10 の 4 枚がキャッシュにあれば、zoom 9 のタイルはダウンロードしない
+        for dx in (0, 1):
+            for dy in (0, 1):
+                location_rainfall.cache.set(
+                    (10, 884 + dx, 408 + dy, 0),
+                    tile.upsample(dx, dy),
+                    forecast_timestamp,
+                )
+        result = asyncio.run(location_rainfall.get_location_rainfall(location, 9))
+        self.assertEqual(result["rainfall"], 80)
+        self.assertFalse(result["stale"])
+        self.assertIn("/hrpns/9/442/204.png", result["image_url"])
+        mock_download_content.assert_not_called()
+        self.assertIsNotNone(location_rainfall.cache.peek((9, 442, 204, 0)))
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_tile_from_coarser_zoom(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        location = Location(lat=33.903307, lon=130.933741)
+        _, forecast_timestamp = location_rainfall.get_current_timestamps(
+            datetime.datetime.now(tz=JST),
+        )
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            location_rainfall.cache.set(
+                (9, 442, 204, 0),
+                PixelTile.from_image(example_image),
+                forecast_timestamp,
+            )
+        # zoom 10 のダウンロードに失敗したら、zoom 9 のタイルを拡大して使う
+        mock_download_content.return_value = None
+        result = asyncio.run(location_rainfall.get_location_rainfall(location, 10))
+        self.assertEqual(result["rainfall"], 80)
+        self.assertTrue(result["stale"])
+        self.assertEqual(result["tile_position"].zoom, 10)
+        self.assertEqual(mock_download_content.call_count, 1)
+        self.assertEqual(location_rainfall.requested_tiles, set())
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_get_location_history(self, mock_download_content):
+        location = Location(lat=33.903307, lon=130.933741)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            location_rainfall = LocationRainfall(archive=FrameArchive(tmpdir))
+
+            async def run():
+                result = await location_rainfall.get_location_rainfall(location)
+                await asyncio.gather(*location_rainfall.archive_tasks)
+                now = datetime.datetime.now(tz=JST)
+                return result, await location_rainfall.get_location_history(
+                    location,
+                    now - datetime.timedelta(hours=1),
+                    now,
+                )
+
+            with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+                mock_download_content.return_value = encode_image(example_image)
+                result, history = asyncio.run(run())
+        self.assertEqual(len(history["series"]), 1)
+        frame = history["series"][0]
+        self.assertEqual(frame["rainfall"], 80)
+        self.assertEqual(frame["forecast_timestamp"], result["forecast_timestamp"])
+        self.assertEqual(frame["image_url"], result["image_url"])
+
+        now = datetime.datetime(2021, 8, 2, 9, 0)
+        with self.assertRaises(ValueError):
+            asyncio.run(location_rainfall.get_location_history(
+                location,
+                now,
+                now - datetime.timedelta(minutes=5),
+            ))
+        with self.assertRaises(ValueError):
+            asyncio.run(location_rainfall.get_location_history(
+                location,
+                now - datetime.timedelta(days=8),
+                now,
+            ))
+        with self.assertRaises(ValueError):
+            asyncio.run(LocationRainfall().get_location_history(location, now, now))
+
+    def test_select_zoom(self):
+        location_rainfall = LocationRainfall()
+        self.assertEqual(location_rainfall.select_zoom(), 9)
+        self.assertEqual(location_rainfall.select_zoom(zoom=6), 6)
+        self.assertEqual(location_rainfall.select_zoom(precision=300, lats=[35.0]), 9)
+        self.assertEqual(location_rainfall.select_zoom(precision=1, lats=[35.0]), 10)
+        with self.assertRaises(ValueError):
+            location_rainfall.select_zoom(zoom=11)
+        with self.assertRaises(ValueError):
+            location_rainfall.select_zoom(precision=0)
+
 
 class TestWeatherEnum(TestCase):
 
@@ -368,10 +988,10 @@ class TestLocationRainfallResponse(TestCase):
 
 class TestApp(TestCase):
 
-    @patch.object(LocationWeatherForecast, "download_image")
-    def test_location_weather_forecast(self, mock_download_image):
+    @patch.object(LocationWeatherForecast, "download_content")
+    def test_location_weather_forecast(self, mock_download_content):
         with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as example_image:
-            mock_download_image.return_value = example_image
+            mock_download_content.return_value = encode_image(example_image)
             client = TestClient(app)
             response = client.post(
                 "/location_weather_forecast",
@@ -380,24 +1000,362 @@ class TestApp(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertEqual(response.json()["weather"], "cloudy")
 
-    @patch.object(LocationRainfall, "download_image")
-    def test_location_weather_forecast(self, mock_download_image):
+    @patch.object(LocationRainfall, "download_content")
+    def test_location_weather_forecast(self, mock_download_content):
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            client = TestClient(app)
+            response = client.post(
+                "/location_rainfall",
+                json={"lat": 33.903307, "lon": 130.933741},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["rainfall"], 80)
+
+    @patch.object(LocationWeatherForecast, "download_content")
+    def test_location_weather_forecast_batch(self, mock_download_content):
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            client = TestClient(app)
+            response = client.post(
+                "/location_weather_forecast/batch",
+                json=[
+                    {"lat": 26.206998, "lon": 127.65174},
+                    {"lat": 26.206998, "lon": 127.65174},
+                ],
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [result["weather"] for result in response.json()],
+                ["cloudy", "cloudy"],
+            )
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_location_rainfall_batch(self, mock_download_content):
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            client = TestClient(app)
+            response = client.post(
+                "/location_rainfall/batch",
+                json=[
+                    {"lat": 33.903307, "lon": 130.933741},
+                    {"lat": 33.903307, "lon": 130.933741},
+                ],
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [result["rainfall"] for result in response.json()],
+                [80, 80],
+            )
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_location_rainfall_series(self, mock_download_content):
         with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
-            mock_download_image.return_value = example_image
+            mock_download_content.return_value = encode_image(example_image)
             client = TestClient(app)
             response = client.post(
+                "/location_rainfall/series",
+                json={"lat": 33.903307, "lon": 130.933741},
+            )
+            self.assertEqual(response.status_code, 200)
+            series = response.json()["series"]
+            self.assertEqual(len(series), 13)
+            self.assertEqual(series[0]["rainfall"], 80)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_location_rainfall_zoom(self, mock_download_content):
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            client = TestClient(app)
+            response = client.post(
+                "/location_rainfall?precision=100000",
+                json={"lat": 33.903307, "lon": 130.933741},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["tile_position"]["zoom"], 4)
+            self.assertIn("/hrpns/4/", response.json()["image_url"])
+
+            response = client.post(
+                "/location_rainfall/batch?zoom=8",
+                json=[{"lat": 33.903307, "lon": 130.933741}],
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()[0]["tile_position"]["zoom"], 8)
+
+            response = client.post(
+                "/location_rainfall?zoom=11",
+                json={"lat": 33.903307, "lon": 130.933741},
+            )
+            self.assertEqual(response.status_code, 400)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_location_rainfall_get(self, mock_download_content):
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            client = TestClient(app)
+            response = client.get(
+                "/location_rainfall",
+                params={"lat": 33.903307, "lon": 130.933741},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["rainfall"], 80)
+            self.assertRegex(
+                response.headers["Cache-Control"],
+                r"^public, max-age=([1-9]\d*)$",
+            )
+            etag = response.headers["ETag"]
+            self.assertTrue(etag.startswith('W/"nowc-'))
+            self.assertTrue(etag.endswith('-9-442-204-55-177"'))
+
+            # 一致すればタイルを見ずに 304 を返す
+            call_count = mock_download_content.call_count
+            response = client.get(
+                "/location_rainfall",
+                params={"lat": 33.903307, "lon": 130.933741},
+                headers={"If-None-Match": etag},
+            )
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers["ETag"], etag)
+            self.assertIn("max-age=", response.headers["Cache-Control"])
+            self.assertEqual(mock_download_content.call_count, call_count)
+
+            response = client.get(
                 "/location_rainfall",
+                params={"lat": 33.9034, "lon": 130.9338, "snap": True},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["ETag"], etag)
+            location = response.json()["location"]
+            self.assertAlmostEqual(location["lat"], 33.9033, places=3)
+            self.assertNotEqual(location["lon"], 130.9338)
+
+    def test_location_rainfall_history(self):
+        client = TestClient(app)
+        body = {"lat": 33.903307, "lon": 130.933741}
+        response = client.post("/location_rainfall/history", json=body)
+        self.assertEqual(response.status_code, 404)
+        indices = np.zeros((256, 256), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archive = FrameArchive(tmpdir)
+            for timestamp, value in [
+                ("20210801235500", 2),
+                ("20210802000000", 8),
+                ("20210802000500", 9),
+            ]:
+                indices[:, :] = value
+                archive.append(
+                    "nowc",
+                    9,
+                    442,
+                    204,
+                    timestamp,
+                    timestamp,
+                    PixelTile.from_array(indices),
+                )
+            with patch.object(main.location_rainfall, "archive", archive):
+                response = client.post(
+                    "/location_rainfall/history",
+                    params={
+                        "start": "2021-08-02T09:00:00+09:00",
+                        "end": "2021-08-02T00:30:00Z",
+                    },
+                    json=body,
+                )
+                self.assertEqual(response.status_code, 200)
+                result = response.json()
+                self.assertEqual(result["start"], "20210802000000")
+                self.assertEqual(
+                    [frame["rainfall"] for frame in result["series"]],
+                    [80, 100],
+                )
+                # タイムゾーンのない時刻は JST として扱う
+                response = client.post(
+                    "/location_rainfall/history",
+                    params={
+                        "start": "2021-08-02T08:55:00",
+                        "end": "2021-08-02T08:55:00",
+                        "compact": True,
+                    },
+                    json=body,
+                )
+                self.assertEqual(
+                    [frame["rainfall"] for frame in response.json()["series"]],
+                    [1],
+                )
+                self.assertNotIn("tile_position", response.json())
+                response = client.post(
+                    "/location_rainfall/history",
+                    params={
+                        "start": "2021-08-02T09:00:00",
+                        "end": "2021-08-02T08:00:00",
+                    },
+                    json=body,
+                )
+                self.assertEqual(response.status_code, 400)
+
+    def test_etag_matches(self):
+        etag = 'W/"nowc-1"'
+        self.assertTrue(etag_matches('W/"nowc-1"', etag))
+        self.assertTrue(etag_matches('"nowc-1"', etag))
+        self.assertTrue(etag_matches('"a", W/"nowc-1"', etag))
+        self.assertTrue(etag_matches("*", etag))
+        self.assertFalse(etag_matches('"nowc-2"', etag))
+        self.assertFalse(etag_matches(None, etag))
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_location_rainfall_area(self, mock_download_content):
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            client = TestClient(app)
+            response = client.post(
+                "/location_rainfall/area",
+                json={"south": 33.9, "west": 130.93, "north": 33.91, "east": 130.94},
+            )
+            self.assertEqual(response.status_code, 200)
+            result = response.json()
+            self.assertEqual(sum(result["histogram"].values()), result["pixels"])
+            self.assertIn("80", result["histogram"])
+
+            response = client.post(
+                "/location_rainfall/area",
+                json={"south": 20.0, "west": 122.0, "north": 46.0, "east": 154.0},
+            )
+            self.assertEqual(response.status_code, 400)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_watch_locations(self, mock_download_content):
+        client = TestClient(app)
+        response = client.put(
+            "/watch_locations/store",
+            json={"lat": 33.903307, "lon": 130.933741},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            {"name": "store", "location": {"lat": 33.903307, "lon": 130.933741}},
+            client.get("/watch_locations").json(),
+        )
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            response = client.get("/watch_locations/store/rainfall")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["rainfall"], 80)
+
+        self.assertEqual(client.delete("/watch_locations/store").status_code, 200)
+        self.assertEqual(client.delete("/watch_locations/store").status_code, 404)
+        self.assertEqual(client.get("/watch_locations/store/rainfall").status_code, 404)
+        self.assertEqual(
+            client.get("/watch_locations/store/weather_forecast").status_code,
+            404,
+        )
+
+    def test_location_updates_invalid(self):
+        client = TestClient(app)
+        response = client.get("/location_updates?lat=33.9&lat=34.0&lon=130.9")
+        self.assertEqual(response.status_code, 400)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_location_rainfall_compact(self, mock_download_content):
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            client = TestClient(app)
+            response = client.post(
+                "/location_rainfall?compact=true",
                 json={"lat": 33.903307, "lon": 130.933741},
             )
             self.assertEqual(response.status_code, 200)
+            self.assertNotIn("tile_position", response.json())
             self.assertEqual(response.json()["rainfall"], 80)
 
+            result = asyncio.run(LocationRainfall().get_location_rainfall(
+                Location(lat=33.903307, lon=130.933741),
+            ))
+        self.assertEqual(
+            encode_result(result),
+            json.loads(LocationRainfallResponse(**result).json()),
+        )
+        self.assertEqual(
+            list(encode_result(result)),
+            list(LocationRainfallResponse.__fields__),
+        )
+
+    def test_format_now(self):
+        now = datetime.datetime(2021, 8, 2, 9, 50, 45, 123, tzinfo=JST)
+        self.assertEqual(format_now(now), ("2021/08/02 09:50:45", "2021/08/02 00:50:45"))
+        self.assertIs(format_now(now), format_now(now.replace(microsecond=999)))
+
+    @patch.object(LocationRainfall, "download_content")
+    @patch.object(LocationWeatherForecast, "download_content")
+    def test_location_weather_batch(self, mock_weather_download_content, mock_rainfall_download_content):
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as weather_image, \
+                Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as rainfall_image:
+            mock_weather_download_content.return_value = encode_image(weather_image)
+            mock_rainfall_download_content.return_value = encode_image(rainfall_image)
+            client = TestClient(app)
+            response = client.post(
+                "/location_weather/batch",
+                json={"locations": [{"lat": 33.903307, "lon": 130.933741}]},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()["weather_forecast"]), 1)
+            self.assertEqual(response.json()["rainfall"][0]["rainfall"], 80)
+
+            response = client.post(
+                "/location_weather/batch",
+                json={
+                    "locations": [{"lat": 33.903307, "lon": 130.933741}],
+                    "products": ["rainfall"],
+                },
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(response.json()["weather_forecast"])
+            self.assertEqual(response.json()["rainfall"][0]["rainfall"], 80)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_metrics(self, mock_download_content):
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            client = TestClient(app)
+            client.post(
+                "/location_rainfall",
+                json={"lat": 33.903307, "lon": 130.933741},
+            )
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+        self.assertIn('lwapi_tile_cache_entries{product="nowc"}', response.text)
+        self.assertIn('lwapi_projection_seconds_count{product="nowc"}', response.text)
+        self.assertIn(
+            'lwapi_request_seconds_count{method="POST",path="/location_rainfall",status="200"}',
+            response.text,
+        )
+
     def test_healthcheck(self):
         client = TestClient(app)
         response = client.get("/healthcheck")
         self.assertEqual(response.status_code, 200)
         assert response.json() == {"status": True}
 
+    def test_readiness(self):
+        client = TestClient(app)
+        with patch.object(main.readiness, "ready", False):
+            response = client.get("/readiness")
+            self.assertEqual(response.status_code, 503)
+            self.assertFalse(response.json()["ready"])
+        with patch.object(main.readiness, "ready", True), \
+                patch.object(main.location_weather, "fetch_failures", 5):
+            response = client.get("/readiness")
+            self.assertEqual(response.status_code, 200)
+            result = response.json()
+        self.assertTrue(result["ready"])
+        products = {status["product"]: status for status in result["products"]}
+        self.assertEqual(set(products), {"wdist", "nowc"})
+        # 既定では天気予報だけを日本全域で温める
+        self.assertEqual(products["wdist"]["warmup_tiles"], 16)
+        self.assertFalse(products["wdist"]["upstream_healthy"])
+        self.assertEqual(products["nowc"]["warmup_tiles"], 0)
+        self.assertEqual(products["nowc"]["warmth"], 1.0)
+        self.assertTrue(products["nowc"]["upstream_healthy"])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,96 @@
+import asyncio
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from metrics import CallbackMetric
+from metrics import Counter
+from metrics import Gauge
+from metrics import Histogram
+from metrics import Registry
+from metrics import RequestMetricsMiddleware
+
+
+class TestRegistry(TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        counter = registry.register(Counter("c_total", "A counter.", ["product"]))
+        gauge = registry.register(Gauge("g", "A gauge."))
+        registry.register(CallbackMetric(
+            "cb_total",
+            "A callback.",
+            ["product"],
+            lambda: {("nowc",): 3},
+            "counter",
+        ))
+        counter.inc(("nowc",))
+        counter.inc(("nowc",), 2)
+        counter.inc(('a"b',))
+        gauge.inc()
+        gauge.dec(amount=0.5)
+        self.assertEqual(
+            registry.render(),
+            "# HELP c_total A counter.\n"
+            "# TYPE c_total counter\n"
+            'c_total{product="a\\"b"} 1\n'
+            'c_total{product="nowc"} 3\n'
+            "# HELP g A gauge.\n"
+            "# TYPE g gauge\n"
+            "g 0.5\n"
+            "# HELP cb_total A callback.\n"
+            "# TYPE cb_total counter\n"
+            'cb_total{product="nowc"} 3\n',
+        )
+        with self.assertRaises(ValueError):
+            registry.register(Gauge("g", "Duplicated."))
+
+    def test_histogram(self):
+        histogram = Histogram("h_seconds", "A histogram.", ["product"], buckets=[0.1, 1])
+        histogram.observe(0.05, ("nowc",))
+        histogram.observe(0.5, ("nowc",))
+        histogram.observe(2, ("nowc",))
+        with histogram.time(("wdist",)):
+            pass
+        lines = histogram.render()
+        self.assertIn('h_seconds_bucket{product="nowc",le="0.1"} 1', lines)
+        self.assertIn('h_seconds_bucket{product="nowc",le="1"} 2', lines)
+        self.assertIn('h_seconds_bucket{product="nowc",le="+Inf"} 3', lines)
+        self.assertIn('h_seconds_sum{product="nowc"} 2.55', lines)
+        self.assertIn('h_seconds_count{product="nowc"} 3', lines)
+        self.assertIn('h_seconds_count{product="wdist"} 1', lines)
+
+
+class TestRequestMetricsMiddleware(TestCase):
+
+    def test_call(self):
+        histogram = Histogram("r_seconds", "Requests.", ["method", "path", "status"])
+
+        class Route:
+            path = "/items/{name}"
+
+        async def app(scope, receive, send):
+            scope["route"] = Route()
+            await send({"type": "http.response.start", "status": 404})
+            await send({"type": "http.response.body", "body": b"", "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+
+        async def send(message):
+            pass
+
+        middleware = RequestMetricsMiddleware(app, histogram)
+        asyncio.run(middleware({"type": "http", "method": "GET"}, None, send))
+        self.assertEqual(
+            list(histogram.counts),
+            [("GET", "/items/{name}", "404")],
+        )
+        self.assertEqual(sum(histogram.counts[("GET", "/items/{name}", "404")]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+
+import numpy as np
+from PIL import Image
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from pixel_tile import PixelTile
+
+EXAMPLE_IMAGES_DIR = HERE / "example_images"
+
+
+class TestPixelTile(TestCase):
+
+    def test_from_image(self):
+        for name in ["13.png", "204.png"]:
+            with Image.open(str(EXAMPLE_IMAGES_DIR / name)) as image:
+                tile = PixelTile.from_image(image)
+                self.assertTrue(tile.packed)
+                self.assertEqual(tile.nbytes, 256 * 256 // 2)
+                for y in range(0, 256, 7):
+                    for x in range(256):
+                        self.assertEqual(tile.get(x, y), image.getpixel((x, y)))
+                np.testing.assert_array_equal(tile.to_array(), np.asarray(image))
+
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "0.png")) as image:
+            self.assertIsNone(PixelTile.from_image(image))
+        self.assertIsNone(PixelTile.from_image(None))
+
+    def test_from_array(self):
+        indices = np.arange(256 * 256, dtype=np.uint32).reshape(256, 256) % 200
+        tile = PixelTile.from_array(indices)
+        self.assertFalse(tile.packed)
+        self.assertEqual(tile.nbytes, 256 * 256)
+        self.assertEqual(tile.get(199, 0), 199)
+        self.assertEqual(tile.get(0, 1), 56)
+        np.testing.assert_array_equal(tile.to_array(), indices)
+
+        indices = np.array([[1, 2, 3], [4, 5, 6]])
+        tile = PixelTile.from_array(indices)
+        self.assertFalse(tile.packed)
+        self.assertEqual(tile.get(2, 1), 6)
+
+    def test_get_many(self):
+        rng = np.random.default_rng(0)
+        xs = rng.integers(0, 256, 100)
+        ys = rng.integers(0, 256, 100)
+        for high in (16, 200):
+            tile = PixelTile.from_array(rng.integers(0, high, (256, 256)))
+            np.testing.assert_array_equal(
+                tile.get_many(xs, ys),
+                [tile.get(x, y) for x, y in zip(xs.tolist(), ys.tolist())],
+            )
+
+    def test_downsample(self):
+        rng = np.random.default_rng(0)
+        children = [
+            PixelTile.from_array(rng.integers(0, 10, (256, 256)))
+            for _ in range(4)
+        ]
+        tile = PixelTile.downsample(children)
+        self.assertTrue(tile.packed)
+        self.assertEqual((tile.width, tile.height), (256, 256))
+        for (x, y), child in zip([(0, 0), (1, 0), (0, 1), (1, 1)], children):
+            for px, py in [(0, 0), (5, 9), (127, 127)]:
+                self.assertEqual(
+                    tile.get(x * 128 + px, y * 128 + py),
+                    child.get(px * 2, py * 2),
+                )
+
+    def test_upsample(self):
+        rng = np.random.default_rng(0)
+        tile = PixelTile.from_array(rng.integers(0, 10, (256, 256)))
+        child = tile.upsample(1, 0)
+        self.assertEqual((child.width, child.height), (256, 256))
+        for px, py in [(0, 0), (5, 9), (255, 255)]:
+            self.assertEqual(
+                child.get(px, py),
+                tile.get(128 + px // 2, py // 2),
+            )
+        children = [tile.upsample(x, y) for x, y in [(0, 0), (1, 0), (0, 1), (1, 1)]]
+        np.testing.assert_array_equal(
+            PixelTile.downsample(children).to_array(),
+            tile.to_array(),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+from io import BytesIO
+from pathlib import Path
+import struct
+import sys
+import unittest
+from unittest import TestCase
+import zlib
+
+import numpy as np
+from PIL import Image
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from png_scanline import read_pixel
+
+EXAMPLE_IMAGES_DIR = HERE / "example_images"
+
+
+def chunk(chunk_type, data):
+    return (
+        struct.pack(">I", len(data)) + chunk_type + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+def encode_png(indices, filters, bit_depth=8):
+    """
+    パレット番号の配列を、行ごとに指定したフィルタで PNG にする
+    """
+    height, width = indices.shape
+    per_byte = 8 // bit_depth
+    rows = []
+    for y in range(height):
+        packed = np.zeros((width + per_byte - 1) // per_byte, dtype=np.uint8)
+        for x in range(width):
+            shift = 8 - bit_depth * (x % per_byte + 1)
+            packed[x // per_byte] |= indices[y, x] << shift
+        rows.append(packed.astype(np.int64))
+    data = b""
+    for y, (row, filter_type) in enumerate(zip(rows, filters)):
+        previous = rows[y - 1] if y > 0 else np.zeros_like(row)
+        left = np.concatenate([[0], row[:-1]])
+        if filter_type == 1:
+            filtered = row - left
+        elif filter_type == 2:
+            filtered = row - previous
+        elif filter_type == 3:
+            filtered = row - (left + previous) // 2
+        else:
+            filtered = row
+        data += bytes([filter_type]) + (filtered % 256).astype(np.uint8).tobytes()
+    header = struct.pack(">IIBBBBB", width, height, bit_depth, 3, 0, 0, 0)
+    palette = bytes(range(48))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"PLTE", palette)
+        + chunk(b"IDAT", zlib.compress(data))
+        + chunk(b"IEND", b"")
+    )
+
+
+class TestReadPixel(TestCase):
+
+    def test_example_images(self):
+        for name in ["13.png", "204.png"]:
+            content = (EXAMPLE_IMAGES_DIR / name).read_bytes()
+            with Image.open(str(EXAMPLE_IMAGES_DIR / name)) as image:
+                indices = np.asarray(image)
+            for y in range(0, 256, 5):
+                for x in range(0, 256, 3):
+                    self.assertEqual(read_pixel(content, x, y), indices[y, x])
+
+    def test_filters(self):
+        rng = np.random.default_rng(0)
+        for bit_depth in (4, 8):
+            indices = rng.integers(0, 16, (16, 16))
+            filters = [0, 1, 2, 2, 1, 2, 0, 2] * 2
+            content = encode_png(indices, filters, bit_depth)
+            with Image.open(BytesIO(content)) as image:
+                np.testing.assert_array_equal(np.asarray(image), indices)
+            for y in range(16):
+                for x in range(16):
+                    self.assertEqual(read_pixel(content, x, y), indices[y, x])
+
+    def test_unsupported(self):
+        indices = np.arange(16).reshape(4, 4)
+        content = encode_png(indices, [0, 3, 2, 0])
+        # Average フィルタの行や、それを Up で参照する行は読めない
+        self.assertIsNone(read_pixel(content, 1, 1))
+        self.assertIsNone(read_pixel(content, 1, 2))
+        self.assertEqual(read_pixel(content, 1, 3), 13)
+        self.assertEqual(read_pixel(content, 1, 0), 1)
+        self.assertIsNone(read_pixel(content, 4, 0))
+        self.assertIsNone(read_pixel(content[:60], 1, 3))
+        self.assertIsNone(read_pixel(b"not a png", 0, 0))
+        rgba = (EXAMPLE_IMAGES_DIR / "0.png").read_bytes()
+        self.assertIsNone(read_pixel(rgba, 0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
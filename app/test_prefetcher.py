@@ -0,0 +1,138 @@
+import asyncio
+import datetime
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from main import JST
+from main import LocationRainfall
+from main import LocationWeatherForecast
+from main import NEXT_FRAME_STEP
+from prefetcher import TilePrefetcher
+from test_helpers import encode_image
+
+EXAMPLE_IMAGES_DIR = HERE / "example_images"
+
+
+def clock():
+    return datetime.datetime(2021, 8, 1, 12, 7, 21, tzinfo=JST)
+
+
+class TestTilePrefetcher(TestCase):
+
+    def test_for_japan(self):
+        prefetcher = TilePrefetcher.for_japan(LocationWeatherForecast(), clock)
+        self.assertIn((27, 13), prefetcher.get_tiles())
+        self.assertEqual(len(prefetcher.get_tiles()), 16)
+
+    def test_for_bbox(self):
+        prefetcher = TilePrefetcher.for_bbox(
+            LocationRainfall(),
+            (33.8, 130.8, 34.0, 131.0),
+            clock,
+        )
+        self.assertEqual(prefetcher.get_tiles(), {(442, 204)})
+
+    def test_rotate_hot_tiles(self):
+        location_rainfall = LocationRainfall()
+        prefetcher = TilePrefetcher(location_rainfall, clock, tiles=[(1, 1)], hot_intervals=2)
+        location_rainfall.requested_tiles.update([(2, 2), (3, 3)])
+        prefetcher.rotate_hot_tiles()
+        self.assertEqual(location_rainfall.requested_tiles, set())
+        location_rainfall.requested_tiles.add((4, 4))
+        prefetcher.rotate_hot_tiles()
+        self.assertEqual(prefetcher.get_tiles(), {(1, 1), (2, 2), (3, 3), (4, 4)})
+        prefetcher.rotate_hot_tiles()
+        self.assertEqual(prefetcher.get_tiles(), {(1, 1), (4, 4)})
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_prefetch(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        prefetcher = TilePrefetcher(location_rainfall, clock)
+        mock_download_content.return_value = None
+        failed = asyncio.run(prefetcher.prefetch(clock(), [(442, 204), (443, 204)]))
+        self.assertEqual(failed, [(442, 204), (443, 204)])
+
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            failed = asyncio.run(prefetcher.prefetch(clock(), [(442, 204)]))
+        self.assertEqual(failed, [])
+        self.assertEqual(mock_download_content.call_count, 3)
+        self.assertIsNotNone(location_rainfall.cache.get((9, 442, 204, 0), "20210801030500"))
+        self.assertEqual(
+            mock_download_content.call_args[0][0],
+            "https://www.jma.go.jp/bosai/jmatile/data/nowc/20210801030500/none/20210801030500/surf/hrpns/9/442/204.png",
+        )
+
+    @patch.object(LocationRainfall, "download_content")
+    @patch.object(LocationRainfall, "get_next_update")
+    def test_run(self, mock_get_next_update, mock_download_content):
+        location_rainfall = LocationRainfall()
+        prefetcher = TilePrefetcher(location_rainfall, clock, tiles=[(442, 204)], delay=0)
+        mock_get_next_update.return_value = clock()
+
+        async def run():
+            prefetcher.start()
+            self.assertTrue(location_rainfall.record_requested_tiles)
+            await asyncio.sleep(0.05)
+            await prefetcher.stop()
+            self.assertFalse(location_rainfall.record_requested_tiles)
+
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            asyncio.run(run())
+        self.assertGreaterEqual(mock_download_content.call_count, 1)
+        self.assertIsNotNone(location_rainfall.cache.get((9, 442, 204, 0), "20210801030500"))
+
+
+    @patch.object(LocationWeatherForecast, "download_content")
+    def test_prefetch_next(self, mock_download_content):
+        location_weather = LocationWeatherForecast()
+        prefetcher = TilePrefetcher(location_weather, clock)
+        update = location_weather.get_next_update(clock())
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            fetched = asyncio.run(prefetcher.prefetch_next(update, [(27, 13)]))
+        self.assertEqual(fetched, 1)
+        self.assertEqual(
+            mock_download_content.call_args[0][0],
+            "https://www.jma.go.jp/bosai/jmatile/data/wdist/20210801020000/none/20210801060000/surf/wm/5/27/13.png",
+        )
+        # 現在の予報時刻のタイルとは別のキーに格納する
+        self.assertIsNone(location_weather.cache.peek((5, 27, 13, 0)))
+        self.assertEqual(
+            location_weather.cache.peek((5, 27, 13, NEXT_FRAME_STEP)).timestamp,
+            "20210801060000",
+        )
+
+    @patch.object(LocationWeatherForecast, "download_content")
+    @patch.object(LocationWeatherForecast, "get_next_update")
+    def test_run_before_update(self, mock_get_next_update, mock_download_content):
+        location_weather = LocationWeatherForecast()
+        location_weather.prefetch_lead = 0.04
+        prefetcher = TilePrefetcher(location_weather, clock, tiles=[(27, 13)])
+        mock_get_next_update.return_value = clock() + datetime.timedelta(seconds=0.05)
+
+        async def run():
+            prefetcher.start()
+            await asyncio.sleep(0.03)
+            await prefetcher.stop()
+
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as example_image:
+            mock_download_content.return_value = encode_image(example_image)
+            asyncio.run(run())
+        # 切り替わりの前に次の予報時刻のタイルを取得している
+        self.assertEqual(mock_download_content.call_count, 1)
+        self.assertIsNotNone(location_weather.cache.peek((5, 27, 13, NEXT_FRAME_STEP)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import math
+from pathlib import Path
+import random
+import sys
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from projection import TileCoordinate
+from projection import TileWindow
+from projection import pixel_size
+from projection import project
+from projection import tile_windows_in_bbox
+from projection import tiles_in_bbox
+from projection import zoom_for_precision
+
+
+def project_scalar(lat, lon, zoom):
+    lat_rad = math.radians(lat)
+    n = 2.0 ** zoom
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n
+    tile_x = int(x)
+    tile_y = int(y)
+    return (
+        x,
+        y,
+        tile_x,
+        tile_y,
+        int((x - tile_x) * 256),
+        int((y - tile_y) * 256),
+    )
+
+
+class TestProject(TestCase):
+
+    def test_project(self):
+        positions = project([26.206998], [127.65174], 5)
+        self.assertEqual(positions.x[0], 27.346821333333335)
+        self.assertEqual(positions.y[0], 13.584736664484332)
+        self.assertEqual(positions.tile_x[0], 27)
+        self.assertEqual(positions.tile_y[0], 13)
+        self.assertEqual(positions.pixel_x[0], 88)
+        self.assertEqual(positions.pixel_y[0], 149)
+
+        positions = project([33.903307], [130.933741], 9)
+        self.assertEqual(positions.tile_x[0], 442)
+        self.assertEqual(positions.tile_y[0], 204)
+        self.assertEqual(positions.pixel_x[0], 55)
+        self.assertEqual(positions.pixel_y[0], 177)
+
+    def test_project_matches_scalar(self):
+        rng = random.Random(0)
+        lats = [rng.uniform(20.0, 46.0) for _ in range(2000)]
+        lons = [rng.uniform(122.0, 154.0) for _ in range(2000)]
+        for zoom in [4, 5, 9]:
+            positions = project(lats, lons, zoom)
+            for i, (lat, lon) in enumerate(zip(lats, lons)):
+                self.assertEqual(
+                    (
+                        positions.x[i],
+                        positions.y[i],
+                        positions.tile_x[i],
+                        positions.tile_y[i],
+                        positions.pixel_x[i],
+                        positions.pixel_y[i],
+                    ),
+                    project_scalar(lat, lon, zoom),
+                )
+
+    def test_project_empty(self):
+        positions = project([], [], 5)
+        self.assertEqual(positions.tile_x.size, 0)
+
+
+class TestTilesInBbox(TestCase):
+
+    def test_tiles_in_bbox(self):
+        tiles = tiles_in_bbox(26.0, 127.0, 27.0, 128.0, 5)
+        self.assertEqual(tiles, [TileCoordinate(5, 27, 13)])
+
+        tiles = tiles_in_bbox(33.0, 130.0, 34.0, 131.0, 9)
+        self.assertEqual(len(tiles), 3 * 3)
+        self.assertIn(TileCoordinate(9, 442, 204), tiles)
+
+
+class TestTileWindowsInBbox(TestCase):
+
+    def test_tile_windows_in_bbox(self):
+        windows = tile_windows_in_bbox(33.8, 130.8, 34.0, 131.0, 9)
+        self.assertEqual(
+            [(window.tile_x, window.tile_y) for window in windows],
+            [(tile.tile_x, tile.tile_y)
+             for tile in tiles_in_bbox(33.8, 130.8, 34.0, 131.0, 9)],
+        )
+        south_west = project_scalar(33.8, 130.8, 9)
+        north_east = project_scalar(34.0, 131.0, 9)
+        pixels_x = sum(window.x1 - window.x0 for window in windows
+                       if window.tile_y == windows[0].tile_y)
+        self.assertEqual(
+            pixels_x,
+            (north_east[2] * 256 + north_east[4])
+            - (south_west[2] * 256 + south_west[4]) + 1,
+        )
+        for window in windows:
+            self.assertTrue(0 <= window.x0 < window.x1 <= 256)
+            self.assertTrue(0 <= window.y0 < window.y1 <= 256)
+
+    def test_tile_windows_in_bbox_single_pixel(self):
+        windows = tile_windows_in_bbox(33.9, 130.9, 33.9, 130.9, 9)
+        _, _, tile_x, tile_y, pixel_x, pixel_y = project_scalar(33.9, 130.9, 9)
+        self.assertEqual(
+            windows,
+            [TileWindow(9, tile_x, tile_y, pixel_x, pixel_y,
+                        pixel_x + 1, pixel_y + 1)],
+        )
+
+    def test_tile_windows_in_bbox_max_tiles(self):
+        windows = tile_windows_in_bbox(33.0, 130.0, 34.0, 131.0, 9, 9)
+        self.assertEqual(len(windows), 9)
+        with self.assertRaisesRegex(ValueError, r"covers 12 tiles"):
+            tiles_in_bbox(33.0, 130.0, 34.5, 131.0, 9, max_tiles=9)
+        # 範囲が大きすぎる場合は一覧を作る前に拒否する
+        with patch("projection.TileWindow") as mock_tile_window, \
+                patch("projection.TileCoordinate") as mock_tile_coordinate:
+            with self.assertRaisesRegex(ValueError, r"covers 1047550 tiles"):
+                tile_windows_in_bbox(-85.0, -180.0, 85.0, 180.0, 10, 256)
+        mock_tile_window.assert_not_called()
+        mock_tile_coordinate.assert_not_called()
+
+    def test_pixel_size(self):
+        self.assertAlmostEqual(pixel_size(0.0, 0), 156543.03, places=1)
+        self.assertAlmostEqual(pixel_size(60.0, 1), 39135.76, places=1)
+
+    def test_zoom_for_precision(self):
+        self.assertEqual(zoom_for_precision(5000, [35.0], 4, 10), 5)
+        self.assertEqual(zoom_for_precision(300, [35.0], 4, 10), 9)
+        self.assertEqual(zoom_for_precision(260, [35.0], 4, 10), 9)
+        self.assertEqual(zoom_for_precision(260, [35.0, 26.0], 4, 10), 10)
+        self.assertEqual(zoom_for_precision(10 ** 6, [35.0], 4, 10), 4)
+        self.assertEqual(zoom_for_precision(1, [35.0], 4, 10), 10)
+        self.assertEqual(zoom_for_precision(5000, [], 2, 5), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
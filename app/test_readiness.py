@@ -0,0 +1,115 @@
+import asyncio
+import datetime
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from main import JST
+from main import LocationRainfall
+from prefetcher import TilePrefetcher
+from readiness import Readiness
+from test_helpers import encode_image
+from tile_fetcher import TileNotFound
+
+EXAMPLE_IMAGES_DIR = HERE / "example_images"
+
+
+def clock():
+    return datetime.datetime.now(tz=JST)
+
+
+class TestReadiness(TestCase):
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_warm_up(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        warmer = TilePrefetcher(
+            location_rainfall,
+            clock,
+            tiles=[(442, 204), (443, 204)],
+        )
+        readiness = Readiness([warmer], min_warmth=1.0, retry_interval=0.0)
+        self.assertFalse(readiness.ready)
+        self.assertEqual(readiness.get_warmth(warmer), (2, 0))
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            # 1 枚目は 1 回目の取得に失敗し、2 回目で取得できる
+            mock_download_content.side_effect = [
+                None,
+                encode_image(example_image),
+                encode_image(example_image),
+            ]
+            asyncio.run(readiness.warm_up())
+        self.assertTrue(readiness.ready)
+        self.assertFalse(readiness.warming_up)
+        self.assertEqual(readiness.get_warmth(warmer), (2, 2))
+        self.assertEqual(mock_download_content.call_count, 3)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_warm_up_min_warmth(self, mock_download_content):
+        location_rainfall = LocationRainfall()
+        warmer = TilePrefetcher(
+            location_rainfall,
+            clock,
+            tiles=[(442, 204), (443, 204)],
+        )
+        readiness = Readiness([warmer], min_warmth=0.5, retry_interval=0.0)
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as example_image:
+            mock_download_content.side_effect = [encode_image(example_image), None]
+            asyncio.run(readiness.warm_up())
+        self.assertTrue(readiness.ready)
+        self.assertEqual(readiness.get_warmth(warmer), (2, 1))
+        self.assertEqual(mock_download_content.call_count, 2)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_warm_up_timeout(self, mock_download_content):
+        now = 0.0
+
+        def monotonic():
+            return now
+
+        async def download_content(url):
+            nonlocal now
+            now += 10.0
+            return None
+
+        mock_download_content.side_effect = download_content
+        warmer = TilePrefetcher(LocationRainfall(), clock, tiles=[(442, 204)])
+        readiness = Readiness(
+            [warmer],
+            timeout=25.0,
+            retry_interval=0.0,
+            clock=monotonic,
+        )
+        asyncio.run(readiness.warm_up())
+        # 気象庁から取得できなくても、timeout 秒が経てば ready にする
+        self.assertTrue(readiness.ready)
+        self.assertEqual(readiness.get_warmth(warmer), (1, 0))
+        self.assertEqual(mock_download_content.call_count, 3)
+
+    @patch.object(LocationRainfall, "download_content")
+    def test_warm_up_not_found(self, mock_download_content):
+        mock_download_content.side_effect = TileNotFound("404")
+        warmer = TilePrefetcher(LocationRainfall(), clock, tiles=[(442, 204)])
+        readiness = Readiness([warmer], min_warmth=1.0, retry_interval=0.0)
+        asyncio.run(readiness.warm_up())
+        # 存在しないタイルは温まったものとして扱い、取得し直さない
+        self.assertTrue(readiness.ready)
+        self.assertEqual(readiness.get_warmth(warmer), (1, 1))
+        self.assertEqual(mock_download_content.call_count, 1)
+
+    def test_warm_up_without_warmers(self):
+        readiness = Readiness([])
+        asyncio.run(readiness.warm_up())
+        self.assertTrue(readiness.ready)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import asyncio
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from single_flight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+
+    def test_do(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def work(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value * 2
+
+        async def run():
+            results = await asyncio.gather(
+                single_flight.do("a", work, 1),
+                single_flight.do("a", work, 1),
+                single_flight.do("b", work, 2),
+            )
+            self.assertEqual(results, [2, 2, 4])
+            self.assertEqual(len(single_flight), 0)
+            self.assertEqual(await single_flight.do("a", work, 3), 6)
+
+        asyncio.run(run())
+        self.assertEqual(calls, [1, 2, 3])
+
+    def test_do_exception(self):
+        single_flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("failed")
+
+        async def run():
+            results = await asyncio.gather(
+                single_flight.do("a", fail),
+                single_flight.do("a", fail),
+                return_exceptions=True,
+            )
+            for result in results:
+                self.assertIsInstance(result, RuntimeError)
+            self.assertEqual(len(single_flight), 0)
+
+        asyncio.run(run())
+
+    def test_do_cancelled_caller(self):
+        single_flight = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.02)
+            return "done"
+
+        async def run():
+            first = asyncio.ensure_future(single_flight.do("a", work))
+            second = asyncio.ensure_future(single_flight.do("a", work))
+            await asyncio.sleep(0)
+            first.cancel()
+            self.assertEqual(await second, "done")
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from main import JST
+from main import Location
+from main import LocationRainfall
+from main import TilePosition
+from main import format_event
+from pixel_tile import PixelTile
+from subscription import LocationSubscription
+
+
+def clock():
+    return datetime.datetime(2021, 8, 1, 12, 7, 21, tzinfo=JST)
+
+
+class TestLocationSubscription(TestCase):
+
+    def test_events(self):
+        location_rainfall = LocationRainfall()
+        positions = TilePosition.from_locations(
+            [Location(lat=33.903307, lon=130.933741), Location(lat=33.9, lon=130.9)],
+            location_rainfall.zoom,
+        )
+        indices = np.zeros((256, 256), dtype=np.uint8)
+        indices[positions[0].pixel_y, positions[0].pixel_x] = 8
+        subscription = LocationSubscription({location_rainfall: positions}, clock)
+
+        async def scenario():
+            events = subscription.events(keepalive=0.05)
+            initial = [await events.__anext__(), await events.__anext__()]
+            self.assertEqual(
+                sorted((event["index"], event["rainfall"]) for event in initial),
+                [(0, 80), (1, 0)],
+            )
+            self.assertIn(subscription.on_tile, location_rainfall.tile_listeners)
+
+            # 値が変わらなければイベントは送らない
+            location_rainfall.notify_tile(
+                positions[0],
+                PixelTile.from_array(indices),
+                "20210801030500",
+                "20210801031000",
+            )
+            self.assertIsNone(await events.__anext__())
+
+            indices[positions[1].pixel_y, positions[1].pixel_x] = 9
+            location_rainfall.notify_tile(
+                positions[0],
+                PixelTile.from_array(indices),
+                "20210801031000",
+                "20210801031000",
+            )
+            event = await events.__anext__()
+            self.assertEqual(event["index"], 1)
+            self.assertEqual(event["rainfall"], 100)
+            self.assertEqual(event["forecast_timestamp"], "20210801031000")
+            await events.aclose()
+
+        with patch.object(location_rainfall, "download_tile") as mock_download_tile:
+            mock_download_tile.return_value = PixelTile.from_array(indices)
+            asyncio.run(scenario())
+        self.assertEqual(mock_download_tile.call_count, 1)
+        self.assertEqual(location_rainfall.tile_listeners, set())
+
+    def test_format_event(self):
+        self.assertEqual(format_event(None), ": keepalive\n\n")
+        self.assertEqual(
+            format_event({
+                "event": "rainfall",
+                "index": 0,
+                "location": Location(lat=1.0, lon=2.0),
+                "rainfall": 80,
+            }),
+            'event: rainfall\n'
+            'data: {"index": 0, "location": {"lat": 1.0, "lon": 2.0}, "rainfall": 80}\n\n',
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
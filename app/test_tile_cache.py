@@ -0,0 +1,102 @@
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+
+from PIL import Image
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from test_helpers import FakeClock
+from tile_cache import TileCache
+from tile_cache import estimate_size
+
+EXAMPLE_IMAGES_DIR = HERE / "example_images"
+
+
+class TestEstimateSize(TestCase):
+
+    def test_estimate_size(self):
+        self.assertEqual(estimate_size(None), 0)
+        self.assertEqual(estimate_size(b"abc"), 3)
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "13.png")) as image:
+            self.assertEqual(estimate_size(image), 256 * 256)
+
+
+class TestTileCache(TestCase):
+
+    def test_get_set(self):
+        cache = TileCache()
+        self.assertIsNone(cache.get((1, 2), "20210801000000"))
+        cache.set((1, 2), b"image", "20210801000000")
+        entry = cache.get((1, 2), "20210801000000")
+        self.assertEqual(entry.value, b"image")
+        self.assertEqual(entry.timestamp, "20210801000000")
+        self.assertIsNone(cache.get((1, 2), "20210801030000"))
+        self.assertIsNotNone(cache.get((1, 2)))
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_max_entries(self):
+        cache = TileCache(max_entries=2)
+        cache.set("a", b"1", "0")
+        cache.set("b", b"2", "0")
+        cache.get("a")
+        cache.set("c", b"3", "0")
+        self.assertEqual(set(cache), {"a", "c"})
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_max_bytes(self):
+        cache = TileCache(max_bytes=10)
+        cache.set("a", b"12345", "0")
+        cache.set("b", b"12345", "0")
+        self.assertEqual(cache.bytes, 10)
+        cache.set("a", b"123456", "0")
+        self.assertEqual(set(cache), {"a"})
+        self.assertEqual(cache.bytes, 6)
+        cache.set("c", b"12345678901", "0")
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.bytes, 0)
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = TileCache(ttl=300, clock=clock)
+        cache.set("a", b"1", "0")
+        clock.now = 299
+        self.assertIsNotNone(cache.get("a"))
+        clock.now = 300
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_stale(self):
+        clock = FakeClock()
+        cache = TileCache(clock=clock)
+        cache.set("a", b"old", "0")
+        self.assertIsNone(cache.get("a", "1"))
+        self.assertEqual(cache.peek("a").value, b"old")
+        cache.set("a", b"old", "1", stale=True, retry_after=30)
+        entry = cache.get("a", "1")
+        self.assertTrue(entry.stale)
+        self.assertEqual(entry.value, b"old")
+        clock.now = 30
+        self.assertIsNone(cache.get("a", "1"))
+        self.assertTrue(cache.peek("a").stale)
+        cache.set("a", b"new", "1")
+        self.assertFalse(cache.get("a", "1").stale)
+
+    def test_pop_clear(self):
+        cache = TileCache()
+        cache.set("a", b"1", "0")
+        cache.set("b", b"2", "0")
+        self.assertEqual(cache.pop("a").value, b"1")
+        self.assertIsNone(cache.pop("a"))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.bytes, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
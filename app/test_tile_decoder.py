@@ -0,0 +1,60 @@
+import asyncio
+from pathlib import Path
+import sys
+import threading
+import unittest
+from unittest import TestCase
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from tile_decoder import TileDecoder
+
+
+class TestTileDecoder(TestCase):
+
+    def test_run(self):
+        decoder = TileDecoder(max_workers=2)
+
+        async def run():
+            return await decoder.run(lambda value: (
+                value * 2,
+                threading.current_thread() is threading.main_thread(),
+            ), 21)
+
+        self.assertEqual(asyncio.run(run()), (42, False))
+        self.assertEqual(decoder.pending, 0)
+        decoder.shutdown()
+
+    def test_run_error(self):
+        decoder = TileDecoder()
+
+        def fail():
+            raise ValueError("broken image")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(decoder.run(fail))
+        self.assertEqual(decoder.pending, 0)
+        decoder.shutdown()
+
+    def test_max_pending(self):
+        decoder = TileDecoder(max_workers=2, max_pending=1)
+        release = threading.Event()
+
+        async def run():
+            first = asyncio.ensure_future(decoder.run(release.wait))
+            second = asyncio.ensure_future(decoder.run(release.wait))
+            await asyncio.sleep(0.01)
+            # 2 つ目はプールに投入されずに空きを待つ
+            self.assertEqual((decoder.pending, decoder.waiting), (1, 1))
+            release.set()
+            return await asyncio.gather(first, second)
+
+        self.assertEqual(asyncio.run(run()), [True, True])
+        self.assertEqual((decoder.pending, decoder.waiting), (0, 0))
+        decoder.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+import asyncio
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+
+import httpx
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from tile_fetcher import TileFetcher
+from tile_fetcher import TileNotFound
+
+EXAMPLE_IMAGES_DIR = HERE / "example_images"
+
+
+class TestTileFetcher(TestCase):
+
+    def test_fetch(self):
+        content = (EXAMPLE_IMAGES_DIR / "13.png").read_bytes()
+
+        def handler(request):
+            if request.url.path.endswith("/13.png"):
+                return httpx.Response(200, content=content)
+            if request.url.path.endswith("/error.png"):
+                raise httpx.ConnectError("connection refused")
+            if request.url.path.endswith("/503.png"):
+                return httpx.Response(503)
+            if request.url.path.endswith("/429.png"):
+                return httpx.Response(429)
+            if request.url.path.endswith("/403.png"):
+                return httpx.Response(403)
+            return httpx.Response(404)
+
+        fetcher = TileFetcher(transport=httpx.MockTransport(handler))
+
+        async def run():
+            with self.assertLogs("fastapi", level="INFO") as cm:
+                self.assertEqual(await fetcher.fetch("https://example.com/13.png"), content)
+                self.assertTrue("successful image download from" in cm.output[0])
+
+            with self.assertLogs("fastapi", level="WARNING") as cm:
+                self.assertIsNone(await fetcher.fetch("https://example.com/503.png"))
+                self.assertTrue("unexpected response 503" in cm.output[0])
+
+            with self.assertLogs("fastapi", level="WARNING"):
+                self.assertIsNone(await fetcher.fetch("https://example.com/429.png"))
+
+            # 存在しないタイルは通信エラーと区別する
+            for url in ["https://example.com/404.png", "https://example.com/403.png"]:
+                with self.assertRaises(TileNotFound):
+                    await fetcher.fetch(url)
+
+            with self.assertLogs("fastapi", level="ERROR") as cm:
+                self.assertIsNone(await fetcher.fetch("https://example.com/error.png"))
+                self.assertTrue("failed to download image from" in cm.output[0])
+
+            await fetcher.aclose()
+
+        asyncio.run(run())
+
+    def test_fetch_conditional(self):
+        content = (EXAMPLE_IMAGES_DIR / "13.png").read_bytes()
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            if request.url.path.endswith("/etag.png"):
+                if request.headers.get("If-None-Match") == '"v1"':
+                    return httpx.Response(304)
+                return httpx.Response(200, content=content, headers={"ETag": '"v1"'})
+            if request.url.path.endswith("/modified.png"):
+                if request.headers.get("If-Modified-Since") == "Mon, 02 Aug 2021 00:00:00 GMT":
+                    return httpx.Response(304)
+                return httpx.Response(
+                    200,
+                    content=content,
+                    headers={"Last-Modified": "Mon, 02 Aug 2021 00:00:00 GMT"},
+                )
+            return httpx.Response(200, content=content)
+
+        fetcher = TileFetcher(transport=httpx.MockTransport(handler), max_validators=1)
+
+        async def run():
+            for _ in range(2):
+                self.assertEqual(await fetcher.fetch("https://example.com/etag.png"), content)
+            self.assertEqual(fetcher.not_modified, 1)
+            self.assertNotIn("If-None-Match", requests[0].headers)
+
+            for _ in range(2):
+                self.assertEqual(await fetcher.fetch("https://example.com/modified.png"), content)
+            self.assertEqual(fetcher.not_modified, 2)
+            self.assertEqual(list(fetcher.validators), ["https://example.com/modified.png"])
+
+            await fetcher.fetch("https://example.com/plain.png")
+            await fetcher.fetch("https://example.com/plain.png")
+            self.assertNotIn("If-None-Match", requests[-1].headers)
+            self.assertNotIn("If-Modified-Since", requests[-1].headers)
+            self.assertEqual(fetcher.not_modified, 2)
+            await fetcher.aclose()
+
+        asyncio.run(run())
+
+    def test_fetch_not_modified_after_eviction(self):
+        content = (EXAMPLE_IMAGES_DIR / "13.png").read_bytes()
+
+        async def handler(request):
+            if request.headers.get("If-None-Match") == '"v1"':
+                # 応答を待っている間に、他の取得が検証子を追い出す
+                await asyncio.sleep(0.01)
+                return httpx.Response(304)
+            return httpx.Response(200, content=content, headers={"ETag": '"v1"'})
+
+        fetcher = TileFetcher(transport=httpx.MockTransport(handler), max_validators=1)
+
+        async def run():
+            await fetcher.fetch("https://example.com/1.png")
+            results = await asyncio.gather(
+                fetcher.fetch("https://example.com/1.png"),
+                fetcher.fetch("https://example.com/2.png"),
+            )
+            self.assertEqual(results, [content, content])
+            self.assertEqual(fetcher.not_modified, 1)
+            self.assertEqual(list(fetcher.validators), ["https://example.com/1.png"])
+            await fetcher.aclose()
+
+        asyncio.run(run())
+
+    def test_max_validator_bytes(self):
+        content = (EXAMPLE_IMAGES_DIR / "13.png").read_bytes()
+
+        def handler(request):
+            return httpx.Response(200, content=content, headers={"ETag": '"v1"'})
+
+        fetcher = TileFetcher(
+            transport=httpx.MockTransport(handler),
+            max_validator_bytes=len(content) * 2,
+        )
+
+        async def run():
+            for i in range(3):
+                await fetcher.fetch(f"https://example.com/{i}.png")
+            await fetcher.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(
+            list(fetcher.validators),
+            ["https://example.com/1.png", "https://example.com/2.png"],
+        )
+        self.assertEqual(fetcher.validators.stats()["bytes"], len(content) * 2)
+
+    def test_max_concurrency(self):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def handler(request):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return httpx.Response(200, content=b"")
+
+        fetcher = TileFetcher(
+            max_concurrency=2,
+            transport=httpx.MockTransport(handler),
+        )
+
+        async def run():
+            await asyncio.gather(*[
+                fetcher.fetch(f"https://example.com/{i}.png")
+                for i in range(6)
+            ])
+            await fetcher.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(max_in_flight, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
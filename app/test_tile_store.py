@@ -0,0 +1,195 @@
+import asyncio
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+import unittest
+from unittest import TestCase
+
+from PIL import Image
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from pixel_tile import PixelTile
+from tile_store import DiskTileStore
+from tile_store import MemoryTileStore
+from tile_store import TileKey
+from tile_store import locked
+
+EXAMPLE_IMAGES_DIR = HERE / "example_images"
+
+KEY = TileKey("nowc", "20210801030500", "20210801030500", 9, 442, 204)
+
+
+class TestDiskTileStore(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        with Image.open(str(EXAMPLE_IMAGES_DIR / "204.png")) as image:
+            self.tile = PixelTile.from_image(image)
+
+    def test_get_path(self):
+        store = DiskTileStore(self.tmpdir.name)
+        self.assertEqual(
+            store.get_segment_path(KEY),
+            Path(self.tmpdir.name) / "nowc/20210801030500/20210801030500.seg",
+        )
+        self.assertEqual(
+            store.get_lock_path(KEY),
+            Path(self.tmpdir.name) / "nowc/20210801030500/20210801030500/9/442/204.lock",
+        )
+
+    def test_put_get(self):
+        store = DiskTileStore(self.tmpdir.name)
+        self.assertIsNone(store.get(KEY))
+        store.put(KEY, self.tile)
+        self.assertIsNone(store.get(KEY._replace(tile_y=205)))
+        small = PixelTile.from_array([[1, 2], [3, 20]])
+        store.put(KEY._replace(tile_y=205), small)
+        tile = store.get(KEY)
+        self.assertEqual(tile.width, 256)
+        self.assertEqual(tile.height, 256)
+        self.assertTrue(tile.packed)
+        self.assertEqual(tile.nbytes, self.tile.nbytes)
+        self.assertEqual(tile.get(55, 177), self.tile.get(55, 177))
+        self.assertTrue((tile.to_array() == self.tile.to_array()).all())
+        tile = store.get(KEY._replace(tile_y=205))
+        self.assertFalse(tile.packed)
+        self.assertEqual(tile.to_array().tolist(), [[1, 2], [3, 20]])
+        # 別のワーカーが書いたタイルも読める
+        other = DiskTileStore(self.tmpdir.name)
+        self.assertEqual(other.get(KEY).get(55, 177), self.tile.get(55, 177))
+        self.assertEqual(len(os.listdir(store.get_segment_path(KEY).parent)), 1)
+
+    def test_put_grows_segment(self):
+        store = DiskTileStore(self.tmpdir.name)
+        keys = [KEY._replace(tile_y=tile_y) for tile_y in range(100)]
+        store.put(keys[0], self.tile)
+        self.assertIsNotNone(store.get(keys[0]))
+        for key in keys[1:]:
+            store.put(key, self.tile)
+        for key in keys:
+            self.assertEqual(store.get(key).get(55, 177), self.tile.get(55, 177))
+        self.assertGreater(
+            os.path.getsize(store.get_segment_path(KEY)), 100 * 256 * 128
+        )
+
+    def test_put_invalid(self):
+        store = DiskTileStore(self.tmpdir.name)
+        with self.assertRaises(ValueError):
+            store.put(KEY, PixelTile(256, 256, True, b"\0" * 100))
+        self.assertIsNone(store.get(KEY))
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs /proc/self/fd")
+    def test_get_keeps_one_file_descriptor_per_segment(self):
+        store = DiskTileStore(self.tmpdir.name)
+        keys = [KEY._replace(tile_y=tile_y) for tile_y in range(50)]
+        for key in keys:
+            store.put(key, self.tile)
+        before = len(os.listdir("/proc/self/fd"))
+        tiles = [store.get(key) for key in keys]
+        self.assertLessEqual(len(os.listdir("/proc/self/fd")), before + 1)
+        for tile in tiles:
+            self.assertEqual(tile.get(55, 177), self.tile.get(55, 177))
+
+    def test_get_invalid(self):
+        store = DiskTileStore(self.tmpdir.name)
+        path = store.get_segment_path(KEY)
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b"")
+        self.assertIsNone(store.get(KEY))
+        path.write_bytes(b"NOT A TILE SEGMENT FILE")
+        with self.assertLogs("fastapi", level="WARNING"):
+            self.assertIsNone(store.get(KEY))
+
+    def test_get_truncated(self):
+        store = DiskTileStore(self.tmpdir.name)
+        store.put(KEY, self.tile)
+        path = store.get_segment_path(KEY)
+        content = path.read_bytes()
+        path.unlink()
+        path.write_bytes(content[:16 + 24 + 1000])
+        self.assertIsNone(DiskTileStore(self.tmpdir.name).get(KEY))
+
+    def test_prune(self):
+        store = DiskTileStore(self.tmpdir.name)
+        store.put(KEY, self.tile)
+        old_key = KEY._replace(forecast_timestamp="20210801030000")
+        store.put(old_key, self.tile)
+        self.assertIsNotNone(store.get(old_key))
+        old = time.time() - 120
+        os.utime(store.get_segment_path(old_key), (old, old))
+        self.assertEqual(store.prune(60), 1)
+        self.assertIsNone(store.get(old_key))
+        self.assertIsNotNone(store.get(KEY))
+        self.assertFalse(store.get_segment_path(old_key).exists())
+
+    def test_try_lock(self):
+        store = DiskTileStore(self.tmpdir.name)
+        handle = store.try_lock(KEY)
+        self.assertIsNotNone(handle)
+        self.assertIsNone(store.try_lock(KEY))
+        other = store.try_lock(KEY._replace(tile_y=205))
+        self.assertIsNotNone(other)
+        store.unlock(handle)
+        store.unlock(other)
+        handle = store.try_lock(KEY)
+        self.assertIsNotNone(handle)
+        store.unlock(handle)
+
+
+class TestMemoryTileStore(TestCase):
+
+    def test_put_get(self):
+        store = MemoryTileStore()
+        tile = PixelTile.from_array([[1, 2], [3, 4]])
+        self.assertIsNone(store.get(KEY))
+        store.put(KEY, tile)
+        self.assertIs(store.get(KEY), tile)
+
+    def test_try_lock(self):
+        store = MemoryTileStore()
+        handle = store.try_lock(KEY)
+        self.assertIsNotNone(handle)
+        self.assertIsNone(store.try_lock(KEY))
+        store.unlock(handle)
+        store.unlock(store.try_lock(KEY))
+
+
+class TestLocked(TestCase):
+
+    def test_locked(self):
+        store = MemoryTileStore()
+        order = []
+
+        async def worker(name):
+            async with locked(store, KEY, interval=0.001) as acquired:
+                self.assertTrue(acquired)
+                order.append(f"{name} start")
+                await asyncio.sleep(0.01)
+                order.append(f"{name} end")
+
+        async def run():
+            await asyncio.gather(worker("a"), worker("b"))
+
+        asyncio.run(run())
+        self.assertEqual(order, ["a start", "a end", "b start", "b end"])
+
+    def test_locked_timeout(self):
+        store = MemoryTileStore()
+        handle = store.try_lock(KEY)
+
+        async def run():
+            async with locked(store, KEY, timeout=0.01, interval=0.001) as acquired:
+                self.assertFalse(acquired)
+
+        asyncio.run(run())
+        store.unlock(handle)
+
+
+if __name__ == "__main__":
+    unittest.main()
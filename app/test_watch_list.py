@@ -0,0 +1,66 @@
+from pathlib import Path
+import sys
+import unittest
+from unittest import TestCase
+
+import numpy as np
+
+HERE = Path(__file__).resolve().parent
+
+sys.path.append(str(HERE))
+
+from pixel_tile import PixelTile
+from watch_list import WatchList
+
+
+class Position:
+
+    def __init__(self, tile_x, tile_y, pixel_x, pixel_y):
+        self.tile_x = tile_x
+        self.tile_y = tile_y
+        self.pixel_x = pixel_x
+        self.pixel_y = pixel_y
+
+
+class TestWatchList(TestCase):
+
+    def test_add_remove(self):
+        watches = WatchList()
+        watches.add("a", Position(1, 2, 0, 0))
+        watches.add("b", Position(1, 2, 1, 0))
+        watches.add("c", Position(3, 4, 0, 0))
+        self.assertEqual(len(watches), 3)
+        self.assertEqual(watches.tiles(), {(1, 2), (3, 4)})
+
+        watches.add("c", Position(1, 2, 2, 0))
+        self.assertEqual(watches.tiles(), {(1, 2)})
+        self.assertIsNotNone(watches.remove("a"))
+        self.assertIsNone(watches.remove("a"))
+        self.assertNotIn("a", watches)
+        watches.remove("b")
+        watches.remove("c")
+        self.assertEqual(watches.tiles(), set())
+
+    def test_update(self):
+        watches = WatchList()
+        watches.add("a", Position(1, 2, 0, 0))
+        watches.add("b", Position(1, 2, 1, 3))
+        watches.add("c", Position(3, 4, 0, 0))
+        indices = np.zeros((256, 256), dtype=np.uint8)
+        indices[0, 0] = 8
+        indices[3, 1] = 5
+        watches.update(1, 2, PixelTile.from_array(indices), "o", "f")
+        self.assertEqual(watches.values["a"].pixel_value, 8)
+        self.assertEqual(watches.values["b"].pixel_value, 5)
+        self.assertEqual(watches.values["b"].forecast_timestamp, "f")
+        self.assertNotIn("c", watches.values)
+
+        watches.update(1, 2, None, "o", "g", stale=True)
+        self.assertEqual(watches.values["a"].pixel_value, 0)
+        self.assertTrue(watches.values["a"].stale)
+        watches.update(9, 9, None, "o", "g")
+        self.assertNotIn("c", watches.values)
+
+
+if __name__ == "__main__":
+    unittest.main()
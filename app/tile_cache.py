@@ -0,0 +1,198 @@
+from collections import OrderedDict
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+from typing import Iterator
+from typing import Optional
+
+
+def estimate_size(value: Any) -> int:
+    """
+    キャッシュする値のおおよそのバイト数を返す
+    """
+    if value is None:
+        return 0
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if hasattr(value, "width") and hasattr(value, "getbands"):
+        # PIL.Image は展開後のピクセルデータの大きさで見積もる
+        return value.width * value.height * len(value.getbands())
+    return len(value)
+
+
+class TileCacheEntry:
+    """
+    タイルキャッシュの 1 エントリ
+
+    stale なエントリは、timestamp の値の取得に失敗したために古い値を
+    入れているもので、retry_at を過ぎるとミス扱いになる。
+    """
+    __slots__ = (
+        "value",
+        "timestamp",
+        "size",
+        "expires_at",
+        "stale",
+        "retry_at",
+    )
+
+    def __init__(
+        self,
+        value: Any,
+        timestamp: str,
+        size: int,
+        expires_at: Optional[float],
+        stale: bool = False,
+        retry_at: Optional[float] = None,
+    ):
+        self.value = value
+        self.timestamp = timestamp
+        self.size = size
+        self.expires_at = expires_at
+        self.stale = stale
+        self.retry_at = retry_at
+
+
+class TileCache:
+    """
+    エントリ数とバイト数の上限を持つ LRU のタイルキャッシュ
+
+    エントリは書き込みから ttl 秒で期限切れになる。ttl には各プロダクトの
+    画像の更新間隔を与える想定。ヒット、ミス、追い出しの回数を記録する。
+
+    取得に失敗した場合は、直前の値を stale として短い間だけ格納できる
+    (ネガティブキャッシュ)。期限が来るとミスになるが、エントリ自体は
+    次に取得に成功するまでの代わりの値として残る。
+    """
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        sizeof: Callable[[Any], int] = estimate_size,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.clock = clock
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: "OrderedDict[Hashable, TileCacheEntry]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(list(self._entries))
+
+    def get(
+        self,
+        key: Hashable,
+        timestamp: Optional[str] = None,
+    ) -> Optional[TileCacheEntry]:
+        """
+        key のエントリを返す。期限切れか、timestamp より古いエントリしかなければ
+        None を返す
+        """
+        entry = self._entries.get(key)
+        if entry is not None and self._is_expired(entry):
+            self._remove(key)
+            self.expirations += 1
+            entry = None
+        if entry is None or (
+            timestamp is not None and entry.timestamp < timestamp
+        ) or (
+            entry.stale and entry.retry_at <= self.clock()
+        ):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def peek(self, key: Hashable) -> Optional[TileCacheEntry]:
+        """
+        key のエントリを期限や統計に関係なくそのまま返す
+        """
+        return self._entries.get(key)
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        timestamp: str,
+        stale: bool = False,
+        retry_after: float = 0.0,
+    ):
+        """
+        key に値を格納し、上限を超えた分を古い順に追い出す。
+        stale が真なら retry_after 秒後にミス扱いにする
+        """
+        if key in self._entries:
+            self._remove(key)
+        now = self.clock()
+        entry = TileCacheEntry(
+            value,
+            timestamp,
+            self.sizeof(value),
+            None if self.ttl is None else now + self.ttl,
+            stale,
+            now + retry_after if stale else None,
+        )
+        self._entries[key] = entry
+        self.bytes += entry.size
+        self._evict()
+
+    def pop(self, key: Hashable) -> Optional[TileCacheEntry]:
+        """
+        key のエントリを取り除いて返す
+        """
+        if key not in self._entries:
+            return None
+        return self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        キャッシュの統計情報を返す
+        """
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _is_expired(self, entry: TileCacheEntry) -> bool:
+        return entry.expires_at is not None and entry.expires_at <= self.clock()
+
+    def _remove(self, key: Hashable) -> TileCacheEntry:
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+        return entry
+
+    def _evict(self):
+        while self._entries and (
+            (self.max_entries is not None
+             and len(self._entries) > self.max_entries)
+            or
+            (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= entry.size
+            self.evictions += 1
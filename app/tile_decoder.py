@@ -0,0 +1,64 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Optional
+
+
+class TileDecoder:
+    """
+    タイル画像のデコードをイベントループの外のスレッドプールで行う
+
+    PNG の展開とデコードは GIL を解放するので、スレッドでも並列に進む。
+    プールに投入するのは同時に max_pending 件までで、それを超えた分は
+    イベントループ上で空きを待つ。セマフォはイベントループ上で初めて
+    使われた時に生成する。
+    """
+    def __init__(self, max_workers: int = 4, max_pending: int = 64):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.waiting = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="tile-decoder",
+            )
+        return self._executor
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+        return self._semaphore
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        func(*args) をスレッドプールで実行して結果を返す
+        """
+        self.waiting += 1
+        try:
+            await self._get_semaphore().acquire()
+        finally:
+            self.waiting -= 1
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(),
+                func,
+                *args,
+            )
+        finally:
+            self.pending -= 1
+            self._get_semaphore().release()
+
+    def shutdown(self):
+        """
+        スレッドプールを止める。実行中のデコードは待たない
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
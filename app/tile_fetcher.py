@@ -0,0 +1,153 @@
+import asyncio
+from typing import NamedTuple
+from typing import Optional
+
+from fastapi.logger import logger
+import httpx
+
+from tile_cache import TileCache
+
+# 4xx のうち、時間を置けば成功しうる応答 (Request Timeout, Too Many Requests)
+TRANSIENT_CLIENT_ERRORS = (408, 429)
+
+
+class TileNotFound(Exception):
+    """
+    タイル画像が存在しない (404 など) ことを表す。気象庁の提供範囲外のタイルなどで、
+    再取得しても結果は変わらない
+    """
+
+
+class Validators(NamedTuple):
+    """
+    条件付きリクエストに使う、前回の応答の検証子と内容
+    """
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content: bytes
+
+
+class TileFetcher:
+    """
+    気象庁のタイル画像を非同期に取得する HTTP クライアント
+
+    keep-alive 接続をプールした httpx.AsyncClient を全プロダクトで共有し、
+    同時取得数をセマフォで制限する。クライアントとセマフォはイベントループ上で
+    初めて使われた時に生成する。
+
+    ETag か Last-Modified を返した URL は、検証子と内容を最大 max_validators 件、
+    内容の合計で max_validator_bytes バイトまで保持し、次に同じ URL を
+    取得するときは条件付きリクエストにする。
+    304 が返ってきたら保持している内容を返すので、本文を再度受信しない。
+    """
+    def __init__(
+        self,
+        timeout: float = 1.0,
+        connect_timeout: Optional[float] = None,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        max_concurrency: int = 10,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        max_validators: int = 4096,
+        max_validator_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.timeout = httpx.Timeout(
+            timeout,
+            connect=timeout if connect_timeout is None else connect_timeout,
+        )
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        self.max_concurrency = max_concurrency
+        self.transport = transport
+        self.validators = TileCache(
+            max_entries=max_validators,
+            max_bytes=max_validator_bytes,
+            sizeof=lambda validators: len(validators.content),
+        )
+        self.not_modified = 0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=self.limits,
+                transport=self.transport,
+            )
+        return self._client
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def fetch(self, url: str) -> Optional[bytes]:
+        """
+        URL の内容を取得して返す。404 などの再取得しても変わらない 4xx の場合は
+        TileNotFound を送出し、一時的な障害 (タイムアウト、接続エラー、5xx、
+        408、429) の場合は None を返す。
+        変更がなければ (304) 前回の内容を返す
+        """
+        entry = self.validators.peek(url)
+        validators = None if entry is None else entry.value
+        headers = {}
+        if validators is not None:
+            if validators.etag is not None:
+                headers["If-None-Match"] = validators.etag
+            if validators.last_modified is not None:
+                headers["If-Modified-Since"] = validators.last_modified
+        async with self._get_semaphore():
+            try:
+                response = await self._get_client().get(url, headers=headers)
+                if response.status_code == 304 and validators is not None:
+                    logger.info(f"image not modified at {url}")
+                    self.not_modified += 1
+                    # 待っている間に追い出されていれば、手元の内容を入れ直す
+                    if self.validators.get(url) is None:
+                        self.validators.set(url, validators, "")
+                    return validators.content
+                if response.status_code == 200:
+                    logger.info(f"successful image download from {url}")
+                    self._store_validators(url, response)
+                    return response.content
+                if (
+                    400 <= response.status_code < 500
+                    and response.status_code not in TRANSIENT_CLIENT_ERRORS
+                ):
+                    logger.info(
+                        f"image not found at {url}"
+                        f" ({response.status_code})"
+                    )
+                    raise TileNotFound(url)
+                logger.warning(
+                    f"unexpected response {response.status_code} from {url}"
+                )
+            except TileNotFound:
+                raise
+            except Exception:
+                logger.exception(f"failed to download image from {url}")
+        return None
+
+    def _store_validators(self, url: str, response: httpx.Response):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            self.validators.pop(url)
+            return
+        self.validators.set(
+            url,
+            Validators(etag, last_modified, response.content),
+            "",
+        )
+
+    async def aclose(self):
+        """
+        プールしている接続を閉じる
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self._semaphore = None
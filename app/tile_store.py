@@ -0,0 +1,337 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import fcntl
+import mmap
+import os
+from pathlib import Path
+import struct
+import threading
+import time
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
+from typing import NamedTuple
+from typing import Optional
+from typing import Protocol
+from typing import Tuple
+from typing import Union
+
+from fastapi.logger import logger
+
+from pixel_tile import PixelTile
+
+# セグメントファイル先頭のヘッダ: マジックナンバー, 使用済みバイト数
+SEGMENT_HEADER = struct.Struct("<4s4xQ")
+SEGMENT_MAGIC = b"LWTS"
+# 新しいセグメントファイルの大きさ。足りなくなれば倍にしていく
+INITIAL_SEGMENT_SIZE = 1024 * 1024
+# タイルごとのヘッダ: マジックナンバー, zoom, x, y, 幅, 高さ, 詰めて保持しているか
+HEADER = struct.Struct("<4sIIIHHB3x")
+MAGIC = b"LWPT"
+
+
+class TileKey(NamedTuple):
+    """
+    保存するタイルを識別するキー
+    """
+    product: str
+    observation_timestamp: str
+    forecast_timestamp: str
+    zoom: int
+    tile_x: int
+    tile_y: int
+
+
+class TileStore(Protocol):
+    """
+    プロセスの外にタイルを保存するタイルストアのインターフェース
+
+    try_lock はキーのロックを取れればそのハンドルを、他のプロセスなどが
+    ロックを持っていれば None を返す。ロックは同じタイルの取得を 1 つに
+    まとめるためだけに使う。
+    """
+    def get(self, key: TileKey) -> Optional[PixelTile]:
+        ...
+
+    def put(self, key: TileKey, tile: PixelTile):
+        ...
+
+    def try_lock(self, key: TileKey) -> Optional[Any]:
+        ...
+
+    def unlock(self, handle: Any):
+        ...
+
+
+@asynccontextmanager
+async def locked(
+    store: TileStore,
+    key: TileKey,
+    timeout: float = 5.0,
+    interval: float = 0.05,
+) -> AsyncIterator[bool]:
+    """
+    イベントループを止めずにキーのロックを待つ。timeout 秒待っても取れなければ
+    ロックなしで進め、ロックを取れたかどうかを返す
+    """
+    deadline = time.monotonic() + timeout
+    handle = store.try_lock(key)
+    while handle is None and time.monotonic() < deadline:
+        await asyncio.sleep(interval)
+        handle = store.try_lock(key)
+    try:
+        yield handle is not None
+    finally:
+        if handle is not None:
+            store.unlock(handle)
+
+
+class MemoryTileStore:
+    """
+    プロセス内にタイルを保存するタイルストア
+
+    外部のタイルストアの代わりにテストなどで使う。
+    """
+    def __init__(self):
+        self.tiles: Dict[TileKey, PixelTile] = {}
+        self.locks: Dict[TileKey, threading.Lock] = {}
+
+    def get(self, key: TileKey) -> Optional[PixelTile]:
+        return self.tiles.get(key)
+
+    def put(self, key: TileKey, tile: PixelTile):
+        self.tiles[key] = tile
+
+    def try_lock(self, key: TileKey) -> Optional[threading.Lock]:
+        lock = self.locks.setdefault(key, threading.Lock())
+        return lock if lock.acquire(blocking=False) else None
+
+    def unlock(self, handle: threading.Lock):
+        handle.release()
+
+
+class Segment:
+    """
+    メモリマップしたセグメントファイルと、そこに書かれたタイルの索引
+    """
+    __slots__ = ("inode", "buffer", "index", "offset")
+
+    def __init__(self, inode: int, buffer: mmap.mmap):
+        self.inode = inode
+        self.buffer = buffer
+        # (zoom, x, y) -> (データの位置, 幅, 高さ, 詰めて保持しているか)
+        self.index: Dict[Tuple[int, int, int], Tuple[int, int, int, bool]] = {}
+        self.offset = SEGMENT_HEADER.size
+
+
+def get_data_size(width: int, height: int, packed: bool) -> int:
+    """
+    タイルのパレット番号のバイト数を返す
+    """
+    return width * height // 2 if packed else width * height
+
+
+class DiskTileStore:
+    """
+    PixelTile をディスクに保存するタイルストア
+
+    同じプロダクト・観測時刻・予報時刻のタイルは 1 つのセグメントファイル
+    {root}/{product}/{観測時刻}/{予報時刻}.seg に追記していく。
+    読み込み時はセグメントファイル全体を 1 度だけメモリマップし、タイルは
+    そのマップ上のバイト列を参照するので、ファイルディスクリプタは
+    タイルごとではなくセグメントごとに 1 つで済む。
+
+    root を /dev/shm などの共有メモリ上に置くと、同じホストで動く複数の
+    ワーカーがページキャッシュ上の同じタイルを共有し、ワーカーを増やしても
+    タイルのメモリ使用量は増えない。
+    ロックにはタイルごとのロックファイルへの flock を使う。
+    """
+    def __init__(self, root: Union[str, Path], max_segments: int = 64):
+        self.root = Path(root)
+        self.max_segments = max_segments
+        self.segments: "OrderedDict[Path, Segment]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_segment_path(self, key: TileKey) -> Path:
+        return (
+            self.root
+            / key.product
+            / key.observation_timestamp
+            / f"{key.forecast_timestamp}.seg"
+        )
+
+    def get_lock_path(self, key: TileKey) -> Path:
+        return (
+            self.root
+            / key.product
+            / key.observation_timestamp
+            / key.forecast_timestamp
+            / str(key.zoom)
+            / str(key.tile_x)
+            / f"{key.tile_y}.lock"
+        )
+
+    def get(self, key: TileKey) -> Optional[PixelTile]:
+        """
+        キーのタイルを読み込んで返す。保存されていなければ None を返す
+        """
+        path = self.get_segment_path(key)
+        coordinate = (key.zoom, key.tile_x, key.tile_y)
+        with self.lock:
+            segment = self.segments.get(path)
+            if segment is None or coordinate not in segment.index:
+                segment = self.load_segment(path, segment)
+                if segment is None or coordinate not in segment.index:
+                    return None
+            self.segments.move_to_end(path)
+            offset, width, height, packed = segment.index[coordinate]
+            size = get_data_size(width, height, packed)
+            data = memoryview(segment.buffer)[offset:offset + size]
+        return PixelTile(width, height, packed, data)
+
+    def load_segment(
+        self,
+        path: Path,
+        segment: Optional[Segment],
+    ) -> Optional[Segment]:
+        """
+        セグメントファイルに追記されたタイルを索引に加える。
+        ファイルが伸びていればメモリマップし直す
+        """
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size < SEGMENT_HEADER.size:
+                    return segment
+                if (
+                    segment is None
+                    or segment.inode != stat.st_ino
+                    or stat.st_size > len(segment.buffer)
+                ):
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    if segment is None or segment.inode != stat.st_ino:
+                        segment = Segment(stat.st_ino, buffer)
+                    else:
+                        segment.buffer = buffer
+        except FileNotFoundError:
+            self.segments.pop(path, None)
+            return None
+        except (OSError, ValueError):
+            logger.exception(f"failed to read tiles from {path}")
+            return None
+        buffer = segment.buffer
+        magic, used = SEGMENT_HEADER.unpack_from(buffer)
+        if magic != SEGMENT_MAGIC:
+            logger.warning(f"unexpected tile segment {path}")
+            return None
+        used = min(used, len(buffer))
+        offset = segment.offset
+        while offset + HEADER.size <= used:
+            magic, zoom, tile_x, tile_y, width, height, packed = (
+                HEADER.unpack_from(buffer, offset)
+            )
+            if magic != MAGIC:
+                logger.warning(f"unexpected tile record in {path}")
+                break
+            data_offset = offset + HEADER.size
+            size = get_data_size(width, height, bool(packed))
+            if data_offset + size > used:
+                # 書きかけや切り詰められたタイルは読まない
+                break
+            segment.index[(zoom, tile_x, tile_y)] = (
+                data_offset,
+                width,
+                height,
+                bool(packed),
+            )
+            offset = data_offset + size
+        segment.offset = offset
+        self.segments[path] = segment
+        while len(self.segments) > self.max_segments:
+            self.segments.popitem(last=False)
+        return segment
+
+    def put(self, key: TileKey, tile: PixelTile):
+        """
+        タイルをセグメントファイルに追記する。読み込み側が書き込み途中の
+        タイルを読まないように、タイルを書いてからヘッダの使用済みバイト数を
+        更新する
+        """
+        size = get_data_size(tile.width, tile.height, tile.packed)
+        if tile.nbytes != size:
+            raise ValueError(
+                f"tile data is {tile.nbytes} bytes, expected {size} bytes"
+            )
+        path = self.get_segment_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        record = HEADER.pack(
+            MAGIC,
+            key.zoom,
+            key.tile_x,
+            key.tile_y,
+            tile.width,
+            tile.height,
+            tile.packed,
+        ) + bytes(tile.data)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            capacity = os.fstat(fd).st_size
+            used = SEGMENT_HEADER.size
+            if capacity >= SEGMENT_HEADER.size:
+                magic, used = SEGMENT_HEADER.unpack(
+                    os.pread(fd, SEGMENT_HEADER.size, 0)
+                )
+                if magic != SEGMENT_MAGIC:
+                    raise ValueError(f"unexpected tile segment {path}")
+            end = used + len(record)
+            if end > capacity:
+                os.ftruncate(
+                    fd,
+                    max(end, capacity * 2, INITIAL_SEGMENT_SIZE),
+                )
+            os.pwrite(fd, record, used)
+            os.pwrite(fd, SEGMENT_HEADER.pack(SEGMENT_MAGIC, end), 0)
+        finally:
+            os.close(fd)
+
+    def try_lock(self, key: TileKey) -> Optional[int]:
+        path = self.get_lock_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def unlock(self, handle: int):
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        os.close(handle)
+
+    def prune(self, max_age: float) -> int:
+        """
+        更新から max_age 秒より古いセグメントファイル・ロックファイルと
+        空のディレクトリを削除し、削除したファイル数を返す
+        """
+        deadline = time.time() - max_age
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.root, topdown=False):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.stat(path).st_mtime < deadline:
+                        os.unlink(path)
+                        removed += 1
+                        with self.lock:
+                            self.segments.pop(Path(path), None)
+                except FileNotFoundError:
+                    pass
+            if dirpath != str(self.root):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+        return removed
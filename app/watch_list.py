@@ -0,0 +1,121 @@
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import numpy as np
+
+from pixel_tile import PixelTile
+
+
+class WatchValue(NamedTuple):
+    """
+    監視地点の値 (パレット番号) と、その画像の観測時刻、予報時刻
+    """
+    pixel_value: int
+    observation_timestamp: str
+    forecast_timestamp: str
+    stale: bool
+
+
+class WatchList:
+    """
+    繰り返し問い合わせられる地点 (監視地点) を登録し、その値を保持する
+
+    監視地点のタイル座標とピクセル座標は登録時に一度だけ計算し、タイルごとに
+    まとめておく。タイルが更新されると、そのタイルに含まれる監視地点の値を
+    まとめて取り出して保持するので、値の読み出しは辞書を引くだけで済む。
+    """
+    def __init__(self):
+        self.positions: Dict[str, Any] = {}
+        self.values: Dict[str, WatchValue] = {}
+        self._members: Dict[Tuple[int, int], Dict[str, None]] = {}
+        self._tiles: Dict[
+            Tuple[int, int],
+            Tuple[List[str], np.ndarray, np.ndarray],
+        ] = {}
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.positions
+
+    def add(self, name: str, position: Any):
+        """
+        監視地点を登録する。position は tile_x, tile_y, pixel_x, pixel_y を持つもの
+        """
+        if name in self.positions:
+            self.remove(name)
+        self.positions[name] = position
+        key = (position.tile_x, position.tile_y)
+        self._members.setdefault(key, {})[name] = None
+        self._index(key)
+
+    def remove(self, name: str) -> Optional[Any]:
+        """
+        監視地点の登録を取り消し、その位置を返す
+        """
+        position = self.positions.pop(name, None)
+        self.values.pop(name, None)
+        if position is not None:
+            key = (position.tile_x, position.tile_y)
+            del self._members[key][name]
+            self._index(key)
+        return position
+
+    def tiles(self) -> Set[Tuple[int, int]]:
+        """
+        監視地点を含むタイル座標の集合を返す
+        """
+        return set(self._tiles)
+
+    def update(
+        self,
+        tile_x: int,
+        tile_y: int,
+        tile: Optional[PixelTile],
+        observation_timestamp: str,
+        forecast_timestamp: str,
+        stale: bool = False,
+    ) -> List[str]:
+        """
+        タイルに含まれる監視地点の値をまとめて取り出して保持し、更新した地点の名前を返す。
+        タイルがなければパレット番号 0 とする。保持している値より古い予報時刻なら無視する
+        """
+        index = self._tiles.get((tile_x, tile_y))
+        if index is None:
+            return []
+        names, pixel_xs, pixel_ys = index
+        current = self.values.get(names[0])
+        if current is not None and (
+            current.forecast_timestamp > forecast_timestamp
+        ):
+            return []
+        if tile is None:
+            pixel_values = [0] * len(names)
+        else:
+            pixel_values = tile.get_many(pixel_xs, pixel_ys).tolist()
+        for name, pixel_value in zip(names, pixel_values):
+            self.values[name] = WatchValue(
+                pixel_value,
+                observation_timestamp,
+                forecast_timestamp,
+                stale,
+            )
+        return names
+
+    def _index(self, key: Tuple[int, int]):
+        names = list(self._members.get(key, ()))
+        if not names:
+            self._members.pop(key, None)
+            self._tiles.pop(key, None)
+            return
+        self._tiles[key] = (
+            names,
+            np.array([self.positions[name].pixel_x for name in names]),
+            np.array([self.positions[name].pixel_y for name in names]),
+        )